@@ -0,0 +1,213 @@
+import os
+import sys
+import shutil
+import threading
+from Queue import Queue
+
+import torch
+
+from agent.fast_checkpoint import fastPath, saveFastCheckpoint
+
+
+def snapshot(x):
+    """
+    copy the tensors in a (nested) state dict to cpu, so the copy no longer changes with the training
+    """
+    if isinstance(x, torch.Tensor):
+        return x.detach().to('cpu', copy=True)
+    if isinstance(x, dict):
+        return type(x)((k, snapshot(v)) for k, v in x.items())
+    if hasattr(x, '_fields'):
+        return type(x)(*map(snapshot, x))
+    if type(x) in (tuple, list):
+        return type(x)(map(snapshot, x))
+    return x
+
+
+class CheckpointWriter(object):
+    def __init__(self, saving_dir, keep_last=None, keep_every=None, background=False, max_pending=1):
+        """
+        write the files of a checkpoint atomically (to a temporary file, then renamed), or its directory in the fast
+        layout, and delete the older checkpoints of this writer by a retention policy. checkpoints written before the
+        writer was created, e.g. the one a run was resumed from, are never deleted. files a checkpoint references, e.g.
+        the replay segments of its manifest, are deleted once released and no kept checkpoint of this writer
+        references them
+        :param saving_dir: directory of the run
+        :param keep_last: number of the newest checkpoints kept, None keeps all of them
+        :param keep_every: also keep every keep_every-th checkpoint, None keeps no others
+        :param background: serialize and write in a background thread, save only queues the snapshot
+        :param max_pending: number of checkpoints queued for the thread before save blocks
+        """
+        self.saving_dir = saving_dir
+        self.keep_last = keep_last
+        self.keep_every = keep_every
+        self.background = background
+        self.history = []
+        self.released = set()
+        self.n_written = 0
+        self.exc_info = None
+        self.queue = None
+        self.thread = None
+        if background:
+            self.queue = Queue(maxsize=max_pending)
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                if self.exc_info is None:
+                    function, args = item
+                    function(*args)
+            except Exception:
+                self.exc_info = sys.exc_info()
+            finally:
+                self.queue.task_done()
+
+    def _raise(self):
+        if self.exc_info is not None:
+            exc_info = self.exc_info
+            self.exc_info = None
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def path(self, prefix, time_stamp):
+        return os.path.join(self.saving_dir, prefix + '.' + time_stamp + '.pth.tar')
+
+    def _submit(self, function, *args):
+        self._raise()
+        if self.background:
+            self.queue.put((function, args))
+        else:
+            function(*args)
+
+    def save(self, time_stamp, files, refs=()):
+        """
+        write one checkpoint, or queue it for the background thread. the objects must not change afterwards, see
+        snapshot
+        :param time_stamp: time stamp of the checkpoint
+        :param files: list of (prefix, object), each object is saved to prefix.time_stamp.pth.tar
+        :param refs: paths of other files the checkpoint needs to be loaded, kept as long as the checkpoint is
+        :return: None
+        """
+        self._submit(self.write, time_stamp, files, list(refs))
+
+    def saveFast(self, time_stamp, model_state, metrics, replay):
+        """
+        write one checkpoint as the directory of fast_checkpoint.saveFastCheckpoint, or queue it for the background
+        thread, under the same retention policy as save. the objects must not change afterwards
+        :param time_stamp: time stamp of the checkpoint
+        :return: None
+        """
+        self._submit(self.writeFast, time_stamp, model_state, metrics, replay)
+
+    def saveFile(self, path, obj):
+        """
+        save one object atomically, in order with the checkpoints but outside of the retention policy
+        :param path: path of the file
+        :param obj: object to save, must not change afterwards
+        :return: None
+        """
+        self._submit(self.writeFile, path, obj)
+
+    def release(self, paths):
+        """
+        delete files saved by saveFile once no kept checkpoint references them, in order with the writes
+        :param paths: list of paths
+        :return: None
+        """
+        self._submit(self.releaseFiles, list(paths))
+
+    def releaseFiles(self, paths):
+        self.released.update(paths)
+        self.collect()
+
+    def collect(self):
+        """
+        delete the released files no kept checkpoint references
+        :return: None
+        """
+        referenced = set()
+        for _, _, refs in self.history:
+            referenced.update(refs)
+        for path in self.released - referenced:
+            self.deleteFile(path)
+        self.released &= referenced
+
+    @staticmethod
+    def writeFile(path, obj):
+        torch.save(obj, path + '.tmp')
+        os.rename(path + '.tmp', path)
+
+    @staticmethod
+    def deleteFile(path):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def write(self, time_stamp, files, refs=()):
+        """
+        save the files of one checkpoint and apply the retention policy
+        :return: None
+        """
+        paths = []
+        for prefix, obj in files:
+            path = self.path(prefix, time_stamp)
+            self.writeFile(path, obj)
+            paths.append(path)
+        self.retain(paths, refs)
+
+    def writeFast(self, time_stamp, model_state, metrics, replay):
+        """
+        save one checkpoint in the fast layout and apply the retention policy
+        :return: None
+        """
+        directory = fastPath(self.saving_dir, time_stamp)
+        saveFastCheckpoint(directory, model_state, metrics, replay)
+        self.retain([directory])
+
+    def retain(self, paths, refs=()):
+        """
+        record a written checkpoint, delete the checkpoints the retention policy no longer keeps and the released
+        files only they referenced
+        :param paths: files or directories of the checkpoint
+        :param refs: paths of other files the checkpoint needs
+        :return: None
+        """
+        self.n_written += 1
+        self.history.append((self.n_written, paths, refs))
+        if self.keep_last is None:
+            return
+        kept = []
+        for i, (n, checkpoint_paths, checkpoint_refs) in enumerate(self.history):
+            if len(self.history) - i <= self.keep_last or (self.keep_every and n % self.keep_every == 0):
+                kept.append((n, checkpoint_paths, checkpoint_refs))
+                continue
+            for path in checkpoint_paths:
+                self.deleteFile(path)
+        self.history = kept
+        self.collect()
+
+    def wait(self):
+        """
+        block until the queued checkpoints are written
+        :return: None
+        """
+        if self.background:
+            self.queue.join()
+        self._raise()
+
+    def stop(self):
+        """
+        write the queued checkpoints and stop the thread
+        :return: None
+        """
+        if self.background:
+            self.queue.put(None)
+            self.thread.join()
+            self.background = False
+        self._raise()
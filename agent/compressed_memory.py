@@ -0,0 +1,266 @@
+import time
+import zlib
+from collections import deque
+
+import numpy as np
+import torch
+
+from agent.sequence_memory import SequenceReplayMemory, PrioritizedSequenceReplayMemory
+
+try:
+    import lz4.frame as lz4
+except ImportError:
+    lz4 = None
+
+
+class FrameCodec(object):
+    def __init__(self, codec='zlib', level=1):
+        """
+        lossless compression of single frames, decoding is timed so the cost can be traded against the memory saved
+        :param codec: 'zlib', or 'lz4' if the lz4 package is installed
+        :param level: compression level
+        """
+        assert codec in ('zlib', 'lz4'), 'unknown codec: ' + codec
+        assert codec != 'lz4' or lz4 is not None, 'the lz4 codec needs the lz4 package'
+        self.codec = codec
+        self.level = level
+        self.decoded_frames = 0
+        self.decode_time = 0.
+
+    def encode(self, frame):
+        """
+        :param frame: tensor
+        :return: compressed bytes of the frame
+        """
+        data = frame.to('cpu').contiguous().numpy().tobytes()
+        if self.codec == 'lz4':
+            return lz4.compress(data, compression_level=self.level)
+        return zlib.compress(data, self.level)
+
+    def decode(self, frames, shape, dtype):
+        """
+        decompress a list of frames into one batch, a buffer listed several times is decompressed once
+        :param frames: list of compressed frames
+        :param shape: shape of one frame
+        :param dtype: numpy dtype of the frames
+        :return: tensor, len(frames) x shape
+        """
+        start = time.time()
+        decompress = lz4.decompress if self.codec == 'lz4' else zlib.decompress
+        out = np.empty((len(frames),) + tuple(shape), dtype=dtype)
+        flat = out.reshape(len(frames), -1)
+        rows = {}
+        for i, frame in enumerate(frames):
+            if id(frame) in rows:
+                flat[i] = flat[rows[id(frame)]]
+            else:
+                flat[i] = np.frombuffer(decompress(frame), dtype=dtype)
+                rows[id(frame)] = i
+        self.decode_time += time.time() - start
+        self.decoded_frames += len(rows)
+        return torch.from_numpy(out)
+
+
+class CompressedStorage(object):
+    """
+    mixin storing the image components (2 or more dims per sample) of the states of a replay memory as one compressed
+    buffer per slot, the other components and fields stay in tensors. a frame equal to the state that follows it, or
+    to one of the last n_recent encoded next states, shares its buffer, so consecutive frames are stored once.
+    frames are decoded in gather, i.e. in the prefetch thread when the agent prefetches
+    """
+    def initCodec(self, codec='zlib', level=1, n_recent=16):
+        """
+        :param codec: 'zlib' or 'lz4'
+        :param level: compression level
+        :param n_recent: number of encoded next states kept to match against the next pushed states, at least the
+                         number of envs pushing in turn
+        """
+        self.codec = FrameCodec(codec, level)
+        self.frame_specs = None
+        self.recent = deque(maxlen=n_recent)
+
+    def _allocate(self, state):
+        self.tuple_state = type(state) in (tuple, list)
+        n_slots = len(self.actions)
+        self.frame_specs = []
+        self.states = []
+        self.next_states = []
+        for s in self._components(state):
+            if s.dim() > 2:
+                shape = tuple(s.shape[1:])
+                zero = self.codec.encode(torch.zeros(shape, dtype=s.dtype))
+                self.frame_specs.append((shape, torch.zeros(0, dtype=s.dtype).numpy().dtype, zero))
+                self.states.append([zero] * n_slots)
+                self.next_states.append([zero] * n_slots)
+            else:
+                self.frame_specs.append(None)
+                self.states.append(torch.zeros((n_slots,) + s.shape[1:], dtype=s.dtype))
+                self.next_states.append(torch.zeros((n_slots,) + s.shape[1:], dtype=s.dtype))
+
+    def _components(self, state):
+        return state if self.tuple_state else [state]
+
+    def _encodeState(self, i, frame):
+        frame = frame.to('cpu')
+        for recent_i, recent_frame, encoded in self.recent:
+            if recent_i == i and recent_frame.shape == frame.shape and torch.equal(recent_frame, frame):
+                return encoded
+        return self.codec.encode(frame)
+
+    def _storeStates(self, slots, states, next_states):
+        idx = torch.from_numpy(slots)
+        for i, spec in enumerate(self.frame_specs):
+            if spec is None:
+                padding = torch.zeros_like(states[0][i])
+                self.states[i][idx] = torch.cat([s[i] for s in states]).to('cpu', self.states[i].dtype)
+                self.next_states[i][idx] = torch.cat([s[i] if s is not None else padding for s in next_states]) \
+                    .to('cpu', self.states[i].dtype)
+                continue
+            encoded = [self._encodeState(i, s[i]) for s in states]
+            for j, slot in enumerate(slots):
+                self.states[i][slot] = encoded[j]
+                next_state = next_states[j]
+                if next_state is None:
+                    self.next_states[i][slot] = spec[2]
+                elif j + 1 < len(states) and torch.equal(next_state[i], states[j + 1][i]):
+                    self.next_states[i][slot] = encoded[j + 1]
+                else:
+                    frame = next_state[i].to('cpu')
+                    self.next_states[i][slot] = self.codec.encode(frame)
+                    self.recent.append((i, frame, self.next_states[i][slot]))
+
+    def _gatherStates(self, idx):
+        state = []
+        next_state = []
+        for i, spec in enumerate(self.frame_specs):
+            if spec is None:
+                state.append(self.states[i][torch.from_numpy(idx)])
+                next_state.append(self.next_states[i][torch.from_numpy(idx)])
+                continue
+            frames = [self.states[i][slot] for slot in idx.flat] + [self.next_states[i][slot] for slot in idx.flat]
+            decoded = self.codec.decode(frames, spec[0], spec[1]).view((2,) + idx.shape + spec[0])
+            state.append(decoded[0])
+            next_state.append(decoded[1])
+        return state, next_state
+
+    def _gatherFrames(self, idx):
+        state = []
+        for i, spec in enumerate(self.frame_specs):
+            if spec is None:
+                state.append(self.states[i][torch.from_numpy(idx)])
+                continue
+            state.append(self.codec.decode([self.states[i][slot] for slot in idx.flat], spec[0], spec[1])
+                         .view(idx.shape + spec[0]))
+        return state
+
+    def compressionStats(self):
+        """
+        :return: dict with the MB the stored frames take raw and compressed, their ratio and the decode time per
+                 frame in ms
+        """
+        raw = stored = 0
+        for i, spec in enumerate(self.frame_specs or []):
+            if spec is None:
+                continue
+            raw += 2 * len(self) * int(np.prod(spec[0])) * spec[1].itemsize
+            buffers = {}
+            for storage in (self.states[i], self.next_states[i]):
+                for frame in storage:
+                    buffers[id(frame)] = len(frame)
+            stored += sum(buffers.values())
+        return {
+            'raw_mb': raw / 2. ** 20,
+            'stored_mb': stored / 2. ** 20,
+            'ratio': float(raw) / max(stored, 1),
+            'decode_ms_per_frame': 1000. * self.codec.decode_time / max(self.codec.decoded_frames, 1)
+        }
+
+
+class CompressedReplayMemory(CompressedStorage):
+    def __init__(self, capacity, codec='zlib', level=1):
+        """
+        ring of transitions for SynDQNAgent with the image components of the states compressed
+        :param capacity: number of transitions to store
+        :param codec: 'zlib' or 'lz4'
+        :param level: compression level
+        """
+        self.initCodec(codec, level)
+        self.capacity = capacity
+        self.states = None
+        self.next_states = None
+        self.tuple_state = False
+        self.actions = torch.zeros(capacity, 1, dtype=torch.long)
+        self.rewards = torch.zeros(capacity)
+        self.finals = torch.zeros(capacity, dtype=torch.uint8)
+        self.position = 0
+        self.size = 0
+
+    def push(self, state, action, next_state, reward):
+        """
+        store one transition, next_state is None for final transitions
+        """
+        if self.states is None:
+            self._allocate(state)
+        self._storeStates(np.array([self.position]), [self._components(state)],
+                          [self._components(next_state) if next_state is not None else None])
+        self.finals[self.position] = 1 if next_state is None else 0
+        self.actions[self.position] = action.to('cpu')
+        self.rewards[self.position] = reward.to('cpu')
+        self.position = (self.position + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def sampleIndex(self, batch_size):
+        """
+        :param batch_size: size of the mini batch
+        :return: numpy array of slots, sampled with replacement
+        """
+        return np.random.randint(0, self.size, batch_size)
+
+    def gather(self, idx):
+        """
+        gather the batch at the given slots
+        :param idx: numpy array of slots
+        :return: state, action, next_state, reward, final_mask, non_pad_mask
+        """
+        state, next_state = self._gatherStates(idx)
+        if self.tuple_state:
+            state = tuple(state)
+            next_state = tuple(next_state)
+        else:
+            state = state[0]
+            next_state = next_state[0]
+        idx = torch.from_numpy(idx)
+        non_pad_mask = torch.ones(len(idx), dtype=torch.uint8)
+        return state, self.actions[idx], next_state, self.rewards[idx], self.finals[idx], non_pad_mask
+
+    def sample(self, batch_size):
+        return self.gather(self.sampleIndex(batch_size))
+
+    def __len__(self):
+        return self.size
+
+
+class CompressedSequenceReplayMemory(CompressedStorage, SequenceReplayMemory):
+    def __init__(self, capacity, sequence_len, codec='zlib', level=1):
+        """
+        SequenceReplayMemory with the image components of the states compressed
+        :param capacity: number of transitions to store
+        :param sequence_len: length of the sampled slices
+        :param codec: 'zlib' or 'lz4'
+        :param level: compression level
+        """
+        self.initCodec(codec, level)
+        SequenceReplayMemory.__init__(self, capacity, sequence_len)
+
+
+class CompressedPrioritizedSequenceReplayMemory(CompressedStorage, PrioritizedSequenceReplayMemory):
+    def __init__(self, capacity, sequence_len, codec='zlib', level=1):
+        """
+        PrioritizedSequenceReplayMemory with the image components of the states compressed
+        :param capacity: number of transitions to store
+        :param sequence_len: length of the sampled slices
+        :param codec: 'zlib' or 'lz4'
+        :param level: compression level
+        """
+        self.initCodec(codec, level)
+        PrioritizedSequenceReplayMemory.__init__(self, capacity, sequence_len)
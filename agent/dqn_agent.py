@@ -4,6 +4,7 @@ import time
 import copy
 from abc import abstractmethod
 import os
+import threading
 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -15,6 +16,16 @@ import torch.nn as nn
 import torch.optim as optim
 import torch.nn.functional as F
 
+from util.utils import LinearSchedule
+from util.segment_tree import SumTree
+from agent.replay_log import ReplayLog
+from agent.prefetcher import BatchPrefetcher
+from agent.checkpoint_writer import CheckpointWriter, snapshot
+from agent.fast_checkpoint import fastPath, hasArrayStorage, loadMetrics, loadModelState, loadReplay
+from agent.warm_up import collectParallel
+from agent.target_cache import TargetCache
+from agent.learner_thread import LearnerThread
+
 Transition = namedtuple('Transition', ('state', 'action', 'next_state', 'reward'))
 
 
@@ -44,9 +55,251 @@ class ReplayMemory(object):
         return len(self.memory)
 
 
+class ArrayReplayMemory(object):
+    def __init__(self, capacity):
+        """
+        replay memory backed by preallocated tensors. the next state of a transition is read from the following slot,
+        where the next push stores the same state. a non final transition followed by a push of another state (an
+        episode cut by a time limit, then reset) keeps its next state in self.boundary_next_states instead
+        :param capacity: number of transitions to store
+        """
+        self.capacity = capacity
+        self.states = None
+        self.actions = torch.zeros(capacity, 1, dtype=torch.long)
+        self.rewards = torch.zeros(capacity)
+        self.finals = torch.zeros(capacity, dtype=torch.uint8)
+        self.position = 0
+        self.size = 0
+        # slot -> next state of the non final transitions whose following slot holds another episode
+        self.boundary_next_states = {}
+        # the slot at self.position holds the provisional next state of the last transition
+        self.pending = False
+
+    def __setstate__(self, state):
+        # memories pickled before the episode boundaries were kept
+        state.setdefault('boundary_next_states', {})
+        state.setdefault('pending', False)
+        self.__dict__.update(state)
+
+    def pendingNextState(self):
+        """
+        :return: the provisional next state of the last transition, stored at self.position
+        """
+        return self.states[self.position].clone()
+
+    def checkBoundary(self, state):
+        """
+        called before a push. if the pushed state is not the provisional next state of the last transition, the
+        last transition was cut without a final state and its next state is moved to self.boundary_next_states
+        :param state: state of the pushed transition, as stored in the slot at self.position
+        :return: True if the push starts a new episode
+        """
+        self.boundary_next_states.pop(self.position, None)
+        if not self.pending:
+            return False
+        pending = self.pendingNextState()
+        if torch.equal(pending, state.to('cpu', pending.dtype)):
+            return False
+        self.boundary_next_states[(self.position - 1) % self.capacity] = pending
+        return True
+
+    def gatherNextStates(self, idx, next_states):
+        """
+        replace the next states of the sampled transitions cut at an episode boundary
+        :param idx: long tensor of non final slots
+        :param next_states: tensor of their next states read from the following slots, modified in place
+        :return: next_states
+        """
+        if len(self.boundary_next_states) > 0:
+            for row, slot in enumerate(idx.tolist()):
+                if slot in self.boundary_next_states:
+                    next_states[row] = self.boundary_next_states[slot]
+        return next_states
+
+    def push(self, *args):
+        state, action, next_state, reward = args
+        if self.states is None:
+            self.states = torch.zeros((self.capacity,) + state.shape[1:], dtype=state.dtype)
+        self.checkBoundary(state[0])
+        self.states[self.position] = state[0]
+        self.actions[self.position] = action[0]
+        self.rewards[self.position] = reward[0]
+        self.finals[self.position] = next_state is None
+        self.position = (self.position + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+        self.pending = next_state is not None
+        if next_state is not None:
+            # provisional, overwritten by the same state when the next transition is pushed
+            self.states[self.position] = next_state[0]
+
+    def gather(self, idx):
+        """
+        gather the transitions at the given slots
+        :param idx: long tensor of slots
+        :return: state, action, reward, non_final_mask, non_final_next_state tensors
+        """
+        non_final_mask = self.finals[idx] == 0
+        non_final_idx = idx[non_final_mask.nonzero().view(-1)]
+        next_states = self.gatherNextStates(non_final_idx, self.states[(non_final_idx + 1) % self.capacity])
+        return self.states[idx], self.actions[idx], self.rewards[idx], non_final_mask, next_states
+
+    def sampleIndex(self, batch_size):
+        """
+        sample slots uniformly (with replacement)
+        :param batch_size: size of the mini batch
+        :return: long tensor of slots, None (no importance sampling weights)
+        """
+        if self.size < self.capacity:
+            idx = torch.randint(0, self.size, (batch_size,), dtype=torch.long)
+        else:
+            # the slot at self.position may hold the pending next state instead of its own transition
+            idx = (torch.randint(1, self.capacity, (batch_size,), dtype=torch.long) + self.position) % self.capacity
+        return idx, None
+
+    def sample(self, batch_size):
+        """
+        sample a mini batch (with replacement)
+        :param batch_size: size of the mini batch
+        :return: state, action, reward, non_final_mask, non_final_next_state tensors
+        """
+        idx, _ = self.sampleIndex(batch_size)
+        return self.gather(idx)
+
+    def __len__(self):
+        return self.size
+
+
+class FrameStackReplayMemory(ArrayReplayMemory):
+    def __init__(self, capacity, stack):
+        """
+        replay memory for frame stacked observations (gym_test.wrapper.FrameStack). only the newest frame of every
+        state is stored (as uint8), stacks are rebuilt from the previous slots at sample time. frames before the start
+        of an episode repeat its first frame, as FrameStack does on reset. an episode starts after a final transition,
+        or with a push whose stack is not the pending next stack (the last episode was cut by a time limit)
+        :param capacity: number of transitions to store
+        :param stack: number of frames in a state
+        """
+        ArrayReplayMemory.__init__(self, capacity)
+        self.stack = stack
+        self.episode_steps = torch.zeros(capacity, dtype=torch.long)
+        self.next_step = 0
+
+    def push(self, *args):
+        state, action, next_state, reward = args
+        channels = state.shape[1] // self.stack
+        if self.states is None:
+            self.states = torch.zeros((self.capacity, channels) + state.shape[2:], dtype=torch.uint8)
+        if self.checkBoundary(state[0]):
+            self.next_step = 0
+        self.states[self.position] = state[0, -channels:]
+        self.actions[self.position] = action[0]
+        self.rewards[self.position] = reward[0]
+        self.finals[self.position] = next_state is None
+        self.episode_steps[self.position] = self.next_step
+        self.position = (self.position + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+        self.pending = next_state is not None
+        if next_state is not None:
+            self.states[self.position] = next_state[0, -channels:]
+            self.episode_steps[self.position] = self.next_step + 1
+            self.next_step += 1
+        else:
+            self.next_step = 0
+
+    def stackFrames(self, idx):
+        """
+        rebuild the states ending at the given slots
+        :param idx: long tensor of slots
+        :return: uint8 tensor, len(idx) x stack * channels x h x w
+        """
+        back = torch.arange(self.stack - 1, -1, -1, dtype=torch.long).unsqueeze(0)
+        back = torch.min(back.expand(len(idx), self.stack), self.episode_steps[idx].unsqueeze(1))
+        frames = self.states[(idx.unsqueeze(1) - back) % self.capacity]
+        return frames.view((len(idx), self.stack * self.states.shape[1]) + self.states.shape[2:])
+
+    def pendingNextState(self):
+        return self.stackFrames(torch.tensor([self.position], dtype=torch.long))[0]
+
+    def gather(self, idx):
+        non_final_mask = self.finals[idx] == 0
+        non_final_idx = idx[non_final_mask.nonzero().view(-1)]
+        next_states = self.gatherNextStates(non_final_idx, self.stackFrames((non_final_idx + 1) % self.capacity))
+        return self.stackFrames(idx), self.actions[idx], self.rewards[idx], non_final_mask, next_states
+
+    def sampleIndex(self, batch_size):
+        if self.size < self.capacity:
+            idx = torch.randint(0, self.size, (batch_size,), dtype=torch.long)
+        else:
+            # the stacks of the oldest stack - 1 slots may reach the slot at self.position, which is overwritten
+            idx = torch.randint(self.stack, self.capacity, (batch_size,), dtype=torch.long)
+            idx = (idx + self.position) % self.capacity
+        return idx, None
+
+
+class PrioritizedReplayMemory(ArrayReplayMemory):
+    def __init__(self, capacity, alpha=0.6, beta=0.4, beta_steps=100000, eps=1e-6):
+        """
+        proportional prioritized replay on top of ArrayReplayMemory
+        :param capacity: number of transitions to store
+        :param alpha: priority exponent, 0 is uniform sampling
+        :param beta: initial importance sampling exponent, annealed to 1 over beta_steps samples
+        :param beta_steps: number of sample calls to anneal beta over
+        :param eps: added to the absolute td error so no transition gets zero priority
+        """
+        ArrayReplayMemory.__init__(self, capacity)
+        self.alpha = alpha
+        self.beta = LinearSchedule(beta_steps, 1.0, beta)
+        self.eps = eps
+        self.tree = SumTree(capacity)
+        self.max_priority = 1.0
+        self.samples_done = 0
+
+    def push(self, *args):
+        position = self.position
+        ArrayReplayMemory.push(self, *args)
+        self.tree.update([position], [self.max_priority ** self.alpha])
+        if self.size == self.capacity:
+            # the slot at self.position may hold the pending next state instead of its own transition
+            self.tree.update([self.position], [0.])
+
+    def sampleIndex(self, batch_size):
+        """
+        sample slots proportional to their priorities, one per equal segment of the total priority
+        :param batch_size: size of the mini batch
+        :return: long tensor of slots, float tensor of importance sampling weights normalized to max 1
+        """
+        total = self.tree.total()
+        prefix_sums = (np.arange(batch_size) + np.random.random(batch_size)) * total / batch_size
+        idx = self.tree.find(prefix_sums)
+        probs = self.tree.get(idx) / total
+        # rounding can land a prefix sum on a zero leaf: the pending slot or an unwritten one
+        idx = np.where(probs > 0, idx, idx[np.argmax(probs)])
+        probs = self.tree.get(idx) / total
+        weights = (self.size * probs) ** (-self.beta.value(self.samples_done))
+        weights /= weights.max()
+        self.samples_done += 1
+        return torch.from_numpy(idx), torch.from_numpy(weights).float()
+
+    def sample(self, batch_size):
+        idx, _ = self.sampleIndex(batch_size)
+        return self.gather(idx)
+
+    def updatePriorities(self, idx, td_errors):
+        """
+        set the priorities of sampled slots from their td errors
+        :param idx: long tensor of slots
+        :param td_errors: tensor of td errors
+        :return: None
+        """
+        priorities = np.abs(td_errors.detach().to('cpu').numpy()) + self.eps
+        self.max_priority = max(self.max_priority, priorities.max())
+        self.tree.update(idx.numpy(), priorities ** self.alpha)
+
+
 class DQNAgent:
     def __init__(self, model_class, model=None, env=None, exploration=None,
-                 gamma=0.99, memory_size=100000, batch_size=64, target_update_frequency=1000, saving_dir=None):
+                 gamma=0.99, memory_size=100000, batch_size=64, target_update_frequency=1000, saving_dir=None,
+                 memory_type='list', prefetch=0, target_cache=False, macro_batch=1):
         """
         base class for dqn agent
         :param model_class: sub class of torch.nn.Module. class reference of the model
@@ -58,7 +311,21 @@ class DQNAgent:
         :param batch_size: size of the mini batch for one step update
         :param target_update_frequency: the frequency for updating target net (in steps)
         :param saving_dir: the directory for saving checkpoint
+        :param memory_type: 'list' for a list of transitions, 'array' for preallocated tensor storage,
+                            'prioritized' for prioritized replay over the tensor storage
+        :param prefetch: number of mini batches assembled ahead in a background thread, 0 assembles them in
+                         optimizeModel
+        :param target_cache: cache the max target q value of every memory slot until the next target update, see
+                             TargetCache. needs the 'array' or 'prioritized' memory
+        :param macro_batch: run the updates in groups of macro_batch every macro_batch env steps, which keeps one
+                            update per step. the mini batches of a group are sampled together and the target net
+                            evaluates all of them in one forward, see optimizeMacroBatch
         """
+        assert not target_cache or memory_type in ('array', 'prioritized'), \
+            'target_cache needs the array or prioritized memory'
+        # a prefetched batch may be sampled before its slots are overwritten, its values would be cached for the new
+        # transitions
+        assert not (target_cache and prefetch > 0), 'target_cache does not work with prefetch'
         self.model_class = model_class
         self.env = env
         self.exploration = exploration
@@ -73,7 +340,44 @@ class DQNAgent:
             self.target_net = self.target_net.to(self.device)
             self.target_net.eval()
             self.optimizer = optim.Adam(self.policy_net.parameters(), lr=0.0001)
-        self.memory = ReplayMemory(memory_size)
+        if memory_type == 'array':
+            self.memory = ArrayReplayMemory(memory_size)
+        elif memory_type == 'prioritized':
+            self.memory = PrioritizedReplayMemory(memory_size)
+        else:
+            self.memory = ReplayMemory(memory_size)
+        # built at the first push, see logRecord
+        self.replay_log = None
+        self.log_replay = True
+        self.memory_lock = threading.Lock()
+        self.target_cache = TargetCache(memory_size) if target_cache else None
+        self.prefetch = prefetch
+        self.prefetcher = None
+        self.batch_wait_time = 0.
+        self.macro_batch = macro_batch
+        self.pending_updates = 0
+        # checkpoint options, see CheckpointWriter. async_checkpoint snapshots the state and leaves serialization and
+        # writing to a background thread
+        self.async_checkpoint = False
+        self.keep_last = None
+        self.keep_every = None
+        self.checkpoint_writer = None
+        self.checkpoint_block_times = []
+        # 'pth' for checkpoint and memory .pth.tar files, 'fast' for the memory mappable layout of saveFastCheckpoint,
+        # which needs a memory with array storage (not 'list')
+        self.checkpoint_format = 'pth'
+        # concurrent mode, see LearnerThread. a learner thread updates the nets while trainOneEpisode acts on a copy
+        # of the policy net refreshed every actor_sync_freq updates. actor_threads and learner_threads are passed to
+        # torch.set_num_threads, the first in the acting thread when the learner starts, the second in the learner
+        # thread right after. the OpenMP kernels of torch read the count of their calling thread, so they run with
+        # the count of their role. MKL keeps one count per process, the learner_threads set last. None keeps the
+        # default of the role
+        self.concurrent = False
+        self.actor_sync_freq = 100
+        self.actor_threads = None
+        self.learner_threads = None
+        self.learner = None
+        self.learn_lock = threading.Lock()
         self.batch_size = batch_size
         self.gamma = gamma
         self.target_update = target_update_frequency
@@ -84,6 +388,8 @@ class DQNAgent:
         self.saving_dir = saving_dir
 
         self.state = None
+        # recurrent agents run the policy net on every step to carry their hidden state, even for random actions
+        self.recurrent = False
 
     def forwardPolicyNet(self, state):
         """
@@ -92,9 +398,18 @@ class DQNAgent:
         :return: tensor of action size, q values
         """
         with torch.no_grad():
-            q_values = self.policy_net(state)
+            q_values = self.actorForward(state)
             return q_values
 
+    def actorForward(self, *args):
+        """
+        forward the net used for acting, the acting copy of self.learner in concurrent mode, else the policy net
+        :return: output of the net
+        """
+        if self.learner is not None:
+            return self.learner.forward(*args)
+        return self.policy_net(*args)
+
     def selectAction(self, state, require_q=False):
         """
         select action base on e-greedy policy
@@ -104,20 +419,46 @@ class DQNAgent:
         """
         e = self.exploration.value(self.steps_done)
         self.steps_done += 1
-        q_values = self.forwardPolicyNet(state)
-        if random.random() > e:
-            action = q_values.max(1)[1].view(1, 1)
+        explore = random.random() <= e
+        if explore and not self.recurrent:
+            # a random action needs no q values, q is nan
+            action = self.randomAction()
+            q_value = float('nan')
         else:
-            if hasattr(self.env, 'nA'):
-                action_space = self.env.nA
-            else:
-                action_space = self.env.action_space.n
-            action = torch.tensor([[random.randrange(action_space)]], device=self.device, dtype=torch.long)
-        q_value = q_values.gather(1, action).item()
+            q_values = self.forwardPolicyNet(state)
+            action = self.randomAction() if explore else q_values.max(1)[1].view(1, 1)
+            q_value = q_values.gather(1, action).item()
         if require_q:
             return action, q_value
         return action
 
+    def randomAction(self):
+        """
+        :return: (1x1 tensor) uniform random action
+        """
+        if hasattr(self.env, 'nA'):
+            action_space = self.env.nA
+        else:
+            action_space = self.env.action_space.n
+        return torch.tensor([[random.randrange(action_space)]], device=self.device, dtype=torch.long)
+
+    def timeForward(self, state, n=10):
+        """
+        :param state: input of forwardPolicyNet
+        :param n: number of timed calls
+        :return: mean time of one forwardPolicyNet call in seconds. a recurrent state is left as it was
+        """
+        hidden = getattr(self, 'hidden', None)
+        start = time.time()
+        for _ in range(n):
+            self.forwardPolicyNet(state)
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize()
+        elapsed = (time.time() - start) / n
+        if hasattr(self, 'hidden'):
+            self.hidden = hidden
+        return elapsed
+
     @staticmethod
     def getNonFinalNextStateBatch(mini_batch):
         """
@@ -139,14 +480,17 @@ class DQNAgent:
         state_batch = torch.cat(mini_batch.state)
         return state_batch
 
-    def optimizeModel(self):
+    def sampleBatch(self):
         """
-        one step update for the model
-        :return: None
+        sample a mini batch from the memory and move it to self.device
+        :return: state, action, reward, non_final_mask, non_final_next_state tensors
         """
-        if len(self.memory) < self.batch_size:
-            return
-        transitions = self.memory.sample(self.batch_size)
+        if isinstance(self.memory, ArrayReplayMemory):
+            with self.memory_lock:
+                batch = self.memory.sample(self.batch_size)
+            return tuple(map(lambda x: x.to(self.device), batch))
+        with self.memory_lock:
+            transitions = self.memory.sample(self.batch_size)
         mini_batch = Transition(*zip(*transitions))
         non_final_mask = torch.tensor(tuple(map(lambda s: s is not None,
                                                 mini_batch.next_state)), device=self.device, dtype=torch.uint8).to(self.device)
@@ -154,20 +498,180 @@ class DQNAgent:
         state_batch = self.getStateBatch(mini_batch).to(self.device)
         action_batch = torch.cat(mini_batch.action).to(self.device)
         reward_batch = torch.cat(mini_batch.reward).to(self.device)
+        return state_batch, action_batch, reward_batch, non_final_mask, non_final_next_states
 
-        state_action_values = self.policy_net(state_batch).gather(1, action_batch)
+    def assembleBatch(self):
+        """
+        sample and collate one mini batch
+        :return: batch tensors on self.device, sampled index and importance sampling weights (None for uniform
+                 memories)
+        """
+        if isinstance(self.memory, ArrayReplayMemory):
+            with self.memory_lock:
+                idx, weights = self.memory.sampleIndex(self.batch_size)
+                batch = self.memory.gather(idx)
+            return tuple(map(lambda x: x.to(self.device), batch)), idx, weights
+        return self.sampleBatch(), None, None
+
+    def nextBatch(self):
+        """
+        get the next mini batch, from the prefetcher if self.prefetch > 0. the time the learner spends here is
+        added to self.batch_wait_time
+        :return: output of assembleBatch
+        """
+        start = time.time()
+        if self.prefetch > 0:
+            if self.prefetcher is None:
+                self.prefetcher = BatchPrefetcher(self.assembleBatch, self.prefetch)
+            batch = self.prefetcher.get()
+        else:
+            batch = self.assembleBatch()
+        self.batch_wait_time += time.time() - start
+        return batch
 
-        next_state_values = torch.zeros(self.batch_size, device=self.device)
-        next_state_values[non_final_mask] = self.target_net(non_final_next_states).max(1)[0].detach()
+    def stopPrefetcher(self):
+        """
+        stop the prefetch thread, it is restarted by the next nextBatch call
+        :return: None
+        """
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+            self.prefetcher = None
+
+    def getLearner(self):
+        """
+        start the learner thread of the concurrent mode if it is not running. self.actor_threads is set in the
+        calling (acting) thread before the learner thread starts and sets self.learner_threads
+        :return: self.learner
+        """
+        if self.learner is None:
+            # the acting loop overwrites slots while the learner thread caches their values
+            assert self.target_cache is None, 'target_cache does not work in concurrent mode'
+            if self.actor_threads is not None:
+                torch.set_num_threads(self.actor_threads)
+            self.learner = LearnerThread(self, self.actor_sync_freq, self.learner_threads)
+        return self.learner
+
+    def stopLearner(self):
+        """
+        stop the learner thread, it is restarted by the next trainOneEpisode call in concurrent mode
+        :return: None
+        """
+        if self.learner is not None:
+            learner = self.learner
+            self.learner = None
+            learner.stop()
+
+    def optimizeModel(self):
+        """
+        one step update for the model
+        :return: None
+        """
+        if len(self.memory) < self.batch_size:
+            return
+        batch, idx, weights = self.nextBatch()
+        _, _, _, non_final_mask, non_final_next_states = batch
+        next_state_values = self.nextStateValues(idx, non_final_mask, non_final_next_states)
+        self.updateModel(batch, idx, weights, next_state_values)
+
+    def optimizeMacroBatch(self):
+        """
+        self.macro_batch updates on mini batches sampled up front. the target net runs once on the next states of all
+        of them, it does not change between the updates of a group anyway
+        :return: None
+        """
+        if len(self.memory) < self.batch_size:
+            return
+        batches = [self.nextBatch() for _ in range(self.macro_batch)]
+        batch, idx, _ = zip(*batches)
+        non_final_mask = torch.cat([b[3] for b in batch])
+        non_final_next_states = torch.cat([b[4] for b in batch])
+        idx = torch.cat(idx) if idx[0] is not None else None
+        next_state_values = self.nextStateValues(idx, non_final_mask, non_final_next_states)
+        for (batch, idx, weights), values in zip(batches, next_state_values.split(self.batch_size)):
+            self.updateModel(batch, idx, weights, values)
+
+    def learnStep(self):
+        """
+        the updates due after one env step: optimizeModel, or with self.macro_batch > 1 a group of updates every
+        self.macro_batch steps
+        :return: None
+        """
+        if self.macro_batch <= 1:
+            return self.optimizeModel()
+        self.pending_updates += 1
+        if self.pending_updates >= self.macro_batch:
+            self.pending_updates = 0
+            self.optimizeMacroBatch()
+
+    def nextStateValues(self, idx, non_final_mask, non_final_next_states):
+        """
+        max target q values of the sampled transitions
+        :param idx: long tensor of sampled slots, None for the list memory
+        :param non_final_mask: uint8 tensor, 1 for the transitions with a next state
+        :param non_final_next_states: next states of the non final transitions
+        :return: float tensor on self.device, 0 for the final transitions
+        """
+        if self.target_cache is not None:
+            return self.cachedNextStateValues(idx, non_final_mask, non_final_next_states)
+        next_state_values = torch.zeros(len(non_final_mask), device=self.device)
+        with torch.no_grad():
+            next_state_values[non_final_mask] = self.target_net(non_final_next_states).max(1)[0]
+        return next_state_values
+
+    def updateModel(self, batch, idx, weights, next_state_values):
+        """
+        one gradient step on a mini batch
+        :param batch: state, action, reward, non_final_mask, non_final_next_state tensors
+        :param idx: sampled slots, used to update the priorities
+        :param weights: importance sampling weights, None for uniform memories
+        :param next_state_values: max target q values of the batch, see nextStateValues
+        :return: None
+        """
+        state_batch, action_batch, reward_batch, _, _ = batch
+
+        state_action_values = self.policy_net(state_batch).gather(1, action_batch)
 
         expected_state_action_values = (next_state_values * self.gamma) + reward_batch
 
-        loss = F.mse_loss(state_action_values, expected_state_action_values.unsqueeze(1))
+        if isinstance(self.memory, PrioritizedReplayMemory):
+            td_errors = expected_state_action_values - state_action_values.squeeze(1)
+            loss = (weights.to(self.device) * td_errors.pow(2)).mean()
+            with self.memory_lock:
+                self.memory.updatePriorities(idx, td_errors)
+        else:
+            loss = F.mse_loss(state_action_values, expected_state_action_values.unsqueeze(1))
 
         self.optimizer.zero_grad()
         loss.backward()
         self.optimizer.step()
 
+    def cachedNextStateValues(self, idx, non_final_mask, non_final_next_states):
+        """
+        max target q values of the sampled transitions from self.target_cache, the target net only runs on the next
+        states not cached since the last target update
+        :param idx: long tensor of sampled slots
+        :param non_final_mask: uint8 tensor, 1 for the transitions with a next state
+        :param non_final_next_states: next states of the non final transitions
+        :return: float tensor on self.device, 0 for the final transitions
+        """
+        # row of every non final transition in non_final_next_states
+        next_rows = non_final_mask.long().cumsum(0) - 1
+
+        def compute(rows):
+            with torch.no_grad():
+                return self.target_net(non_final_next_states[next_rows[rows.to(self.device)]]).max(1)[0]
+        return self.target_cache.get(idx, non_final_mask, compute).to(self.device)
+
+    def updateTargetNet(self):
+        """
+        copy the policy net into the target net, the cached target values go stale with it
+        :return: None
+        """
+        self.target_net.load_state_dict(self.policy_net.state_dict())
+        if self.target_cache is not None:
+            self.target_cache.invalidate()
+
     def resetEnv(self):
         """
         reset the env and set self.state
@@ -193,6 +697,45 @@ class DQNAgent:
         """
         return torch.tensor(obs, device=self.device, dtype=torch.float).unsqueeze(0)
 
+    def pushMemory(self, state, action, next_state, reward):
+        """
+        push one transition into the memory and the replay log
+        :return: None
+        """
+        with self.memory_lock:
+            if self.target_cache is not None:
+                self.target_cache.evict(self.memory.position)
+            self.memory.push(state, action, next_state, reward)
+        self.logRecord((state, action, next_state, reward))
+
+    def cutEpisode(self):
+        """
+        end the running episode of the memory after its last transition was pushed with its next state, because a step
+        limit ended it. the memories storing whole episodes store it then, the others see it at the next push
+        :return: None
+        """
+        if not hasattr(self.memory, 'cutEpisode'):
+            return
+        with self.memory_lock:
+            self.memory.cutEpisode()
+        self.logRecord(None, 0)
+
+    def logRecord(self, record, n=1):
+        """
+        append a pushed record to self.replay_log. the log is created at the first push if self.saving_dir is set
+        and self.log_replay is on. a log that missed pushes could not rebuild the memory, so a run that pushed
+        without a log keeps none and its checkpoints save the memory itself
+        :param record: arguments of one push, see pushRecord
+        :param n: number of transitions in the record
+        :return: None
+        """
+        if self.replay_log is None:
+            if self.saving_dir is None or not self.log_replay:
+                self.log_replay = False
+                return
+            self.replay_log = ReplayLog(self.memory.capacity)
+        self.replay_log.append(record, n, self.saving_dir, self.getCheckpointWriter())
+
     def trainOneEpisode(self, num_episodes, max_episode_steps=100, save_freq=100, render=False):
         """
         train the network for on episode
@@ -202,6 +745,8 @@ class DQNAgent:
         :return:
         """
         # tqdm.write('------Episode {} / {}------'.format(self.episodes_done, num_episodes))
+        if self.concurrent:
+            self.getLearner()
         self.resetEnv()
         r_total = 0
         with trange(1, max_episode_steps+1, leave=False) as t:
@@ -223,10 +768,14 @@ class DQNAgent:
                 else:
                     next_state = self.getNextState(obs_)
                 reward = torch.tensor([r], device=self.device, dtype=torch.float)
-                self.memory.push(state, action, next_state, reward)
-                self.optimizeModel()
-                if self.steps_done % self.target_update == 0:
-                    self.target_net.load_state_dict(self.policy_net.state_dict())
+                self.pushMemory(state, action, next_state, reward)
+                if self.learner is not None:
+                    # the learner thread runs the updates
+                    self.learner.check()
+                else:
+                    self.learnStep()
+                    if self.steps_done % self.target_update == 0:
+                        self.updateTargetNet()
 
                 if done or step == max_episode_steps - 1:
                     tqdm.write('------Episode {} ended, total reward: {}, step: {}------' \
@@ -241,10 +790,86 @@ class DQNAgent:
                     self.episode_rewards.append(r_total)
                     self.episode_lengths.append(step)
                     if self.episodes_done % save_freq == 0:
-                        self.saveCheckpoint()
+                        with self.learn_lock:
+                            self.saveCheckpoint()
                     break
                 self.state = next_state
 
+    def collectRandom(self, n_steps, max_episode_steps, push):
+        """
+        run whole episodes with uniform random actions through resetEnv, takeAction and getNextState, without any
+        forward pass, until at least n_steps transitions are collected
+        :param n_steps: number of transitions to collect
+        :param max_episode_steps: maximum length of one episode
+        :param push: function(episode) called with the list of (state, action, next_state, reward) of every episode.
+                     the last transition of an episode ended by max_episode_steps keeps its next state
+        :return: number of transitions collected
+        """
+        n = 0
+        while n < n_steps:
+            self.resetEnv()
+            episode = []
+            for step in range(1, max_episode_steps + 1):
+                action = self.randomAction()
+                obs_, r, done, info = self.takeAction(action.item())
+                if done:
+                    next_state = None
+                else:
+                    next_state = self.getNextState(obs_)
+                episode.append((self.state, action, next_state, torch.tensor([r], device=self.device,
+                                                                             dtype=torch.float)))
+                if next_state is None:
+                    break
+                self.state = next_state
+            push(episode)
+            n += len(episode)
+        return n
+
+    def warmUp(self, n_steps=None, max_episode_steps=100, workers=0):
+        """
+        fill the memory with whole episodes of uniform random actions before training, without any forward pass of
+        the policy net. with workers > 0 the episodes are run by forked copies of the agent, so the env has to
+        survive a fork. an episode ended by max_episode_steps is cut, not final. the steps count into steps_done, the
+        episodes are not recorded
+        :param n_steps: number of transitions to collect, by default what the memory lacks for the learner to start
+                        (min_mem, or batch_size for agents without it)
+        :param max_episode_steps: maximum length of one episode
+        :param workers: number of worker processes, 0 collects in this process
+        :return: dict with the number of transitions, the time taken and the estimated time saved in seconds
+        """
+        if n_steps is None:
+            n_steps = max(getattr(self, 'min_mem', self.batch_size) - len(self.memory), 0)
+        first_states = []
+
+        def push(episode):
+            first_states.append(episode[0][0])
+            for transition in episode:
+                self.pushMemory(*transition)
+            if episode[-1][2] is not None:
+                self.cutEpisode()
+
+        start = time.time()
+        if workers > 0:
+            n, env_time = collectParallel(self, n_steps, max_episode_steps, workers, push)
+        else:
+            n = self.collectRandom(n_steps, max_episode_steps, push)
+            env_time = time.time() - start
+        elapsed = time.time() - start
+        self.steps_done += n
+        forward_time = 0.
+        if len(first_states) > 0:
+            state = first_states[-1]
+            state = tuple(map(lambda x: x.to(self.device), state)) if type(state) is tuple else state.to(self.device)
+            forward_time = self.timeForward(state)
+        stats = {
+            'transitions': n,
+            'time': elapsed,
+            'saved': n * forward_time + max(env_time - elapsed, 0.)
+        }
+        tqdm.write('------Warm up: {transitions} transitions in {time:.1f}s, about {saved:.1f}s saved------'
+                   .format(**stats))
+        return stats
+
     def train(self, num_episodes, max_episode_steps=100, save_freq=100, render=False):
         """
         train the network for given number of episodes
@@ -255,7 +880,10 @@ class DQNAgent:
         """
         while self.episodes_done < num_episodes:
             self.trainOneEpisode(num_episodes, max_episode_steps, save_freq, render)
+        self.stopLearner()
+        self.stopPrefetcher()
         self.saveCheckpoint()
+        self.stopCheckpointWriter()
 
     def getSavingState(self):
         state = {
@@ -271,18 +899,52 @@ class DQNAgent:
 
     def saveCheckpoint(self):
         """
-        save checkpoint in self.saving_dir
+        save checkpoint in self.saving_dir through self.checkpoint_writer. the time training was blocked is appended
+        to self.checkpoint_block_times
         :return: None
         """
+        start = time.time()
         time_stamp = time.strftime('%Y%m%d%H%M%S', time.gmtime())
-        state_filename = os.path.join(self.saving_dir, 'checkpoint.' + time_stamp + '.pth.tar')
-        mem_filename = os.path.join(self.saving_dir, 'memory.' + time_stamp + '.pth.tar')
-        state = self.getSavingState()
-        memory = {
-            'memory': self.memory
-        }
-        torch.save(state, state_filename)
-        torch.save(memory, mem_filename)
+        if self.checkpoint_format == 'fast':
+            self.saveFastCheckpoint(time_stamp)
+        else:
+            state = self.getSavingState()
+            if self.async_checkpoint:
+                state = snapshot(state)
+            refs = []
+            if self.replay_log is not None:
+                manifest = self.replay_log.write(self.saving_dir, len(self.memory), self.getCheckpointWriter())
+                memory = {
+                    'replay_log': manifest
+                }
+                refs = ReplayLog.segmentPaths(self.saving_dir, manifest)
+            else:
+                with self.memory_lock:
+                    memory = {
+                        'memory': copy.deepcopy(self.memory) if self.async_checkpoint else self.memory
+                    }
+            self.getCheckpointWriter().save(time_stamp, [('checkpoint', state), ('memory', memory)], refs)
+        blocked = time.time() - start
+        self.checkpoint_block_times.append(blocked)
+        tqdm.write('------Checkpoint {}: training blocked for {:.3f}s------'.format(time_stamp, blocked))
+
+    def getCheckpointWriter(self):
+        """
+        :return: the CheckpointWriter of this run, created with the current checkpoint options on first use
+        """
+        if self.checkpoint_writer is None:
+            self.checkpoint_writer = CheckpointWriter(self.saving_dir, self.keep_last, self.keep_every,
+                                                      self.async_checkpoint)
+        return self.checkpoint_writer
+
+    def stopCheckpointWriter(self):
+        """
+        wait for the queued checkpoints and stop the writer thread, it is restarted by the next saveCheckpoint call
+        :return: None
+        """
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.stop()
+            self.checkpoint_writer = None
 
     def loadCheckpoint(self, time_stamp, data_only=False, load_memory=True):
         """
@@ -293,6 +955,11 @@ class DQNAgent:
         state_filename = os.path.join(self.saving_dir, 'checkpoint.' + time_stamp + '.pth.tar')
         mem_filename = os.path.join(self.saving_dir, 'memory.' + time_stamp + '.pth.tar')
 
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.wait()
+        if os.path.exists(fastPath(self.saving_dir, time_stamp)):
+            self.loadFastCheckpoint(time_stamp, data_only, load_memory)
+            return
         print 'loading checkpoint: ', time_stamp
         checkpoint = torch.load(state_filename)
         if data_only:
@@ -312,10 +979,101 @@ class DQNAgent:
         self.target_net.load_state_dict(checkpoint['policy_state_dict'])
         self.target_net = self.target_net.to(self.device)
         self.target_net.eval()
+        if self.target_cache is not None:
+            self.target_cache.invalidate()
 
         self.optimizer = optim.Adam(self.policy_net.parameters())
         self.optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
 
         if load_memory:
             memory = torch.load(mem_filename)
-            self.memory = memory['memory']
+            if 'replay_log' in memory:
+                self.replay_log = ReplayLog(self.memory.capacity)
+                self.replay_log.rebuild(self.saving_dir, memory['replay_log'], self.pushRecord)
+            else:
+                self.memory = memory['memory']
+                # the loaded memory is in no log
+                self.replay_log = None
+                self.log_replay = False
+
+    def saveFastCheckpoint(self, time_stamp):
+        """
+        save the checkpoint as the directory fast.time_stamp in self.saving_dir through self.checkpoint_writer, see
+        fast_checkpoint.saveFastCheckpoint. the state of getSavingState is split into the state dicts and the metrics,
+        the memory arrays are written raw. every checkpoint writes the whole memory, so resuming maps it instead of
+        replaying the log; with async_checkpoint the writer thread writes a copy. the memory needs array storage
+        :param time_stamp: time stamp for the checkpoint
+        :return: None
+        """
+        assert hasArrayStorage(self.memory), 'the fast checkpoint format needs a memory with array storage'
+        state = self.getSavingState()
+        if self.async_checkpoint:
+            state = snapshot(state)
+        model_state = dict((k, v) for k, v in state.items() if k.endswith('state_dict'))
+        metrics = dict((k, v) for k, v in state.items() if not k.endswith('state_dict'))
+        metrics['episode_rewards'] = map(float, metrics['episode_rewards'])
+        metrics['episode_lengths'] = map(int, metrics['episode_lengths'])
+        with self.memory_lock:
+            replay = {
+                'memory': copy.deepcopy(self.memory) if self.async_checkpoint else self.memory,
+                'replay_log': copy.deepcopy(self.replay_log) if self.async_checkpoint else self.replay_log
+            }
+        self.getCheckpointWriter().saveFast(time_stamp, model_state, metrics, replay)
+
+    def loadFastCheckpoint(self, time_stamp, data_only=False, load_memory=True):
+        """
+        load a checkpoint saved by saveFastCheckpoint. the memory arrays are memory mapped copy on write, so resuming
+        does not read the memory and never changes the checkpoint
+        :param time_stamp: time stamp for the checkpoint
+        :return: None
+        """
+        directory = fastPath(self.saving_dir, time_stamp)
+        print 'loading fast checkpoint: ', time_stamp
+        metrics = loadMetrics(directory)
+        self.episode_rewards = metrics['episode_rewards']
+        self.episode_lengths = metrics['episode_lengths']
+        if data_only:
+            return
+        self.episodes_done = metrics['episode']
+        self.steps_done = metrics['steps']
+
+        checkpoint = loadModelState(directory, map_location=self.device)
+        self.policy_net.load_state_dict(checkpoint['policy_state_dict'])
+        self.policy_net = self.policy_net.to(self.device)
+        self.policy_net.train()
+
+        self.target_net.load_state_dict(checkpoint['target_state_dict'])
+        self.target_net = self.target_net.to(self.device)
+        self.target_net.eval()
+        if self.target_cache is not None:
+            self.target_cache.invalidate()
+
+        self.optimizer = optim.Adam(self.policy_net.parameters())
+        self.optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+
+        if load_memory:
+            replay = loadReplay(directory)
+            self.memory = replay['memory']
+            self.replay_log = replay['replay_log']
+            self.log_replay = self.replay_log is not None
+
+    def convertCheckpoint(self, time_stamp):
+        """
+        convert the checkpoint.time_stamp.pth.tar and memory.time_stamp.pth.tar checkpoint to the fast layout under the
+        same time stamp. the agent is left resumed from it
+        :param time_stamp: time stamp for the checkpoint
+        :return: None
+        """
+        self.loadCheckpoint(time_stamp)
+        self.saveFastCheckpoint(time_stamp)
+
+    def pushRecord(self, record):
+        """
+        push one record of self.replay_log into the memory
+        :param record: arguments of memory.push, None for the end of a cut episode
+        :return: None
+        """
+        if record is None:
+            self.memory.cutEpisode()
+            return
+        self.memory.push(*record)
@@ -10,6 +10,7 @@ import torch.nn.functional as F
 
 from util.utils import *
 from dqn_agent import DQNAgent
+from sequence_memory import forwardShifted
 
 
 Transition = namedtuple('Transition', ('state', 'action', 'next_state', 'reward'))
@@ -20,6 +21,10 @@ class EpisodicReplayMemory(object):
         self.memory = deque()
         self.local_memory = []
         self.capacity = capacity
+        self.episode_lengths = deque()
+        self.size = 0
+        # episodes sorted by length for sampleBucketed, rebuilt after the memory changed
+        self.by_length = None
 
     def push(self, *args):
         state, action, next_state, reward = args
@@ -32,21 +37,98 @@ class EpisodicReplayMemory(object):
         self.local_memory.append(Transition(state, action, next_state, reward))
 
         if next_state is None:
-            self.memory.append(self.local_memory)
-            while self.__len__() > self.capacity:
-                self.memory.popleft()
-            self.local_memory = []
+            self.storeEpisode()
+
+    def cutEpisode(self):
+        """
+        store the running episode when it was ended by a step limit, its last transition keeps its next state
+        :return: None
+        """
+        if len(self.local_memory) > 0:
+            self.storeEpisode()
+
+    def storeEpisode(self):
+        self.memory.append(self.local_memory)
+        self.episode_lengths.append(len(self.local_memory))
+        self.size += len(self.local_memory)
+        self.evict()
+        self.local_memory = []
+        self.by_length = None
+
+    def evict(self):
+        """
+        drop the oldest episodes until the number of stored transitions fits in self.capacity
+        :return: None
+        """
+        n_evict = 0
+        evicted_size = 0
+        while self.size - evicted_size > self.capacity:
+            evicted_size += self.episode_lengths[n_evict]
+            n_evict += 1
+        for _ in range(n_evict):
+            self.memory.popleft()
+            self.episode_lengths.popleft()
+        self.size -= evicted_size
 
     def sample(self, batch_size):
         return random.sample(self.memory, batch_size)
 
+    def sampleBucketed(self, batch_size, n_buckets):
+        """
+        sample episodes of similar length. the episodes sorted by length are cut into n_buckets buckets of equal
+        count (at least batch_size), a bucket is picked with probability proportional to its count and the batch is
+        sampled from it, so every episode is still sampled about uniformly
+        :param batch_size: number of episodes
+        :param n_buckets: number of length buckets
+        :return: list of episodes
+        """
+        if self.by_length is None:
+            self.by_length = sorted(self.memory, key=len)
+        n = len(self.by_length)
+        bucket_size = max(n // n_buckets, batch_size)
+        n_full = max(n // bucket_size, 1)
+        bucket = min(random.randrange(n) // bucket_size, n_full - 1)
+        start = bucket * bucket_size
+        end = n if bucket == n_full - 1 else start + bucket_size
+        return random.sample(self.by_length[start:end], batch_size)
+
     def __len__(self):
-        return sum(map(len, self.memory))
+        return self.size
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['by_length'] = None
+        return state
+
+    def __setstate__(self, state):
+        state.setdefault('by_length', None)
+        self.__dict__.update(state)
+        if 'size' not in state:
+            # memory pickled before the size was tracked
+            self.episode_lengths = deque(map(len, self.memory))
+            self.size = sum(self.episode_lengths)
+
+
+def forwardPacked(net, x, hidden=None):
+    """
+    forward a recurrent net on a PackedSequence. nets with forwardPacked(x, hidden) run on the real steps only,
+    the others on the padded batch
+    :param net: recurrent net
+    :param x: PackedSequence of inputs
+    :param hidden: initial recurrent state
+    :return: PackedSequence of q values, recurrent state
+    """
+    if hasattr(net, 'forwardPacked'):
+        return net.forwardPacked(x, hidden)
+    padded, lengths = nn.utils.rnn.pad_packed_sequence(x, True)
+    q_values, hidden = net(padded, hidden)
+    return nn.utils.rnn.pack_padded_sequence(q_values, lengths, True), hidden
 
 
 class DRQNAgent(DQNAgent):
     def __init__(self, model_class, model=None, env=None, exploration=None,
-                 gamma=0.99, memory_size=100000, batch_size=1, target_update_frequency=1000, saving_dir=None, min_mem=10000):
+                 gamma=0.99, memory_size=100000, batch_size=1, target_update_frequency=1000, saving_dir=None, min_mem=10000,
+                 prefetch=0, single_pass=False, share_target_encoder=False, packed=False, length_buckets=0):
         """
         base class for lstm dqn agent
         :param model_class: sub class of torch.nn.Module. class reference of the model
@@ -58,48 +140,112 @@ class DRQNAgent(DQNAgent):
         :param batch_size: size of the mini batch for one step update
         :param target_update_frequency: the frequency for updating target net (in steps)
         :param saving_dir: the directory for saving checkpoint
+        :param prefetch: number of mini batches assembled ahead in a background thread
+        :param single_pass: batch the states and next states of an episode as one sequence of observations, the
+                            policy net reads it from the first step and the target net from the second
+        :param share_target_encoder: with single_pass, encode the observations once with the policy net and run the
+                                     target net on its features. the model needs encode(x) and head(features, hidden)
+        :param packed: train on packed sequences of the whole episodes, the states of an episode for the policy net
+                       and its next states as a second sequence for the target net, see unzipPacked. nothing is padded
+                       if the model has forwardPacked(packed_x, hidden), see forwardPacked
+        :param length_buckets: sample the episodes of a batch from one of this many length buckets, 0 samples them
+                               uniformly
         """
         DQNAgent.__init__(self, model_class, model, env, exploration, gamma, memory_size, batch_size,
-                          target_update_frequency, saving_dir)
+                          target_update_frequency, saving_dir, prefetch=prefetch)
         self.memory = EpisodicReplayMemory(memory_size)
         self.hidden = None
         self.min_mem = min_mem
+        self.single_pass = single_pass
+        self.share_target_encoder = share_target_encoder
+        self.packed = packed
+        self.length_buckets = length_buckets
+        self.recurrent = True
 
     def forwardPolicyNet(self, state):
         with torch.no_grad():
             state = state.unsqueeze(0)
-            q_values, self.hidden = self.policy_net(state, self.hidden)
+            q_values, self.hidden = self.actorForward(state, self.hidden)
             q_values = q_values.squeeze(0)
             return q_values
 
+    def unzipPacked(self, memory):
+        """
+        pack a batch of episodes. the target net gets its own sequences of the next states, so its recurrence starts
+        at the second state as in the padded update. every field is flat over the real steps in the time major order
+        of the packed states
+        :param memory: list of episodes
+        :return: packed states, packed next states, flat action, flat reward, flat final_mask
+        """
+        memory.sort(key=lambda x: len(x), reverse=True)
+        padding = torch.zeros_like(memory[0][0].state)
+        states = []
+        next_states = []
+        actions = []
+        rewards = []
+        finals = []
+        for episode in memory:
+            episode_transition = Transition(*zip(*episode))
+            states.append(torch.cat(episode_transition.state))
+            next_states.append(torch.cat([s if s is not None else padding for s in episode_transition.next_state]))
+            actions.append(torch.cat(episode_transition.action))
+            rewards.append(torch.cat(episode_transition.reward))
+            finals.append(self.finalMask(episode_transition))
+        states = nn.utils.rnn.pack_sequence(states)
+        next_states = nn.utils.rnn.pack_sequence(next_states)
+        actions = nn.utils.rnn.pack_sequence(actions)
+        rewards = nn.utils.rnn.pack_sequence(rewards)
+        final_mask = nn.utils.rnn.pack_sequence(finals)
+        return states.to(self.device), next_states.to(self.device), actions.data.to(self.device), \
+            rewards.data.to(self.device), final_mask.data.to(self.device)
+
+    @staticmethod
+    def finalMask(episode_transition):
+        """
+        :param episode_transition: Transition of the field tuples of one episode
+        :return: uint8 tensor, 1 for the steps without next state. the last step of an episode cut by a step limit
+                 keeps its next state and is not final
+        """
+        return torch.tensor([s is None for s in episode_transition.next_state], dtype=torch.uint8)
+
     def unzipMemory(self, memory):
+        if self.packed:
+            return self.unzipPacked(memory)
         state_batch = []
         action_batch = []
         next_state_batch = []
         reward_batch = []
+        final_batch = []
         padding = torch.zeros_like(memory[0][0].state)
 
         memory.sort(key=lambda x: len(x), reverse=True)
 
         for episode in memory:
             episode_transition = Transition(*zip(*episode))
-            state_batch.append(torch.cat(episode_transition.state))
+            if self.single_pass:
+                # the next state of step t is the state of step t + 1, the final step is followed by padding and
+                # the last step of a cut episode by its next state
+                last = episode_transition.next_state[-1]
+                state_batch.append(torch.cat(episode_transition.state + (last if last is not None else padding,)))
+            else:
+                state_batch.append(torch.cat(episode_transition.state))
+                non_final_next_states = torch.cat([s if s is not None else padding
+                                                   for s in episode_transition.next_state])
+                next_state_batch.append(non_final_next_states)
             action_batch.append(torch.cat(episode_transition.action))
-            non_final_next_states = torch.cat([s if s is not None else padding
-                                               for s in episode_transition.next_state])
-            next_state_batch.append(non_final_next_states)
             reward_batch.append(torch.cat(episode_transition.reward))
+            final_batch.append(self.finalMask(episode_transition))
 
-        episode_size = map(lambda x: x.shape[0], state_batch)
+        episode_size = map(lambda x: x.shape[0], action_batch)
 
         padded_state = nn.utils.rnn.pad_sequence(state_batch, True).to(self.device)
-        padded_next_state = nn.utils.rnn.pad_sequence(next_state_batch, True).to(self.device)
+        padded_next_state = None
+        if not self.single_pass:
+            padded_next_state = nn.utils.rnn.pad_sequence(next_state_batch, True).to(self.device)
         padded_action = nn.utils.rnn.pad_sequence(action_batch, True).to(self.device)
         padded_reward = nn.utils.rnn.pad_sequence(reward_batch, True).to(self.device)
 
-        final_mask = torch.zeros_like(padded_reward, dtype=torch.uint8)
-        for i in range(len(episode_size)):
-            final_mask[i, episode_size[i] - 1] = 1
+        final_mask = nn.utils.rnn.pad_sequence(final_batch, True).to(self.device)
 
         non_pad_mask = torch.ones_like(padded_reward, dtype=torch.uint8)
         for i in range(len(episode_size)):
@@ -107,16 +253,55 @@ class DRQNAgent(DQNAgent):
 
         return padded_state, padded_action, padded_next_state, padded_reward, final_mask, non_pad_mask
 
+    def assembleBatch(self):
+        with self.memory_lock:
+            if self.length_buckets > 0:
+                mini_memory = self.memory.sampleBucketed(self.batch_size, self.length_buckets)
+            else:
+                mini_memory = self.memory.sample(self.batch_size)
+        return self.unzipMemory(mini_memory), None, None
+
+    def optimizeModelPacked(self, batch):
+        """
+        one step update on a batch of unzipPacked, the loss is over the real steps only
+        :return: None
+        """
+        state_batch, next_state_batch, action_batch, reward_batch, final_mask = batch
+
+        q_values, _ = forwardPacked(self.policy_net, state_batch)
+        state_action_values = q_values.data.gather(1, action_batch).squeeze(1)
+        with torch.no_grad():
+            target_q_values, _ = forwardPacked(self.target_net, next_state_batch)
+        target_state_action_values = target_q_values.data.max(1)[0]
+
+        target_state_action_values[final_mask] = 0
+        expected_state_action_values = reward_batch + self.gamma * target_state_action_values
+
+        loss = F.mse_loss(state_action_values, expected_state_action_values)
+
+        self.optimizer.zero_grad()
+        loss.backward()
+        for param in self.policy_net.parameters():
+            param.grad.data.clamp_(-1, 1)
+        self.optimizer.step()
+
     def optimizeModel(self):
         if len(self.memory) < self.min_mem:
             return
-        mini_memory = self.memory.sample(self.batch_size)
-
-        state_batch, action_batch, next_state_batch, reward_batch, final_mask, non_pad_mask = self.unzipMemory(mini_memory)
+        batch, _, _ = self.nextBatch()
+        if self.packed:
+            return self.optimizeModelPacked(batch)
+        state_batch, action_batch, next_state_batch, reward_batch, final_mask, non_pad_mask = batch
 
-        state_action_values, _ = self.policy_net(state_batch)
+        if self.single_pass:
+            # state_batch holds the observation sequences, one step longer than the episodes
+            state_action_values, target_state_action_values = \
+                forwardShifted(self.policy_net, self.target_net, state_batch,
+                               share_encoder=self.share_target_encoder)
+        else:
+            state_action_values, _ = self.policy_net(state_batch)
+            target_state_action_values, _ = self.target_net(next_state_batch)
         state_action_values = state_action_values.gather(2, action_batch).squeeze(2)
-        target_state_action_values, _ = self.target_net(next_state_batch)
         target_state_action_values = target_state_action_values.max(2)[0].detach()
 
         expected_state_action_values = reward_batch
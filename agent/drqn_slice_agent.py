@@ -11,108 +11,103 @@ import torch.nn.functional as F
 from util.utils import *
 from dqn_agent import DQNAgent
 from drqn_agent import DRQNAgent
-
-Transition = namedtuple('Transition', ('state', 'action', 'next_state', 'reward', 'final_mask', 'pad_mask'))
-
-
-class SliceReplayMemory:
-    def __init__(self, capacity, sequence_len):
-        self.memory = deque()
-        self.local_memory = []
-        self.capacity = capacity
-        self.sequence_len = sequence_len
-
-    def push(self, *args):
-        state, action, next_state, reward = args
-        if type(state) is tuple:
-            state = map(lambda x: x.to('cpu'), state)
-        else:
-            state = state.to('cpu')
-        action = action.to('cpu')
-        if next_state is not None:
-            if type(next_state) is tuple:
-                next_state = map(lambda x: x.to('cpu'), next_state)
-            else:
-                next_state = next_state.to('cpu')
-        reward = reward.to('cpu')
-        if next_state is not None:
-            self.local_memory.append(Transition(state, action, next_state, reward, 0, 0))
-
-        else:
-            self.local_memory.append(Transition(state, action, next_state, reward, 1, 0))
-            while len(self.local_memory) < self.sequence_len:
-                self.local_memory.append(Transition(
-                    None,
-                    torch.tensor([[0]], dtype=torch.long),
-                    None,
-                    torch.tensor([0.]),
-                    0,
-                    1
-                ))
-            self.memory.append(self.local_memory)
-            while self.__len__() > self.capacity:
-                self.memory.popleft()
-            self.local_memory = []
-
-    def sample(self, batch_size):
-        sample = []
-        batch_indexes = np.random.choice(np.arange(len(self.memory)), batch_size, replace=False)
-        for batch_idx in batch_indexes:
-            episode = self.memory[batch_idx]
-            start = random.randint(0, len(episode) - self.sequence_len)
-            transitions = episode[start:start + self.sequence_len]
-            sample.append(transitions)
-        return sample
-
-    def __len__(self):
-        return sum(map(len, self.memory))
+from sequence_memory import SequenceReplayMemory, PrioritizedSequenceReplayMemory, sampleSlices, sliceLoss
 
 
 class DRQNSliceAgent(DRQNAgent):
     def __init__(self, model_class, model=None, env=None, exploration=None,
                  gamma=0.99, memory_size=100000, batch_size=1, target_update_frequency=1000, saving_dir=None,
-                 min_mem=10000, sequence_len=32):
+                 min_mem=10000, sequence_len=32, memory_type='sequence', prefetch=0, stored_state=False, burn_in=0,
+                 single_pass=False, share_target_encoder=False):
+        """
+        lstm dqn agent trained on slices of sequence_len steps
+        :param memory_type: 'sequence' for uniform slices, 'prioritized' for prioritized slices
+        :param prefetch: number of mini batches assembled ahead in a background thread
+        :param stored_state: store the recurrent state of the actor with every transition, and start the training
+                             slices from it instead of from zeros
+        :param burn_in: number of leading steps of every slice only used to warm up the recurrent state, they get no
+                        loss. sequence_len includes them
+        :param single_pass: sample the slices as sequence_len + 1 observations, stored once per frame. the policy
+                            net reads them from the first step and the target net from the second
+        :param share_target_encoder: with single_pass, encode the observations once with the policy net and run the
+                                     target net on its features. the model needs encode(x) and head(features, hidden)
+        """
+        assert burn_in < sequence_len, 'burn_in has to be shorter than sequence_len'
         DRQNAgent.__init__(self, model_class, model, env, exploration, gamma, memory_size, batch_size,
-                           target_update_frequency, saving_dir, min_mem)
-        self.memory = SliceReplayMemory(memory_size, sequence_len)
-        self.state_padding = None
-        if env is not None:
-            self.state_padding = torch.zeros(self.env.observation_space.shape).unsqueeze(0)
+                           target_update_frequency, saving_dir, min_mem, prefetch, single_pass, share_target_encoder)
+        self.stored_state = stored_state
+        self.burn_in = burn_in
+        self.actor_hidden = None
+        if memory_type == 'prioritized':
+            self.memory = PrioritizedSequenceReplayMemory(memory_size, sequence_len,
+                                                          store_next_states=not single_pass)
+        else:
+            self.memory = SequenceReplayMemory(memory_size, sequence_len, store_next_states=not single_pass)
 
     def forwardPolicyNet(self, state):
         with torch.no_grad():
             state = state.unsqueeze(0)
-            q_values, self.hidden = self.policy_net(state, self.hidden)
+            self.actor_hidden = self.hidden
+            q_values, self.hidden = self.actorForward(state, self.hidden)
             q_values = q_values.squeeze(0)
             return q_values
 
     def unzipMemory(self, memory):
-        state_batch = []
-        action_batch = []
-        next_state_batch = []
-        reward_batch = []
-        final_mask_batch = []
-        pad_mask_batch = []
-
-        padding = self.state_padding
-
-        for episode in memory:
-            episode_transition = Transition(*zip(*episode))
-            state_batch.append(torch.cat([s if s is not None else padding
-                                          for s in episode_transition.state]))
-            action_batch.append(torch.cat(episode_transition.action))
-            next_state_batch.append(torch.cat([s if s is not None else padding
-                                               for s in episode_transition.next_state]))
-            reward_batch.append(torch.cat(episode_transition.reward))
-            final_mask_batch.append(torch.tensor(list(episode_transition.final_mask), dtype=torch.uint8))
-            pad_mask_batch.append(torch.tensor(list(episode_transition.pad_mask), dtype=torch.uint8))
-
-        state = torch.stack(state_batch).to(self.device)
-        action = torch.stack(action_batch).to(self.device)
-        next_state = torch.stack(next_state_batch).to(self.device)
-        reward = torch.stack(reward_batch).to(self.device)
-        final_mask = torch.stack(final_mask_batch).to(self.device)
-        pad_mask = torch.stack(pad_mask_batch)
-        non_pad_mask = 1 - pad_mask
-
-        return state, action, next_state, reward, final_mask, non_pad_mask
+        """
+        move a batch sampled from SequenceReplayMemory to self.device
+        :param memory: state, action, next_state, reward, final_mask, non_pad_mask[, policy_hidden, target_hidden]
+        :return: state, action, next_state, reward, final_mask, non_pad_mask[, policy_hidden, target_hidden]
+        """
+        batch = []
+        for x in memory:
+            if x is None:
+                batch.append(None)
+            elif type(x) is tuple:
+                batch.append(tuple(map(lambda y: y.to(self.device), x)))
+            else:
+                batch.append(x.to(self.device))
+        return tuple(batch)
+
+    def assembleBatch(self):
+        with self.memory_lock:
+            mini_memory, slots, weights = sampleSlices(self.memory, self.batch_size, self.single_pass,
+                                                       self.stored_state)
+        return self.unzipMemory(mini_memory), slots, weights
+
+    def pushMemory(self, state, action, next_state, reward):
+        """
+        push one transition, with the recurrent state of the actor before it saw state if self.stored_state
+        :return: None
+        """
+        if not self.stored_state:
+            return DRQNAgent.pushMemory(self, state, action, next_state, reward)
+        hidden = self.actor_hidden
+        if hidden is not None:
+            hidden = tuple(map(lambda h: h.to('cpu'), hidden)) if type(hidden) is tuple else hidden.to('cpu')
+        record = (state, action, next_state, reward, hidden)
+        with self.memory_lock:
+            self.memory.push(*record)
+        self.logRecord(record)
+
+    def warmUp(self, n_steps=None, max_episode_steps=100, workers=0):
+        # the random actions run no forward pass, the warm up transitions are stored with zero recurrent states
+        self.actor_hidden = None
+        return DRQNAgent.warmUp(self, n_steps, max_episode_steps, workers)
+
+    def optimizeModel(self):
+        if len(self.memory) < self.min_mem:
+            return
+        batch, slots, weights = self.nextBatch()
+        if weights is not None:
+            weights = weights.to(self.device)
+        loss, td_errors, non_pad_mask = sliceLoss(self.policy_net, self.target_net, batch, self.gamma, self.burn_in,
+                                                  self.single_pass, self.share_target_encoder, weights)
+        if slots is not None:
+            with self.memory_lock:
+                self.memory.updatePriorities(slots, td_errors, non_pad_mask)
+
+        self.optimizer.zero_grad()
+        loss.backward()
+        for param in self.policy_net.parameters():
+            param.grad.data.clamp_(-1, 1)
+        self.optimizer.step()
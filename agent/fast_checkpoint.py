@@ -0,0 +1,144 @@
+import os
+import json
+import shutil
+from collections import deque
+
+import numpy as np
+import torch
+
+
+class ArrayRef(object):
+    def __init__(self, name, tensor, shared=False):
+        """
+        placeholder of an array saved to name.npy
+        :param name: file name without extension
+        :param tensor: True for a torch tensor, False for a numpy array
+        :param shared: the tensor was in shared memory
+        """
+        self.name = name
+        self.tensor = tensor
+        self.shared = shared
+
+
+class ObjectRef(object):
+    def __init__(self, cls, state):
+        """
+        placeholder of an object of this package whose state holds ArrayRefs
+        """
+        self.cls = cls
+        self.state = state
+
+
+def fastPath(saving_dir, time_stamp):
+    return os.path.join(saving_dir, 'fast.' + time_stamp)
+
+
+def hasArrayStorage(memory):
+    """
+    :param memory: replay memory
+    :return: False for the memories keeping their transitions in a python list or deque, the fast layout could only
+             pickle them whole
+    """
+    return not isinstance(getattr(memory, 'memory', None), (list, deque))
+
+
+def _isArray(value):
+    return isinstance(value, np.ndarray) and value.dtype != object
+
+
+def _extract(value, directory, name):
+    """
+    save the tensors and numpy arrays in value to directory and replace them by ArrayRefs. lists, tuples, string keyed
+    dicts and the objects of this package are searched recursively, everything else is left to pickle
+    """
+    if isinstance(value, torch.Tensor):
+        np.save(os.path.join(directory, name + '.npy'), value.detach().to('cpu').numpy())
+        return ArrayRef(name, True, value.is_shared())
+    if _isArray(value):
+        np.save(os.path.join(directory, name + '.npy'), np.asarray(value))
+        return ArrayRef(name, False)
+    if type(value) in (list, tuple):
+        return type(value)(_extract(v, directory, '%s.%d' % (name, i)) for i, v in enumerate(value))
+    if type(value) is dict and all(isinstance(k, str) for k in value):
+        return dict((k, _extract(v, directory, name + '.' + k)) for k, v in value.items())
+    if hasattr(value, '__dict__') and type(value).__module__.split('.')[0] in ('agent', 'util'):
+        state = value.__getstate__() if hasattr(value, '__getstate__') else value.__dict__.copy()
+        return ObjectRef(type(value), _extract(state, directory, name))
+    return value
+
+
+def _restore(value, directory):
+    """
+    inverse of _extract. the arrays are memory mapped copy on write, so their pages are read when first touched and
+    writes never reach the checkpoint. shared tensors are copied back into shared memory
+    """
+    if isinstance(value, ArrayRef):
+        array = np.load(os.path.join(directory, value.name + '.npy'), mmap_mode='c')
+        if not value.tensor:
+            return array
+        tensor = torch.from_numpy(array)
+        return tensor.share_memory_() if value.shared else tensor
+    if isinstance(value, ObjectRef):
+        obj = value.cls.__new__(value.cls)
+        state = _restore(value.state, directory)
+        if hasattr(obj, '__setstate__'):
+            obj.__setstate__(state)
+        else:
+            obj.__dict__.update(state)
+        return obj
+    if type(value) in (list, tuple):
+        return type(value)(_restore(v, directory) for v in value)
+    if type(value) is dict:
+        return dict((k, _restore(v, directory)) for k, v in value.items())
+    return value
+
+
+def saveFastCheckpoint(directory, model_state, metrics, replay):
+    """
+    write a checkpoint as a directory: model.pth.tar with the weights and the optimizer state, metrics.json with the
+    counters and learning curves, and replay/ with every array of the replay objects as a raw .npy file next to a
+    small pickled skeleton. the directory is written under a temporary name and renamed
+    :param directory: path of the checkpoint directory, replaced if it exists
+    :param model_state: dict of state dicts
+    :param metrics: json serializable dict
+    :param replay: dict of the objects to restore with the replay, e.g. the memory
+    :return: None
+    """
+    tmp_directory = directory + '.tmp'
+    if os.path.exists(tmp_directory):
+        shutil.rmtree(tmp_directory)
+    os.makedirs(os.path.join(tmp_directory, 'replay'))
+    torch.save(model_state, os.path.join(tmp_directory, 'model.pth.tar'))
+    with open(os.path.join(tmp_directory, 'metrics.json'), 'w') as f:
+        json.dump(metrics, f)
+    skeleton = _extract(replay, os.path.join(tmp_directory, 'replay'), 'replay')
+    torch.save(skeleton, os.path.join(tmp_directory, 'replay', 'skeleton.pth.tar'))
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.rename(tmp_directory, directory)
+
+
+def loadMetrics(directory):
+    """
+    :param directory: path of the checkpoint directory
+    :return: dict written as metrics by saveFastCheckpoint
+    """
+    with open(os.path.join(directory, 'metrics.json')) as f:
+        return json.load(f)
+
+
+def loadModelState(directory, map_location=None):
+    """
+    :param directory: path of the checkpoint directory
+    :return: dict written as model_state by saveFastCheckpoint
+    """
+    return torch.load(os.path.join(directory, 'model.pth.tar'), map_location=map_location)
+
+
+def loadReplay(directory):
+    """
+    :param directory: path of the checkpoint directory
+    :return: dict written as replay by saveFastCheckpoint, its arrays memory mapped
+    """
+    skeleton = torch.load(os.path.join(directory, 'replay', 'skeleton.pth.tar'))
+    return _restore(skeleton, os.path.join(directory, 'replay'))
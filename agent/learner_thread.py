@@ -0,0 +1,94 @@
+import sys
+import copy
+import threading
+import time
+
+import torch
+
+
+class LearnerThread(object):
+    def __init__(self, agent, sync_freq=100, num_threads=None):
+        """
+        run the updates of an agent continuously in a background thread while the agent acts. acting forwards run on
+        a copy of the policy net refreshed every sync_freq updates, so they never see a half applied update. the
+        thread holds agent.learn_lock during every update, and counts the target updates in updates instead of steps
+        :param agent: DQNAgent
+        :param sync_freq: number of updates between two refreshes of the acting copy
+        :param num_threads: passed to torch.set_num_threads when the thread starts, None keeps the default. the
+                            OpenMP kernels of torch use this count in the learner thread only, the acting thread
+                            keeps its own. MKL has one count per process, which this call sets
+        """
+        self.agent = agent
+        self.sync_freq = sync_freq
+        self.num_threads = num_threads
+        self.actor_net = copy.deepcopy(agent.policy_net)
+        self.actor_net.eval()
+        self.net_lock = threading.Lock()
+        self.updates = 0
+        self.exc_info = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        agent = self.agent
+        if self.num_threads is not None:
+            torch.set_num_threads(self.num_threads)
+        min_mem = max(agent.batch_size, getattr(agent, 'min_mem', 0))
+        try:
+            while not self.stopped.is_set():
+                if len(agent.memory) < min_mem:
+                    time.sleep(0.01)
+                    continue
+                with agent.learn_lock:
+                    if agent.macro_batch > 1:
+                        agent.optimizeMacroBatch()
+                        n = agent.macro_batch
+                    else:
+                        agent.optimizeModel()
+                        n = 1
+                    for _ in range(n):
+                        self.updates += 1
+                        if self.updates % agent.target_update == 0:
+                            agent.updateTargetNet()
+                        if self.updates % self.sync_freq == 0:
+                            self.syncActorNet()
+        except Exception:
+            self.exc_info = sys.exc_info()
+
+    def syncActorNet(self):
+        """
+        copy the policy net into the acting copy
+        :return: None
+        """
+        with self.net_lock:
+            self.actor_net.load_state_dict(self.agent.policy_net.state_dict())
+
+    def forward(self, *args):
+        """
+        forward the acting copy of the policy net
+        :return: output of the net
+        """
+        with self.net_lock:
+            with torch.no_grad():
+                return self.actor_net(*args)
+
+    def check(self):
+        """
+        re-raise an exception of the learner thread in the calling thread
+        :return: None
+        """
+        if self.exc_info is not None:
+            exc_info = self.exc_info
+            self.exc_info = None
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def stop(self):
+        """
+        stop the learner thread after its current update
+        :return: None
+        """
+        self.stopped.set()
+        self.thread.join()
+        self.check()
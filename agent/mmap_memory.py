@@ -0,0 +1,203 @@
+import os
+
+import numpy as np
+import torch
+
+from agent.sequence_memory import SequenceReplayMemory
+
+
+def openMmap(path, shape, dtype, mode):
+    """
+    open a memory mapped file as a tensor. pages are read from disk when they are first touched, so the file can be
+    larger than the physical memory
+    :param path: path of the file
+    :param shape: tuple, shape of the tensor
+    :param dtype: numpy dtype
+    :param mode: 'w+' to create (or truncate) the file, 'r+' to reopen it. 'r+' with a missing file or a file of
+                 another size creates it instead
+    :return: tensor sharing memory with the file, the underlying numpy memmap
+    """
+    if mode == 'r+' and (not os.path.exists(path) or
+                         os.path.getsize(path) != int(np.prod(shape)) * np.dtype(dtype).itemsize):
+        mode = 'w+'
+    array = np.memmap(path, dtype=dtype, mode=mode, shape=shape)
+    return torch.from_numpy(array), array
+
+
+class MmapStorage(object):
+    """
+    mixin keeping the fixed shape fields of a replay memory in memory mapped files under one directory. pickling only
+    writes the bookkeeping, unpickling reopens the files. the files always hold the latest data, so reopening an
+    older checkpoint sees newer transitions in the slots written since then
+    """
+    mmap_attrs = ('states', 'next_states', 'actions', 'rewards', 'finals', 'hiddens')
+
+    def initStorage(self, directory):
+        """
+        :param directory: directory of the memory mapped files, created if missing
+        :return: None
+        """
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.mmap_specs = {}
+        self.mmap_arrays = {}
+
+    def _zeros(self, name, shape, dtype):
+        # existing files are opened, not truncated: a resumed run builds its memory here before loadCheckpoint
+        # reopens the files, which must still hold the saved transitions. the slots of a fresh memory are all written
+        # before they are sampled
+        dtype = torch.zeros(0, dtype=dtype).numpy().dtype
+        self.mmap_specs[name] = (tuple(shape), dtype.str)
+        tensor, self.mmap_arrays[name] = openMmap(os.path.join(self.directory, name + '.mmap'), shape, dtype, 'r+')
+        return tensor
+
+    def _reopen(self, name):
+        shape, dtype = self.mmap_specs[name]
+        tensor, self.mmap_arrays[name] = openMmap(os.path.join(self.directory, name + '.mmap'), shape,
+                                                  np.dtype(dtype), 'r+')
+        return tensor
+
+    def reopen(self):
+        """
+        reopen the files of all the fields in self.mmap_attrs
+        :return: None
+        """
+        self.actions = self._reopen('actions')
+        self.rewards = self._reopen('rewards')
+        self.finals = self._reopen('finals')
+        n_states = len([name for name in self.mmap_specs if name.startswith('states_')])
+        if n_states > 0:
+            self.states = [self._reopen('states_%d' % i) for i in range(n_states)]
+            if 'next_states_0' in self.mmap_specs:
+                self.next_states = [self._reopen('next_states_%d' % i) for i in range(n_states)]
+        n_hiddens = len([name for name in self.mmap_specs if name.startswith('hiddens_')])
+        if n_hiddens > 0:
+            self.hiddens = [self._reopen('hiddens_%d' % i) for i in range(n_hiddens)]
+
+    def flush(self):
+        """
+        write the dirty pages back to the files
+        :return: None
+        """
+        for array in self.mmap_arrays.values():
+            array.flush()
+
+    def __getstate__(self):
+        self.flush()
+        state = self.__dict__.copy()
+        state['mmap_arrays'] = {}
+        for attr in self.mmap_attrs:
+            if attr in state:
+                state[attr] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.reopen()
+
+
+class MmapReplayMemory(MmapStorage):
+    def __init__(self, capacity, directory):
+        """
+        ring of transitions for SynDQNAgent with every field in a memory mapped file. sampled indexes are sorted so
+        the pages of one batch are read in file order
+        :param capacity: number of transitions to store
+        :param directory: directory of the memory mapped files
+        """
+        self.initStorage(directory)
+        self.capacity = capacity
+        self.states = None
+        self.next_states = None
+        self.tuple_state = False
+        self.actions = self._zeros('actions', (capacity, 1), torch.long)
+        self.rewards = self._zeros('rewards', (capacity,), torch.float)
+        self.finals = self._zeros('finals', (capacity,), torch.uint8)
+        self.position = 0
+        self.size = 0
+
+    def _allocate(self, state):
+        self.tuple_state = type(state) in (tuple, list)
+        components = state if self.tuple_state else [state]
+        self.states = [self._zeros('states_%d' % i, (self.capacity,) + s.shape[1:], s.dtype)
+                       for i, s in enumerate(components)]
+        self.next_states = [self._zeros('next_states_%d' % i, (self.capacity,) + s.shape[1:], s.dtype)
+                            for i, s in enumerate(components)]
+
+    def push(self, state, action, next_state, reward):
+        """
+        store one transition, next_state is None for final transitions
+        """
+        if self.states is None:
+            self._allocate(state)
+        components = state if self.tuple_state else [state]
+        for i in range(len(self.states)):
+            self.states[i][self.position] = components[i][0].to('cpu')
+        if next_state is None:
+            for s in self.next_states:
+                s[self.position] = 0
+            self.finals[self.position] = 1
+        else:
+            components = next_state if self.tuple_state else [next_state]
+            for i in range(len(self.next_states)):
+                self.next_states[i][self.position] = components[i][0].to('cpu')
+            self.finals[self.position] = 0
+        self.actions[self.position] = action.to('cpu')
+        self.rewards[self.position] = reward.to('cpu')
+        self.position = (self.position + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def sampleIndex(self, batch_size):
+        """
+        :param batch_size: size of the mini batch
+        :return: sorted numpy array of slots, sampled with replacement
+        """
+        return np.sort(np.random.randint(0, self.size, batch_size))
+
+    def gather(self, idx):
+        """
+        gather the batch at the given slots
+        :param idx: numpy array of slots
+        :return: state, action, next_state, reward, final_mask, non_pad_mask
+        """
+        idx = torch.from_numpy(idx)
+        state = [s[idx] for s in self.states]
+        next_state = [s[idx] for s in self.next_states]
+        if self.tuple_state:
+            state = tuple(state)
+            next_state = tuple(next_state)
+        else:
+            state = state[0]
+            next_state = next_state[0]
+        non_pad_mask = torch.ones(len(idx), dtype=torch.uint8)
+        return state, self.actions[idx], next_state, self.rewards[idx], self.finals[idx], non_pad_mask
+
+    def sample(self, batch_size):
+        return self.gather(self.sampleIndex(batch_size))
+
+    def __len__(self):
+        return self.size
+
+
+class MmapSequenceReplayMemory(MmapStorage, SequenceReplayMemory):
+    def __init__(self, capacity, sequence_len, directory, store_next_states=True):
+        """
+        SequenceReplayMemory with the transitions in memory mapped files. sampled slices are sorted by their
+        first slot so the pages of one batch are read in file order
+        :param capacity: number of transitions to store
+        :param sequence_len: length of the sampled slices
+        :param directory: directory of the memory mapped files
+        :param store_next_states: see SequenceReplayMemory
+        """
+        self.initStorage(directory)
+        SequenceReplayMemory.__init__(self, capacity, sequence_len, store_next_states)
+
+    def __setstate__(self, state):
+        state.setdefault('boundary_next_states', {})
+        MmapStorage.__setstate__(self, state)
+
+    def sampleIndex(self, batch_size):
+        episodes, idx = SequenceReplayMemory.sampleIndex(self, batch_size)
+        order = np.argsort(idx[:, 0], kind='mergesort')
+        return episodes[order], idx[order]
+
@@ -1,6 +1,8 @@
 import os
 import torch
 
+from agent.fast_checkpoint import fastPath, loadMetrics
+
 
 class PlotAgent:
     def __init__(self):
@@ -9,6 +11,12 @@ class PlotAgent:
         self.episode_lengths = None
 
     def loadCheckpoint(self, time_stamp):
+        if os.path.exists(fastPath(self.saving_dir, time_stamp)):
+            # only the metrics sidecar is read
+            metrics = loadMetrics(fastPath(self.saving_dir, time_stamp))
+            self.episode_rewards = metrics['episode_rewards']
+            self.episode_lengths = metrics['episode_lengths']
+            return
         state_filename = os.path.join(self.saving_dir, 'checkpoint.' + time_stamp + '.pth.tar')
 
         print 'loading checkpoint: ', time_stamp
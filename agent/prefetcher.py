@@ -0,0 +1,57 @@
+import sys
+import threading
+import time
+from Queue import Queue, Empty, Full
+
+
+class BatchPrefetcher(object):
+    def __init__(self, assemble, n_batches=2):
+        """
+        assemble mini batches in a background thread and hand them to the learner through a bounded queue, so
+        sampling and collation overlap with acting and with the update itself
+        :param assemble: function returning one ready mini batch
+        :param n_batches: number of mini batches assembled ahead
+        """
+        self.assemble = assemble
+        self.queue = Queue(maxsize=n_batches)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while not self.stopped.is_set():
+            try:
+                item = (self.assemble(), None)
+            except Exception:
+                item = (None, sys.exc_info())
+            while not self.stopped.is_set():
+                try:
+                    self.queue.put(item, timeout=0.1)
+                    break
+                except Full:
+                    pass
+            if item[1] is not None:
+                return
+
+    def get(self):
+        """
+        :return: the next mini batch, blocks until one is ready
+        """
+        batch, exc_info = self.queue.get()
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return batch
+
+    def stop(self):
+        """
+        stop the worker thread, batches already in the queue are dropped
+        :return: None
+        """
+        self.stopped.set()
+        while True:
+            try:
+                self.queue.get_nowait()
+            except Empty:
+                break
+        self.thread.join()
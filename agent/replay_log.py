@@ -0,0 +1,157 @@
+import os
+from collections import deque
+
+import torch
+
+
+def toCpu(x):
+    """
+    move the tensors in a (nested) record to cpu
+    """
+    if isinstance(x, torch.Tensor):
+        return x.to('cpu')
+    if hasattr(x, '_fields'):
+        return type(x)(*map(toCpu, x))
+    if type(x) in (tuple, list):
+        return type(x)(map(toCpu, x))
+    return x
+
+
+class ReplayLog(object):
+    def __init__(self, capacity, segment_len=1000):
+        """
+        append only log of the records pushed into a replay memory, used to checkpoint the memory incrementally.
+        pending records are written as a new segment file every segment_len transitions and at every checkpoint, so
+        a checkpoint only writes what was pushed since the previous one. the memory is rebuilt by pushing the
+        records of the segments again. segments older than the eviction watermark (number of pushed transitions
+        the memory no longer holds) are deleted once no kept checkpoint references them. the segments are written
+        through the CheckpointWriter of the run, in order with the checkpoints, in its background thread if it has one
+        :param capacity: capacity of the memory in transitions, older pending records are dropped as the memory
+                         evicted them too
+        :param segment_len: number of transitions per segment
+        """
+        self.capacity = capacity
+        self.segment_len = segment_len
+        self.pending = deque()
+        self.pending_counts = deque()
+        self.n_pending = 0
+        self.n_pushed = 0
+        self.segments = []
+        self.next_index = 0
+
+    @staticmethod
+    def segmentPath(saving_dir, index):
+        return os.path.join(saving_dir, 'replay', 'segment.%08d.pth.tar' % index)
+
+    def append(self, record, n=1, saving_dir=None, writer=None):
+        """
+        log one record
+        :param record: arguments of one push, e.g. a transition or an episode
+        :param n: number of transitions in the record
+        :param saving_dir: directory of the run, the segments go to its replay sub directory. None keeps the
+                           records pending
+        :param writer: CheckpointWriter writing the segments, None writes them here
+        :return: None
+        """
+        self.pending.append(toCpu(record))
+        self.pending_counts.append(n)
+        self.n_pending += n
+        self.n_pushed += n
+        while self.n_pending - self.pending_counts[0] >= self.capacity:
+            self.n_pending -= self.pending_counts.popleft()
+            self.pending.popleft()
+        if saving_dir is not None and self.n_pending >= self.segment_len:
+            self.flush(saving_dir, writer)
+
+    def flush(self, saving_dir, writer=None):
+        """
+        write the pending records as a new segment
+        :param saving_dir: directory of the run
+        :param writer: CheckpointWriter writing the segment, None writes it here
+        :return: None
+        """
+        if self.n_pending == 0:
+            return
+        if not os.path.exists(os.path.join(saving_dir, 'replay')):
+            os.makedirs(os.path.join(saving_dir, 'replay'))
+        start = self.n_pushed - self.n_pending
+        segment = {
+            'start': start,
+            'counts': list(self.pending_counts),
+            'records': list(self.pending)
+        }
+        path = self.segmentPath(saving_dir, self.next_index)
+        if writer is not None:
+            writer.saveFile(path, segment)
+        else:
+            torch.save(segment, path)
+        self.segments.append((self.next_index, start, self.n_pushed))
+        self.next_index += 1
+        self.pending.clear()
+        self.pending_counts.clear()
+        self.n_pending = 0
+
+    def write(self, saving_dir, n_stored, writer=None):
+        """
+        flush the pending records and delete the segments the memory has evicted. through a writer they are only
+        released, older checkpoints it keeps may still reference them, see segmentPaths
+        :param saving_dir: directory of the run
+        :param n_stored: number of transitions in the memory
+        :param writer: CheckpointWriter writing and deleting the segments, None does it here
+        :return: manifest to save with the checkpoint
+        """
+        self.flush(saving_dir, writer)
+        watermark = self.n_pushed - n_stored
+        evicted = []
+        while len(self.segments) > 0 and self.segments[0][2] <= watermark:
+            evicted.append(self.segmentPath(saving_dir, self.segments[0][0]))
+            self.segments.pop(0)
+        if writer is not None:
+            writer.release(evicted)
+        else:
+            for path in evicted:
+                if os.path.exists(path):
+                    os.remove(path)
+        manifest = {
+            'segments': list(self.segments),
+            'watermark': watermark,
+            'n_pushed': self.n_pushed,
+            'next_index': self.next_index
+        }
+        return manifest
+
+    @staticmethod
+    def segmentPaths(saving_dir, manifest):
+        """
+        :param saving_dir: directory of the run
+        :param manifest: manifest returned by write
+        :return: paths of the segments the manifest needs, to pass as the refs of its checkpoint
+        """
+        return [ReplayLog.segmentPath(saving_dir, index) for index, _, _ in manifest['segments']]
+
+    def rebuild(self, saving_dir, manifest, push):
+        """
+        push the records of a manifest that are newer than its watermark, and continue the log from it. a segment
+        the manifest references must exist, a later checkpoint may have deleted it when its memory had evicted the
+        segment
+        :param saving_dir: directory of the run
+        :param manifest: manifest returned by write
+        :param push: function pushing one record into the memory
+        :return: None
+        """
+        self.segments = list(manifest['segments'])
+        self.n_pushed = manifest['n_pushed']
+        self.next_index = manifest['next_index']
+        self.pending.clear()
+        self.pending_counts.clear()
+        self.n_pending = 0
+        for index, start, end in self.segments:
+            path = self.segmentPath(saving_dir, index)
+            if not os.path.exists(path):
+                raise IOError('missing replay segment {}, the memory can not be rebuilt'.format(path))
+            segment = torch.load(path)
+            position = segment['start']
+            for record, n in zip(segment['records'], segment['counts']):
+                if position >= manifest['watermark']:
+                    push(record)
+                position += n
@@ -0,0 +1,515 @@
+from collections import namedtuple
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from util.utils import LinearSchedule
+from util.segment_tree import SumTree
+
+Transition = namedtuple('Transition', ('state', 'action', 'next_state', 'reward'))
+
+
+def sliceTime(x, start, end=None):
+    """
+    slice a batch x time tensor, or a tuple of them, along the time dim
+    """
+    if type(x) is tuple:
+        return tuple(map(lambda y: y[:, start:end], x))
+    return x[:, start:end]
+
+
+def burnIn(policy_net, target_net, batch, burn_in):
+    """
+    warm up the recurrent states of the nets on the first burn_in steps of a batch of slices, without gradient. the
+    nets start from the stored recurrent states of the batch when it has them
+    :param batch: state, action, next_state, reward, final_mask, non_pad_mask[, policy_hidden, target_hidden]
+    :param burn_in: number of steps to burn in
+    :return: the batch without the first burn_in steps, recurrent state of the policy net, recurrent state of the
+             target net
+    """
+    policy_hidden, target_hidden = batch[6:] if len(batch) > 6 else (None, None)
+    batch = batch[:6]
+    if burn_in == 0:
+        return batch, policy_hidden, target_hidden
+    state, _, next_state = batch[:3]
+    with torch.no_grad():
+        _, policy_hidden = policy_net(sliceTime(state, 0, burn_in), policy_hidden)
+        _, target_hidden = target_net(sliceTime(next_state, 0, burn_in), target_hidden)
+    return tuple(map(lambda x: sliceTime(x, burn_in), batch)), policy_hidden, target_hidden
+
+
+def forwardShifted(policy_net, target_net, obs, policy_hidden=None, target_hidden=None, burn_in=0,
+                   share_encoder=False):
+    """
+    q values of the policy net on obs[:, :-1] (the states) and of the target net on obs[:, 1:] (the next states) of
+    one batch of observation sequences, the first burn_in steps only warm up the recurrent states. with
+    share_encoder the nets are split in encode(obs) and head(features, hidden): the observations are encoded once
+    by the policy net and the target head runs on its detached features
+    :param obs: tensor or tuple of tensors, batch x sequence_len + 1 x ...
+    :param policy_hidden: initial recurrent state of the policy net
+    :param target_hidden: initial recurrent state of the target net
+    :param burn_in: number of steps to burn in
+    :param share_encoder: share the encoder features of the policy net with the target net
+    :return: policy q values with gradient, target q values without, each batch x sequence_len - burn_in x actions
+    """
+    if share_encoder:
+        features = policy_net.encode(obs)
+        policy_in, target_in = sliceTime(features, 0, -1), sliceTime(features, 1).detach()
+        policy_forward, target_forward = policy_net.head, target_net.head
+    else:
+        policy_in, target_in = sliceTime(obs, 0, -1), sliceTime(obs, 1)
+        policy_forward, target_forward = policy_net, target_net
+    if burn_in > 0:
+        with torch.no_grad():
+            _, policy_hidden = policy_forward(sliceTime(policy_in, 0, burn_in), policy_hidden)
+            _, target_hidden = target_forward(sliceTime(target_in, 0, burn_in), target_hidden)
+        policy_in, target_in = sliceTime(policy_in, burn_in), sliceTime(target_in, burn_in)
+    q_values, _ = policy_forward(policy_in, policy_hidden)
+    with torch.no_grad():
+        target_q_values, _ = target_forward(target_in, target_hidden)
+    return q_values, target_q_values
+
+
+def sampleSlices(memory, batch_size, single_pass=False, stored_state=False):
+    """
+    sample a batch of slices for the update of a recurrent agent, the caller holds the lock of the memory
+    :param memory: SequenceReplayMemory, windows are sampled by priority from a PrioritizedSequenceReplayMemory
+    :param batch_size: number of slices
+    :param single_pass: gather the states and next states as one observation sequence, see gatherSequence
+    :param stored_state: append the stored recurrent states of the policy and the target net to the batch
+    :return: batch on cpu, sampled window slots and importance sampling weights (None for uniform memories)
+    """
+    slots = weights = None
+    if isinstance(memory, PrioritizedSequenceReplayMemory):
+        slots, weights = memory.sampleWindows(batch_size)
+        idx = memory.windowIndex(slots)
+    else:
+        _, idx = memory.sampleIndex(batch_size)
+    if single_pass:
+        batch = memory.gatherSequence(idx)
+    else:
+        batch = memory.gather(idx)
+    if stored_state:
+        # next_state of step t is the state of step t + 1, the target net starts one step later
+        batch += (memory.gatherHidden(idx[:, 0]), memory.gatherHidden(idx[:, min(1, idx.shape[1] - 1)]))
+    return batch, slots, weights
+
+
+def sliceLoss(policy_net, target_net, batch, gamma, burn_in=0, single_pass=False, share_encoder=False,
+              weights=None):
+    """
+    dqn loss of a batch of sampleSlices, over the steps after burn_in that are not padding
+    :param batch: batch of sampleSlices on the device of the nets
+    :param gamma: discount factor
+    :param burn_in: number of steps to burn in
+    :param single_pass: the batch holds observation sequences, see forwardShifted
+    :param share_encoder: see forwardShifted
+    :param weights: importance sampling weights of the slices, None for a plain mean
+    :return: loss, td errors and non_pad_mask of the steps after burn_in (batch_size x steps)
+    """
+    if single_pass:
+        policy_hidden, target_hidden = batch[5:] if len(batch) > 5 else (None, None)
+        action_batch, reward_batch, final_mask, non_pad_mask = map(lambda x: sliceTime(x, burn_in), batch[1:5])
+        state_action_values, target_state_action_values = \
+            forwardShifted(policy_net, target_net, batch[0], policy_hidden, target_hidden, burn_in, share_encoder)
+    else:
+        batch, policy_hidden, target_hidden = burnIn(policy_net, target_net, batch, burn_in)
+        state_batch, action_batch, next_state_batch, reward_batch, final_mask, non_pad_mask = batch
+        state_action_values, _ = policy_net(state_batch, policy_hidden)
+        target_state_action_values, _ = target_net(next_state_batch, target_hidden)
+    state_action_values = state_action_values.gather(2, action_batch).squeeze(2)
+    target_state_action_values = target_state_action_values.max(2)[0].detach()
+
+    target_state_action_values[final_mask] = 0
+    expected_state_action_values = reward_batch + gamma * target_state_action_values
+
+    td_errors = expected_state_action_values - state_action_values
+    if weights is not None:
+        weights = weights.unsqueeze(1).expand_as(td_errors)
+        loss = (weights[non_pad_mask] * td_errors[non_pad_mask].pow(2)).mean()
+    else:
+        loss = F.mse_loss(state_action_values[non_pad_mask], expected_state_action_values[non_pad_mask])
+    return loss, td_errors, non_pad_mask
+
+
+class SequenceReplayMemory(object):
+    def __init__(self, capacity, sequence_len, store_next_states=True):
+        """
+        replay memory for sequence slices. transitions are stored flat in preallocated tensors, episodes are
+        recorded as (start, length) in a ring of the same size. the extra last slot of every tensor stays zero and
+        is gathered for the padding of episodes shorter than sequence_len
+        :param capacity: number of transitions to store
+        :param sequence_len: length of the sampled slices
+        :param store_next_states: store the next states apart. without them every frame is stored once, and the
+                                  next state of a slot is read from the following slot of its episode
+        """
+        self.capacity = capacity
+        self.sequence_len = sequence_len
+        self.store_next_states = store_next_states
+        self.states = None
+        self.next_states = None
+        self.tuple_state = False
+        self.hiddens = None
+        self.tuple_hidden = False
+        self.actions = self._zeros('actions', (capacity + 1, 1), torch.long)
+        self.rewards = self._zeros('rewards', (capacity + 1,), torch.float)
+        self.finals = self._zeros('finals', (capacity + 1,), torch.uint8)
+        self.position = 0
+        self.size = 0
+
+        self.episode_starts = np.zeros(capacity, dtype=np.int64)
+        self.episode_lengths = np.zeros(capacity, dtype=np.int64)
+        self.episode_head = 0
+        self.n_episodes = 0
+
+        self.local_memory = []
+        self.local_hiddens = []
+        # next states of the last transitions of cut episodes when the next states are not stored, by slot
+        self.boundary_next_states = {}
+
+    def __setstate__(self, state):
+        state.setdefault('boundary_next_states', {})
+        self.__dict__.update(state)
+
+    def push(self, state, action, next_state, reward, hidden=None):
+        """
+        push one transition of the running episode. the episode is stored once next_state is None
+        :param hidden: optional recurrent state of the actor before it saw state
+        """
+        self.local_memory.append(Transition(state, action, next_state, reward))
+        self.local_hiddens.append(hidden)
+        if next_state is None:
+            self.pushEpisode(self.local_memory, self.local_hiddens)
+            self.local_memory = []
+            self.local_hiddens = []
+
+    def cutEpisode(self):
+        """
+        store the running episode of push when it was ended by a step limit, its last transition keeps its next state
+        :return: None
+        """
+        if len(self.local_memory) > 0:
+            self.pushEpisode(self.local_memory, self.local_hiddens, cut=True)
+            self.local_memory = []
+            self.local_hiddens = []
+
+    def _zeros(self, name, shape, dtype):
+        """
+        allocate one storage tensor, subclasses can put it somewhere else than in RAM
+        :param name: name of the field
+        :param shape: tuple, shape of the tensor
+        :param dtype: torch dtype
+        :return: zero filled tensor
+        """
+        return torch.zeros(shape, dtype=dtype)
+
+    def _allocate(self, state):
+        self.tuple_state = type(state) in (tuple, list)
+        components = state if self.tuple_state else [state]
+        self.states = [self._zeros('states_%d' % i, (self.capacity + 1,) + s.shape[1:], s.dtype)
+                       for i, s in enumerate(components)]
+        if self.store_next_states:
+            self.next_states = [self._zeros('next_states_%d' % i, (self.capacity + 1,) + s.shape[1:], s.dtype)
+                                for i, s in enumerate(components)]
+
+    def _components(self, state):
+        return state if self.tuple_state else [state]
+
+    def _allocateHidden(self, hidden):
+        self.tuple_hidden = type(hidden) in (tuple, list)
+        components = hidden if self.tuple_hidden else [hidden]
+        self.hiddens = [self._zeros('hiddens_%d' % i, (self.capacity + 1, h.shape[0], h.shape[2]), torch.float)
+                        for i, h in enumerate(components)]
+
+    def pushEpisode(self, episode, hiddens=None, cut=False):
+        """
+        store a whole episode. the last transition of the episode is final unless the episode is cut
+        :param episode: list of (state, action, next_state, reward)
+        :param hiddens: optional list with the recurrent state (tensor or tuple of tensors, layers x 1 x hidden) of
+                        the actor before every transition, None entries are stored as zeros
+        :param cut: the episode was ended by a step limit, its last transition keeps its next state and is not final
+        :return: None
+        """
+        n = len(episode)
+        if n == 0 or n > self.capacity:
+            return
+        if self.states is None:
+            self._allocate(episode[0][0])
+        self.evict(n)
+
+        slots = (self.position + np.arange(n)) % self.capacity
+        if len(self.boundary_next_states) > 0:
+            for slot in slots:
+                self.boundary_next_states.pop(slot, None)
+        if cut and self.next_states is None:
+            # without stored next states the following slot would be read, which belongs to the next episode
+            self.boundary_next_states[slots[-1]] = [s[0].to('cpu') for s in self._components(episode[-1][2])]
+        if hiddens is not None or self.hiddens is not None:
+            self._storeHiddens(slots, hiddens or [None] * n)
+
+        idx = torch.from_numpy(slots)
+        states, actions, next_states, rewards = zip(*episode)
+        self._storeStates(slots, [self._components(s) for s in states],
+                          [self._components(s) if s is not None else None for s in next_states])
+        self.actions[idx] = torch.cat(actions).to('cpu')
+        self.rewards[idx] = torch.cat(rewards).to('cpu')
+        self.finals[idx] = 0
+        self.finals[idx[-1]] = 0 if cut else 1
+
+        self.episode_starts[(self.episode_head + self.n_episodes) % self.capacity] = self.position
+        self.episode_lengths[(self.episode_head + self.n_episodes) % self.capacity] = n
+        self.n_episodes += 1
+        self.position = (self.position + n) % self.capacity
+        self.size += n
+
+    def _storeStates(self, slots, states, next_states):
+        """
+        store the states and next states of transitions, subclasses can store them differently
+        :param slots: numpy array of storage slots
+        :param states: list with the components of every state
+        :param next_states: list with the components of every next state, None for final transitions
+        :return: None
+        """
+        idx = torch.from_numpy(slots)
+        padding = [torch.zeros_like(s) for s in states[0]]
+        next_states = [s if s is not None else padding for s in next_states]
+        for i in range(len(self.states)):
+            self.states[i][idx] = torch.cat([s[i] for s in states]).to('cpu', self.states[i].dtype)
+            if self.next_states is not None:
+                self.next_states[i][idx] = torch.cat([s[i] for s in next_states]).to('cpu', self.states[i].dtype)
+
+    def _gatherStates(self, idx):
+        """
+        :param idx: numpy index array into the storage
+        :return: list of the state components, list of the next state components, each idx.shape x ...
+        """
+        idx = torch.from_numpy(idx)
+        return [s[idx] for s in self.states], [s[idx] for s in self.next_states]
+
+    def _gatherFrames(self, idx):
+        """
+        :param idx: numpy index array into the storage
+        :return: list of the state components, each idx.shape x ...
+        """
+        idx = torch.from_numpy(idx)
+        return [s[idx] for s in self.states]
+
+    def _hiddenComponents(self, hidden):
+        return hidden if self.tuple_hidden else [hidden]
+
+    def _storeHiddens(self, slots, hiddens):
+        slots = torch.from_numpy(slots)
+        known = [h for h in hiddens if h is not None]
+        if len(known) == 0:
+            for h in self.hiddens or []:
+                h[slots] = 0
+            return
+        if self.hiddens is None:
+            self._allocateHidden(known[0])
+        padding = [torch.zeros_like(h) for h in self._hiddenComponents(known[0])]
+        hiddens = [self._hiddenComponents(h) if h is not None else padding for h in hiddens]
+        for i in range(len(self.hiddens)):
+            self.hiddens[i][slots] = torch.stack([h[i][:, 0] for h in hiddens]).to('cpu', torch.float)
+
+    def gatherHidden(self, slots):
+        """
+        gather the stored recurrent states at the given slots, zeros for the padding slot
+        :param slots: numpy array of storage slots
+        :return: tensor or tuple of tensors, layers x len(slots) x hidden, None if no recurrent state was pushed
+        """
+        if self.hiddens is None:
+            return None
+        slots = torch.from_numpy(slots)
+        hidden = [h[slots].transpose(0, 1).contiguous() for h in self.hiddens]
+        if self.tuple_hidden:
+            return tuple(hidden)
+        return hidden[0]
+
+    def evict(self, n):
+        """
+        drop the oldest episodes until n more transitions fit in self.capacity
+        :param n: number of transitions to make room for
+        :return: None
+        """
+        while self.size + n > self.capacity:
+            self.size -= self.episode_lengths[self.episode_head]
+            self.episode_head = (self.episode_head + 1) % self.capacity
+            self.n_episodes -= 1
+
+    def sampleIndex(self, batch_size):
+        """
+        sample (episode, start) pairs uniformly over the stored episodes
+        :param batch_size: number of slices
+        :return: numpy array of episode slots (batch_size), index array (batch_size x sequence_len) into the storage
+        """
+        episodes = (self.episode_head + np.random.randint(0, self.n_episodes, batch_size)) % self.capacity
+        lengths = self.episode_lengths[episodes]
+        starts = np.random.randint(0, np.maximum(lengths - self.sequence_len, 0) + 1)
+        return episodes, self.sliceIndex(episodes, starts)
+
+    def sliceIndex(self, episodes, starts):
+        """
+        storage index of the slices starting at the given offsets of the given episodes, padding points to the zero slot
+        :param episodes: numpy array of episode slots
+        :param starts: numpy array of offsets inside the episodes
+        :return: index array (batch_size x sequence_len) into the storage
+        """
+        lengths = self.episode_lengths[episodes]
+        offsets = starts[:, None] + np.arange(self.sequence_len)[None, :]
+        idx = (self.episode_starts[episodes][:, None] + offsets) % self.capacity
+        idx[offsets >= lengths[:, None]] = self.capacity
+        return idx
+
+    def gather(self, idx):
+        """
+        gather the batch at the given storage index
+        :param idx: numpy index array (batch_size x sequence_len)
+        :return: state, action, next_state, reward, final_mask, non_pad_mask, each batch_size x sequence_len x ...
+        """
+        if self.next_states is None:
+            obs, action, reward, final_mask, non_pad_mask = self.gatherSequence(idx)
+            return sliceTime(obs, 0, -1), action, sliceTime(obs, 1), reward, final_mask, non_pad_mask
+        non_pad_mask = torch.from_numpy((idx != self.capacity).astype(np.uint8))
+        state, next_state = self._gatherStates(idx)
+        idx = torch.from_numpy(idx)
+        if self.tuple_state:
+            state = tuple(state)
+            next_state = tuple(next_state)
+        else:
+            state = state[0]
+            next_state = next_state[0]
+        return state, self.actions[idx], next_state, self.rewards[idx], self.finals[idx], non_pad_mask
+
+    def gatherSequence(self, idx):
+        """
+        gather the batch at the given storage index with the states and next states as one sequence of observations,
+        so every frame is gathered once. obs[:, t] is the state of step t, obs[:, t + 1] its next state. the
+        observation after a final step is the zero padding, as the stored next state of a final step is. the
+        observation after the last step of a cut episode is its next state from self.boundary_next_states
+        :param idx: numpy index array (batch_size x sequence_len)
+        :return: obs (batch_size x sequence_len + 1 x ...), action, reward, final_mask, non_pad_mask
+        """
+        last = idx[:, -1]
+        following = (last + 1) % self.capacity
+        following[(last == self.capacity) | (self.finals[torch.from_numpy(last)].numpy() != 0)] = self.capacity
+        obs = self._gatherFrames(np.concatenate((idx, following[:, None]), 1))
+        if len(self.boundary_next_states) > 0:
+            cut = np.in1d(idx, np.array(self.boundary_next_states.keys())).reshape(idx.shape)
+            for row, t in zip(*np.nonzero(cut)):
+                for i, s in enumerate(self.boundary_next_states[idx[row, t]]):
+                    obs[i][row, t + 1] = s.to(obs[i].dtype)
+        obs = tuple(obs) if self.tuple_state else obs[0]
+        non_pad_mask = torch.from_numpy((idx != self.capacity).astype(np.uint8))
+        idx = torch.from_numpy(idx)
+        return obs, self.actions[idx], self.rewards[idx], self.finals[idx], non_pad_mask
+
+    def sample(self, batch_size):
+        """
+        sample a batch of slices (with replacement)
+        :param batch_size: number of slices
+        :return: state, action, next_state, reward, final_mask, non_pad_mask, each batch_size x sequence_len x ...
+        """
+        _, idx = self.sampleIndex(batch_size)
+        return self.gather(idx)
+
+    def __len__(self):
+        return self.size
+
+
+class PrioritizedSequenceReplayMemory(SequenceReplayMemory):
+    def __init__(self, capacity, sequence_len, alpha=0.9, beta=0.6, beta_steps=100000, eta=0.9, eps=1e-6,
+                 store_next_states=True):
+        """
+        SequenceReplayMemory with one priority per sequence window. a window is keyed by the storage slot of its
+        first transition, so the sum tree has one leaf per slot and slots that cannot start a window have priority 0
+        :param capacity: number of transitions to store
+        :param sequence_len: length of the sampled slices
+        :param alpha: priority exponent, 0 is uniform sampling
+        :param beta: initial importance sampling exponent, annealed to 1 over beta_steps samples
+        :param beta_steps: number of sample calls to anneal beta over
+        :param eta: weight of the max td error in the window priority, the rest goes to the mean td error
+        :param eps: added to the priority so no window gets zero priority
+        :param store_next_states: see SequenceReplayMemory
+        """
+        SequenceReplayMemory.__init__(self, capacity, sequence_len, store_next_states)
+        self.alpha = alpha
+        self.beta = LinearSchedule(beta_steps, 1.0, beta)
+        self.eta = eta
+        self.eps = eps
+        self.tree = SumTree(capacity)
+        self.max_priority = 1.0
+        self.samples_done = 0
+        self.slot_episodes = np.zeros(capacity, dtype=np.int64)
+        self.n_windows = 0
+
+    def pushEpisode(self, episode, hiddens=None, cut=False):
+        n = len(episode)
+        if n == 0 or n > self.capacity:
+            return
+        position = self.position
+        SequenceReplayMemory.pushEpisode(self, episode, hiddens, cut)
+        self.slot_episodes[(position + np.arange(n)) % self.capacity] = \
+            (self.episode_head + self.n_episodes - 1) % self.capacity
+        starts = (position + np.arange(max(n - self.sequence_len, 0) + 1)) % self.capacity
+        self.tree.update(starts, self.max_priority ** self.alpha)
+        self.n_windows += len(starts)
+
+    def evict(self, n):
+        while self.size + n > self.capacity:
+            head = self.episode_head
+            length = self.episode_lengths[head]
+            starts = (self.episode_starts[head] + np.arange(max(length - self.sequence_len, 0) + 1)) % self.capacity
+            self.tree.update(starts, 0.)
+            self.n_windows -= len(starts)
+            self.size -= length
+            self.episode_head = (head + 1) % self.capacity
+            self.n_episodes -= 1
+
+    def sampleWindows(self, batch_size):
+        """
+        sample windows proportional to their priorities, one per equal segment of the total priority
+        :param batch_size: number of slices
+        :return: numpy array of window slots, float tensor of importance sampling weights normalized to max 1
+        """
+        total = self.tree.total()
+        prefix_sums = (np.arange(batch_size) + np.random.random(batch_size)) * total / batch_size
+        slots = self.tree.find(prefix_sums)
+        probs = self.tree.get(slots) / total
+        # rounding can land a prefix sum on a zero leaf: an invalid window start or an unwritten slot
+        slots = np.where(probs > 0, slots, slots[np.argmax(probs)])
+        probs = self.tree.get(slots) / total
+        weights = (self.n_windows * probs) ** (-self.beta.value(self.samples_done))
+        weights /= weights.max()
+        self.samples_done += 1
+        return slots, torch.from_numpy(weights).float()
+
+    def windowIndex(self, slots):
+        """
+        storage index of the windows starting at the given slots
+        :param slots: numpy array of window slots
+        :return: index array (batch_size x sequence_len) into the storage
+        """
+        episodes = self.slot_episodes[slots]
+        starts = (slots - self.episode_starts[episodes]) % self.capacity
+        return self.sliceIndex(episodes, starts)
+
+    def sample(self, batch_size):
+        slots, _ = self.sampleWindows(batch_size)
+        return self.gather(self.windowIndex(slots))
+
+    def updatePriorities(self, slots, td_errors, non_pad_mask):
+        """
+        set the priorities of sampled windows to eta * max |td| + (1 - eta) * mean |td| over their non pad steps
+        :param slots: numpy array of window slots
+        :param td_errors: tensor of td errors, batch_size x sequence_len
+        :param non_pad_mask: tensor, batch_size x sequence_len
+        :return: None
+        """
+        td_errors = np.abs(td_errors.detach().to('cpu').numpy())
+        non_pad_mask = non_pad_mask.to('cpu').numpy().astype(np.float64)
+        td_errors *= non_pad_mask
+        priorities = self.eta * td_errors.max(1) + \
+                     (1 - self.eta) * td_errors.sum(1) / np.maximum(non_pad_mask.sum(1), 1) + self.eps
+        self.max_priority = max(self.max_priority, priorities.max())
+        self.tree.update(slots, priorities ** self.alpha)
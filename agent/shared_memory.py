@@ -0,0 +1,211 @@
+import numpy as np
+import torch
+
+from util.utils import LinearSchedule
+from util.segment_tree import SumTree
+
+
+class SharedReplayMemory(object):
+    def __init__(self, capacity, n_writers=1, example_state=None):
+        """
+        transition replay with its storage in shared memory tensors, so actor processes (torch.multiprocessing) can
+        push while a learner process samples. the capacity is split into one ring per writer, a writer only touches
+        its own ring and counters, so pushes need no lock. every actor process calls setWriter with its own id
+        before pushing. the storage is allocated from example_state, or from the first pushed state, which then
+        has to happen before the memory is handed to the other processes. sampling skips the slot each full ring
+        is about to overwrite, a sample can still (rarely) see a slot overwritten while it is gathered
+        :param capacity: number of transitions to store
+        :param n_writers: number of processes pushing into the memory
+        :param example_state: a state (tensor or tuple of tensors, batch dim 1) to allocate the storage from
+        """
+        self.n_writers = n_writers
+        self.segment_len = capacity // n_writers
+        self.capacity = self.segment_len * n_writers
+        self.states = None
+        self.next_states = None
+        self.tuple_state = False
+        self.actions = torch.zeros(self.capacity, 1, dtype=torch.long).share_memory_()
+        self.rewards = torch.zeros(self.capacity).share_memory_()
+        self.finals = torch.zeros(self.capacity, dtype=torch.uint8).share_memory_()
+        self.positions = torch.zeros(n_writers, dtype=torch.long).share_memory_()
+        self.sizes = torch.zeros(n_writers, dtype=torch.long).share_memory_()
+        self.writer = 0
+        if example_state is not None:
+            self.allocate(example_state)
+
+    def allocate(self, state):
+        """
+        allocate the state storage in shared memory
+        :param state: tensor or tuple of tensors, batch dim 1
+        :return: None
+        """
+        self.tuple_state = type(state) in (tuple, list)
+        components = state if self.tuple_state else [state]
+        self.states = [torch.zeros((self.capacity,) + s.shape[1:], dtype=s.dtype).share_memory_()
+                       for s in components]
+        self.next_states = [torch.zeros((self.capacity,) + s.shape[1:], dtype=s.dtype).share_memory_()
+                            for s in components]
+
+    def setWriter(self, writer):
+        """
+        select the ring the pushes of this process go to
+        :param writer: id of the writer, in [0, n_writers)
+        :return: None
+        """
+        self.writer = writer
+
+    def push(self, state, action, next_state, reward):
+        """
+        store one transition in the ring of self.writer, next_state is None for final transitions
+        """
+        if self.states is None:
+            self.allocate(state)
+        position = self.positions[self.writer].item()
+        slot = self.writer * self.segment_len + position
+        components = state if self.tuple_state else [state]
+        for i in range(len(self.states)):
+            self.states[i][slot] = components[i][0].to('cpu')
+        if next_state is None:
+            for s in self.next_states:
+                s[slot] = 0
+            self.finals[slot] = 1
+        else:
+            components = next_state if self.tuple_state else [next_state]
+            for i in range(len(self.next_states)):
+                self.next_states[i][slot] = components[i][0].to('cpu')
+            self.finals[slot] = 0
+        self.actions[slot] = action.to('cpu')
+        self.rewards[slot] = reward.to('cpu')
+        self.positions[self.writer] = (position + 1) % self.segment_len
+        self.sizes[self.writer] = min(self.sizes[self.writer].item() + 1, self.segment_len)
+
+    def sampleIndex(self, batch_size):
+        """
+        sample slots uniformly over the filled part of all the rings
+        :param batch_size: size of the mini batch
+        :return: sorted numpy array of slots, sampled with replacement
+        """
+        positions = self.positions.numpy().copy()
+        sizes = self.sizes.numpy().copy()
+        full = sizes == self.segment_len
+        # the slot at the position of a full ring may be the one its writer is overwriting
+        sizes -= full
+        ends = np.cumsum(sizes)
+        r = np.random.randint(0, ends[-1], batch_size)
+        writers = np.searchsorted(ends, r, side='right')
+        offsets = r - (ends[writers] - sizes[writers])
+        offsets = np.where(full[writers], (positions[writers] + 1 + offsets) % self.segment_len, offsets)
+        return np.sort(writers * self.segment_len + offsets)
+
+    def gather(self, idx):
+        """
+        gather the batch at the given slots
+        :param idx: numpy array of slots
+        :return: state, action, next_state, reward, final_mask, non_pad_mask
+        """
+        idx = torch.from_numpy(idx)
+        state = [s[idx] for s in self.states]
+        next_state = [s[idx] for s in self.next_states]
+        if self.tuple_state:
+            state = tuple(state)
+            next_state = tuple(next_state)
+        else:
+            state = state[0]
+            next_state = next_state[0]
+        non_pad_mask = torch.ones(len(idx), dtype=torch.uint8)
+        return state, self.actions[idx], next_state, self.rewards[idx], self.finals[idx], non_pad_mask
+
+    def sample(self, batch_size):
+        return self.gather(self.sampleIndex(batch_size))
+
+    def __len__(self):
+        return int(self.sizes.sum().item())
+
+
+class SharedPrioritizedReplayMemory(SharedReplayMemory):
+    def __init__(self, capacity, n_writers=1, example_state=None, alpha=0.6, beta=0.4, beta_steps=100000, eps=1e-6):
+        """
+        SharedReplayMemory with proportional prioritized sampling. writers push every transition with an initial
+        priority into a shared tensor, the sum tree lives in the sampling (learner) process only, which adds the new
+        slots to it on every sampleIndex call. the slot each full ring is about to overwrite is kept at priority 0
+        :param capacity: number of transitions to store
+        :param n_writers: number of processes pushing into the memory
+        :param example_state: a state (tensor or tuple of tensors, batch dim 1) to allocate the storage from
+        :param alpha: priority exponent, 0 is uniform sampling
+        :param beta: initial importance sampling exponent, annealed to 1 over beta_steps samples
+        :param beta_steps: number of sample calls to anneal beta over
+        :param eps: added to the absolute td error so no transition gets zero priority
+        """
+        SharedReplayMemory.__init__(self, capacity, n_writers, example_state)
+        self.priorities = torch.zeros(self.capacity).share_memory_()
+        self.pushed = torch.zeros(n_writers, dtype=torch.long).share_memory_()
+        self.synced = np.zeros(n_writers, dtype=np.int64)
+        self.alpha = alpha
+        self.beta = LinearSchedule(beta_steps, 1.0, beta)
+        self.eps = eps
+        self.tree = SumTree(self.capacity)
+        self.max_priority = 1.0
+        self.samples_done = 0
+
+    def push(self, state, action, next_state, reward, priority=None):
+        """
+        store one transition in the ring of self.writer
+        :param priority: initial priority (absolute td error), None for the max priority seen by the sampler
+        """
+        slot = self.writer * self.segment_len + self.positions[self.writer].item()
+        self.priorities[slot] = abs(priority) + self.eps if priority is not None else -1
+        SharedReplayMemory.push(self, state, action, next_state, reward)
+        self.pushed[self.writer] += 1
+
+    def sync(self):
+        """
+        add the slots pushed since the last call to the sum tree
+        :return: None
+        """
+        pushed = self.pushed.numpy().copy()
+        priorities = self.priorities.numpy()
+        for writer in range(self.n_writers):
+            n = min(pushed[writer] - self.synced[writer], self.segment_len)
+            if n > 0:
+                slots = writer * self.segment_len + (pushed[writer] - n + np.arange(n)) % self.segment_len
+                new = priorities[slots]
+                new = np.where(new < 0, self.max_priority, new)
+                self.tree.update(slots, new ** self.alpha)
+            if self.sizes[writer].item() == self.segment_len:
+                # the writer may be overwriting the slot at its position
+                self.tree.update([writer * self.segment_len + pushed[writer] % self.segment_len], [0.])
+        self.synced = pushed
+
+    def sampleIndex(self, batch_size):
+        """
+        sample slots proportional to their priorities, one per equal segment of the total priority
+        :param batch_size: size of the mini batch
+        :return: numpy array of slots, float tensor of importance sampling weights normalized to max 1
+        """
+        self.sync()
+        total = self.tree.total()
+        prefix_sums = (np.arange(batch_size) + np.random.random(batch_size)) * total / batch_size
+        idx = self.tree.find(prefix_sums)
+        probs = self.tree.get(idx) / total
+        # rounding can land a prefix sum on an empty leaf
+        idx = np.where(probs > 0, idx, idx[np.argmax(probs)])
+        probs = self.tree.get(idx) / total
+        weights = (len(self) * probs) ** (-self.beta.value(self.samples_done))
+        weights /= weights.max()
+        self.samples_done += 1
+        return idx, torch.from_numpy(weights).float()
+
+    def sample(self, batch_size):
+        idx, _ = self.sampleIndex(batch_size)
+        return self.gather(idx)
+
+    def updatePriorities(self, idx, td_errors):
+        """
+        set the priorities of sampled slots from their td errors
+        :param idx: numpy array of slots
+        :param td_errors: tensor of td errors
+        :return: None
+        """
+        priorities = np.abs(td_errors.detach().to('cpu').numpy()) + self.eps
+        self.max_priority = max(self.max_priority, priorities.max())
+        self.tree.update(idx, priorities ** self.alpha)
@@ -0,0 +1,235 @@
+from multiprocessing.pool import ThreadPool as Pool
+from Queue import Empty
+import time
+import copy
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from tqdm import tqdm
+
+from util.utils import LinearSchedule
+from agent.shared_memory import SharedPrioritizedReplayMemory
+from agent.syn_agent.syn_dqn_agent import ReplayMemory
+
+
+def actorEpsilon(actor_id, n_actors, eps=0.4, alpha=7.):
+    """
+    epsilon of one actor, actor i of n explores with eps ** (1 + alpha * i / (n - 1))
+    """
+    if n_actors == 1:
+        return eps
+    return eps ** (1 + alpha * float(actor_id) / (n_actors - 1))
+
+
+def pullWeights(net, shared_net, version, seen):
+    """
+    load the published weights into net if they changed since version seen. the learner makes version odd while it
+    writes, a copy that overlapped a write is dropped and retried on the next call
+    :return: version of the weights in net
+    """
+    v = version.item()
+    if v == seen or v % 2 == 1:
+        return seen
+    net.load_state_dict(shared_net.state_dict())
+    if version.item() != v:
+        return seen
+    return v
+
+
+def blockPriorities(agent, block):
+    """
+    initial priorities of a block of transitions, their td errors under the net of the actor
+    :param block: list of (state, action, next_state, reward)
+    :return: tensor of td errors
+    """
+    state, action, next_state, reward, final_mask, _ = agent.unzipMemory(
+        [ReplayMemory.makeTransition(*t) for t in block])
+    with torch.no_grad():
+        q = agent.policy_net(state).gather(1, action).squeeze(1)
+        next_q = agent.policy_net(next_state).max(1)[0]
+    next_q[final_mask] = 0
+    return reward + agent.gamma * next_q - q
+
+
+def runActor(agent, actor_id, make_envs, eps, shared_net, version, stats, stopped, block_size, max_episode_steps):
+    """
+    body of one actor process, forked from the learner. acts in its own envs with a cpu copy of the policy net until
+    stopped is set, pushes transitions in blocks into the ring actor_id of the shared memory and reports every
+    finished episode to stats as (actor_id, total reward, length, env steps since the last report)
+    """
+    torch.set_num_threads(1)
+    agent.envs = make_envs(actor_id)
+    agent.n_env = len(agent.envs)
+    agent.pool = Pool(agent.n_env)
+    agent.vec_env = None
+    agent.device = torch.device('cpu')
+    agent.policy_net = copy.deepcopy(shared_net)
+    agent.exploration = LinearSchedule(1, eps, eps)
+    if agent.state_padding is not None:
+        agent.state_padding = agent.state_padding.to('cpu')
+    agent.memory.setWriter(actor_id)
+
+    seen = -1
+    block = []
+    steps = 0
+    while not stopped.is_set():
+        r_total = [0 for _ in range(agent.n_env)]
+        states = agent.resetEnv()
+        for step in range(1, max_episode_steps + 1):
+            seen = pullWeights(agent.policy_net, shared_net, version, seen)
+            actions = agent.selectAction(states)
+            rets = agent.takeAction(actions.view(-1).tolist())
+            actions = list(actions.split(1))
+            obs_s, rs, dones, infos = zip(*rets)
+            next_states = agent.getStateFromObs(obs_s)
+            steps += len(agent.alive_idx)
+            # the step limit cuts the running episodes, their last transitions keep their next states
+            cut = step == max_episode_steps
+
+            for i, idx in enumerate(copy.copy(agent.alive_idx)):
+                r_total[idx] += rs[i]
+                block.append((states[idx], actions[idx], next_states[i] if not dones[i] else None,
+                              torch.tensor([rs[i]], dtype=torch.float)))
+                if dones[i] or cut:
+                    agent.alive_idx.remove(idx)
+                    stats.put((actor_id, r_total[idx], step, steps))
+                    steps = 0
+                    next_states[i] = None
+
+            if len(block) >= block_size:
+                priorities = blockPriorities(agent, block).tolist()
+                for transition, priority in zip(block, priorities):
+                    agent.memory.push(*(transition + (priority,)))
+                block = []
+
+            if len(agent.alive_idx) == 0 or stopped.is_set():
+                break
+            states = filter(lambda x: x is not None, next_states)
+            for i in range(agent.n_env):
+                if i not in agent.alive_idx:
+                    states.insert(i, agent.state_padding)
+
+
+class ApexTrainer(object):
+    def __init__(self, agent, make_envs, n_actors, example_state=None, eps=0.4, eps_alpha=7., block_size=50,
+                 publish_freq=100):
+        """
+        ape-x style training on one machine. n_actors processes step their own envs with a copy of the policy net
+        and their own epsilon, and push blocks of transitions with initial priorities into a shared prioritized
+        memory. the learner (this process) trains agent continuously, updates the priorities of the transitions it
+        samples and publishes its weights to the actors every publish_freq updates through a net in shared memory.
+        only feed forward agents (SynDQNAgent and its subclasses) are supported
+        :param agent: SynDQNAgent trained by the learner. the actors act with forked copies of it, so the state
+                      conversion of subclasses (getStateFromObs, _act, ...) is used as is
+        :param make_envs: function(actor_id) returning the list of envs of one actor, called in the actor process
+        :param n_actors: number of actor processes
+        :param example_state: a state (batch dim 1) to allocate the shared memory from, agent.state_padding if None
+        :param eps: base epsilon of the actors
+        :param eps_alpha: spread of the epsilons of the actors
+        :param block_size: number of transitions an actor buffers before it computes their priorities and pushes them
+        :param publish_freq: number of learner updates between two weight publications
+        """
+        if example_state is None:
+            example_state = agent.state_padding
+        assert example_state is not None, 'the shared memory needs an example_state'
+        self.agent = agent
+        self.make_envs = make_envs
+        self.n_actors = n_actors
+        self.epsilons = [actorEpsilon(i, n_actors, eps, eps_alpha) for i in range(n_actors)]
+        self.block_size = block_size
+        self.publish_freq = publish_freq
+        agent.memory = SharedPrioritizedReplayMemory(agent.memory.capacity, n_actors,
+                                                     map(lambda x: x.to('cpu'), example_state)
+                                                     if type(example_state) is tuple else example_state.to('cpu'))
+        # the actors push from other processes, the memory is saved whole
+        agent.replay_log = None
+        agent.log_replay = False
+        self.shared_net = copy.deepcopy(agent.policy_net).to('cpu')
+        self.shared_net.share_memory()
+        self.version = torch.zeros(1, dtype=torch.long).share_memory_()
+        self.updates = 0
+        self.actors = []
+        self.stats = None
+        self.stopped = None
+
+    def publish(self):
+        """
+        copy the weights of the policy net to the shared net read by the actors
+        :return: None
+        """
+        self.version += 1
+        for shared, param in zip(self.shared_net.state_dict().values(), self.agent.policy_net.state_dict().values()):
+            shared.copy_(param)
+        self.version += 1
+
+    def startActors(self, max_episode_steps):
+        self.publish()
+        self.stats = mp.Queue()
+        self.stopped = mp.Event()
+        self.actors = []
+        for i in range(self.n_actors):
+            actor = mp.Process(target=runActor,
+                               args=(self.agent, i, self.make_envs, self.epsilons[i], self.shared_net, self.version,
+                                     self.stats, self.stopped, self.block_size, max_episode_steps))
+            actor.daemon = True
+            actor.start()
+            self.actors.append(actor)
+
+    def stopActors(self):
+        self.stopped.set()
+        for actor in self.actors:
+            actor.join(10)
+            if actor.is_alive():
+                actor.terminate()
+        self.actors = []
+
+    def collectStats(self, save_freq):
+        """
+        record the episodes the actors finished since the last call
+        :return: None
+        """
+        agent = self.agent
+        while True:
+            try:
+                actor_id, r_total, length, steps = self.stats.get_nowait()
+            except Empty:
+                return
+            agent.episodes_done += 1
+            agent.steps_done += steps
+            agent.episode_rewards.append(r_total)
+            agent.episode_lengths.append(length)
+            if agent.episodes_done % save_freq == 0:
+                tqdm.write('------Episode {}, avg reward of the last {}: {}, steps done: {}, updates: {}------'
+                           .format(agent.episodes_done, save_freq, np.average(agent.episode_rewards[-save_freq:]),
+                                   agent.steps_done, self.updates))
+                agent.saveCheckpoint()
+
+    def train(self, num_episodes, max_episode_steps=100, save_freq=100):
+        """
+        train until the actors finished num_episodes episodes
+        :param num_episodes: number of episodes over all the actors
+        :param max_episode_steps: maximum length of one episode
+        :param save_freq: number of episodes between two checkpoints
+        :return: None
+        """
+        agent = self.agent
+        self.startActors(max_episode_steps)
+        try:
+            while agent.episodes_done < num_episodes:
+                self.collectStats(save_freq)
+                if len(agent.memory) < agent.min_mem:
+                    time.sleep(0.01)
+                    continue
+                agent.optimizeModel()
+                self.updates += 1
+                if self.updates % agent.target_update == 0:
+                    agent.updateTargetNet()
+                if self.updates % self.publish_freq == 0:
+                    self.publish()
+        finally:
+            self.stopActors()
+            agent.stopPrefetcher()
+        agent.saveCheckpoint()
+        agent.stopCheckpointWriter()
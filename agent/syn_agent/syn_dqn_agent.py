@@ -1,5 +1,6 @@
 from collections import namedtuple, deque
 from multiprocessing.pool import ThreadPool as Pool
+import threading
 import random
 import time
 import os
@@ -17,6 +18,16 @@ import gym
 import sys
 sys.path.append('../..')
 from util.utils import *
+from util.segment_tree import SumTree
+from agent.mmap_memory import MmapStorage, MmapReplayMemory
+from agent.shared_memory import SharedReplayMemory, SharedPrioritizedReplayMemory
+from agent.compressed_memory import CompressedStorage, CompressedReplayMemory
+from agent.replay_log import ReplayLog
+from agent.prefetcher import BatchPrefetcher
+from agent.checkpoint_writer import CheckpointWriter, snapshot
+from agent.fast_checkpoint import fastPath, hasArrayStorage, loadMetrics, loadModelState, loadReplay
+from agent.target_cache import TargetCache
+from agent.syn_agent.vec_env import SubprocVecEnv
 from gym_test.wrapper import wrap_dqn
 
 Transition = namedtuple('Transition', ('state', 'action', 'next_state', 'reward', 'final_mask', 'pad_mask'))
@@ -28,6 +39,14 @@ class ReplayMemory:
         self.capacity = capacity
 
     def push(self, *args):
+        self.memory.append(self.makeTransition(*args))
+
+    @staticmethod
+    def makeTransition(*args):
+        """
+        move the input tensors to cpu and pack them into a Transition
+        :return: Transition
+        """
         state, action, next_state, reward = args
         if type(state) is tuple:
             state = map(lambda x: x.to('cpu'), state)
@@ -46,7 +65,7 @@ class ReplayMemory:
         action = action.to('cpu')
         reward = reward.to('cpu')
 
-        self.memory.append(Transition(state, action, next_state, reward, final_mask, 0))
+        return Transition(state, action, next_state, reward, final_mask, 0)
 
     def sample(self, batch_size):
         return random.sample(self.memory, batch_size)
@@ -55,9 +74,90 @@ class ReplayMemory:
         return len(self.memory)
 
 
+class PrioritizedReplayMemory(ReplayMemory):
+    def __init__(self, capacity, alpha=0.6, beta=0.4, beta_steps=100000, eps=1e-6):
+        """
+        proportional prioritized replay, transitions are kept in a ring list indexed by a sum tree
+        :param capacity: number of transitions to store
+        :param alpha: priority exponent, 0 is uniform sampling
+        :param beta: initial importance sampling exponent, annealed to 1 over beta_steps samples
+        :param beta_steps: number of sample calls to anneal beta over
+        :param eps: added to the absolute td error so no transition gets zero priority
+        """
+        ReplayMemory.__init__(self, capacity)
+        self.memory = []
+        self.position = 0
+        self.alpha = alpha
+        self.beta = LinearSchedule(beta_steps, 1.0, beta)
+        self.eps = eps
+        self.tree = SumTree(capacity)
+        self.max_priority = 1.0
+        self.samples_done = 0
+
+    def push(self, *args):
+        if len(self.memory) < self.capacity:
+            self.memory.append(None)
+        self.memory[self.position] = self.makeTransition(*args)
+        self.tree.update([self.position], [self.max_priority ** self.alpha])
+        self.position = (self.position + 1) % self.capacity
+
+    def sampleIndex(self, batch_size):
+        """
+        sample slots proportional to their priorities, one per equal segment of the total priority
+        :param batch_size: size of the mini batch
+        :return: numpy array of slots, float tensor of importance sampling weights normalized to max 1
+        """
+        total = self.tree.total()
+        prefix_sums = (np.arange(batch_size) + np.random.random(batch_size)) * total / batch_size
+        idx = np.minimum(self.tree.find(prefix_sums), len(self.memory) - 1)
+        probs = self.tree.get(idx) / total
+        weights = (len(self.memory) * probs) ** (-self.beta.value(self.samples_done))
+        weights /= weights.max()
+        self.samples_done += 1
+        return idx, torch.from_numpy(weights).float()
+
+    def gather(self, idx):
+        return [self.memory[i] for i in idx]
+
+    def sample(self, batch_size):
+        idx, _ = self.sampleIndex(batch_size)
+        return self.gather(idx)
+
+    def updatePriorities(self, idx, td_errors):
+        """
+        set the priorities of sampled slots from their td errors
+        :param idx: numpy array of slots
+        :param td_errors: tensor of td errors
+        :return: None
+        """
+        priorities = np.abs(td_errors.detach().to('cpu').numpy()) + self.eps
+        self.max_priority = max(self.max_priority, priorities.max())
+        self.tree.update(idx, priorities ** self.alpha)
+
+
 class SynDQNAgent:
     def __init__(self, model, envs, exploration,
-                 gamma=0.99, memory_size=100000, batch_size=64, target_update_frequency=1000, saving_dir=None, min_mem=1000):
+                 gamma=0.99, memory_size=100000, batch_size=64, target_update_frequency=1000, saving_dir=None, min_mem=1000,
+                 memory_type='list', prefetch=0, env_workers=0, auto_reset=False, target_cache=False,
+                 macro_batch=1):
+        """
+        :param memory_type: 'list', 'prioritized', 'mmap', 'shared', 'shared_prioritized' or 'compressed'
+        :param prefetch: number of mini batches assembled ahead in a background thread
+        :param env_workers: number of processes stepping the envs, 0 steps them in a thread pool of this process
+        :param auto_reset: reset every env as soon as its episode ends instead of waiting for all the envs, see
+                           trainSteps
+        :param target_cache: cache the max target q value of every memory slot until the next target update, see
+                             TargetCache. needs the 'prioritized', 'mmap' or 'compressed' memory, the slots of the
+                             others are not stable or are written by other processes
+        :param macro_batch: run the updates in groups of macro_batch every macro_batch vector steps, which keeps one
+                            update per step. the mini batches of a group are sampled together and the target net
+                            evaluates all of them in one forward, see optimizeMacroBatch
+        """
+        assert not target_cache or memory_type in ('prioritized', 'mmap', 'compressed'), \
+            'target_cache needs the prioritized, mmap or compressed memory'
+        # a prefetched batch may be sampled before its slots are overwritten, its values would be cached for the new
+        # transitions
+        assert not (target_cache and prefetch > 0), 'target_cache does not work with prefetch'
 
         self.exploration = exploration
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -75,8 +175,43 @@ class SynDQNAgent:
         self.n_env = len(envs) if envs is not None else 1
         self.alive_idx = [i for i in range(self.n_env)]
         self.pool = Pool(self.n_env)
-
-        self.memory = ReplayMemory(memory_size)
+        self.vec_env = None
+        if envs is not None and env_workers > 0:
+            self.vec_env = SubprocVecEnv(envs, self._act, self._reset, env_workers)
+
+        if memory_type == 'prioritized':
+            self.memory = PrioritizedReplayMemory(memory_size)
+        elif memory_type == 'mmap':
+            assert saving_dir is not None, 'mmap memory needs a saving_dir'
+            self.memory = MmapReplayMemory(memory_size, os.path.join(saving_dir, 'memory'))
+        elif memory_type == 'shared':
+            self.memory = SharedReplayMemory(memory_size)
+        elif memory_type == 'shared_prioritized':
+            self.memory = SharedPrioritizedReplayMemory(memory_size)
+        elif memory_type == 'compressed':
+            self.memory = CompressedReplayMemory(memory_size)
+        else:
+            self.memory = ReplayMemory(memory_size)
+        # the memory mapped files already persist the mmap memory
+        self.replay_log = None
+        self.log_replay = memory_type != 'mmap'
+        self.memory_lock = threading.Lock()
+        self.target_cache = TargetCache(memory_size) if target_cache else None
+        self.prefetch = prefetch
+        self.prefetcher = None
+        self.batch_wait_time = 0.
+        self.macro_batch = macro_batch
+        self.pending_updates = 0
+        # checkpoint options, see CheckpointWriter. async_checkpoint snapshots the state and leaves serialization and
+        # writing to a background thread
+        self.async_checkpoint = False
+        self.keep_last = None
+        self.keep_every = None
+        self.checkpoint_writer = None
+        self.checkpoint_block_times = []
+        # 'pth' for checkpoint and memory .pth.tar files, 'fast' for the memory mappable layout of saveFastCheckpoint,
+        # which needs a memory with array storage (not 'list' or 'prioritized')
+        self.checkpoint_format = 'pth'
         self.batch_size = batch_size
         self.gamma = gamma
         self.target_update = target_update_frequency
@@ -87,11 +222,33 @@ class SynDQNAgent:
         self.saving_dir = saving_dir
 
         self.state = None
+        self.auto_reset = auto_reset
+        # continuous mode: current states, and steps and total reward of the running episode of every env
+        self.states = None
+        self.env_steps = [0 for _ in range(self.n_env)]
+        self.env_rewards = [0 for _ in range(self.n_env)]
         self.min_mem = min_mem
         self.state_padding = None
+        # recurrent agents run the policy net on every step to carry their hidden state, even for random actions
+        self.recurrent = False
+        # batch of the last getStateFromObs call and its rows, and the reused input buffer of getStateInputTensor
+        self.obs_batch = None
+        self.obs_views = None
+        self.input_buffer = None
 
         if envs is not None and hasattr(envs[0].observation_space, 'shape'):
-            self.state_padding = torch.zeros(self.envs[0].observation_space.shape, device=self.device).unsqueeze(0)
+            space = self.envs[0].observation_space
+            dtype = self.stateDtype(np.dtype(getattr(space, 'dtype', np.float32)))
+            self.state_padding = torch.from_numpy(np.zeros((1,) + space.shape, dtype=dtype)).to(self.device)
+
+    @staticmethod
+    def stateDtype(dtype):
+        """
+        :param dtype: numpy dtype of the observations
+        :return: numpy dtype of the states, uint8 observations (images) stay uint8 for the model to convert, the
+                 others become float32
+        """
+        return dtype if dtype == np.uint8 else np.dtype(np.float32)
 
     def getAliveEnvs(self):
         return [self.envs[idx] for idx in self.alive_idx]
@@ -102,33 +259,90 @@ class SynDQNAgent:
             return q_values
 
     def getStateInputTensor(self, states):
-        states_tensor = torch.cat(states)
-        return states_tensor
+        """
+        :param states: list of states (batch dim 1)
+        :return: the states as one batch. when they are the rows of the last getStateFromObs batch, that batch is
+                 returned as is, otherwise they are copied into a buffer reused across steps
+        """
+        if self.obs_views is not None and len(states) == len(self.obs_views) and \
+                all(s is v for s, v in zip(states, self.obs_views)):
+            return self.obs_batch
+        shape = (len(states),) + tuple(states[0].shape[1:])
+        if self.input_buffer is None or tuple(self.input_buffer.shape) != shape or \
+                self.input_buffer.dtype != states[0].dtype or self.input_buffer.device != states[0].device:
+            self.input_buffer = torch.empty(shape, dtype=states[0].dtype, device=states[0].device)
+        return torch.cat(states, out=self.input_buffer)
 
     def selectAction(self, states, require_q=False):
+        """
+        epsilon greedy actions for all the states with one forward pass, one argmax and one randint over the batch
+        :param states: list of states (batch dim 1)
+        :param require_q: also return the q values of the selected actions
+        :return: long tensor of actions, n x 1, and with require_q a tensor of their q values, n
+        """
+        e = self.exploration.value(self.steps_done)
+        explore = torch.rand(len(states), 1) < e
+        random_actions = self.randomActions(len(states))
+        if not self.recurrent and bool(explore.all()):
+            # only random actions, no forward pass, the q values are nan
+            if require_q:
+                return random_actions, torch.full((len(states),), float('nan'), device=self.device)
+            return random_actions
         states_tensor = self.getStateInputTensor(states)
         output = self.forwardPolicyNet(states_tensor)
-        actions = []
-        q_values = []
-        for i in range(len(states)):
-            e = self.exploration.value(self.steps_done)
-            if random.random() > e:
-                action = output[i].max(0)[1].view(1, 1)
-            else:
-                if hasattr(self.envs[0], 'nA'):
-                    action_space = self.envs[0].nA
-                else:
-                    action_space = self.envs[0].action_space.n
-                action = torch.tensor([[random.randrange(action_space)]], device=self.device, dtype=torch.long)
-            q_value = output[i].unsqueeze(0).gather(1, action).item()
-            actions.append(action)
-            q_values.append(q_value)
+        greedy = output.max(1)[1].unsqueeze(1)
+        actions = torch.where(explore.to(greedy.device), random_actions.to(greedy.device), greedy)
         if require_q:
-            return actions, q_values
+            return actions, output.gather(1, actions).squeeze(1)
         else:
             return actions
 
+    def randomActions(self, n):
+        """
+        :param n: number of actions
+        :return: long tensor of uniform random actions, n x 1
+        """
+        if hasattr(self.envs[0], 'nA'):
+            action_space = self.envs[0].nA
+        else:
+            action_space = self.envs[0].action_space.n
+        return torch.randint(action_space, (n, 1), device=self.device, dtype=torch.long)
+
+    def timeForward(self, states, n=10):
+        """
+        :param states: list of states
+        :param n: number of timed calls
+        :return: mean time of one forward pass on the batch of states in seconds. a recurrent state is left as it
+                 was
+        """
+        hidden = getattr(self, 'hidden', None)
+        start = time.time()
+        for _ in range(n):
+            self.forwardPolicyNet(self.getStateInputTensor(states))
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize()
+        elapsed = (time.time() - start) / n
+        if hasattr(self, 'hidden'):
+            self.hidden = hidden
+        return elapsed
+
     def unzipMemory(self, memory):
+        """
+        build the batch tensors on self.device
+        :param memory: list of Transition, or a batch already gathered by an array based memory
+        :return: state, action, next_state, reward, final_mask, non_pad_mask
+        """
+        if type(memory) is tuple:
+            batch = []
+            for x in memory:
+                if x is None:
+                    batch.append(None)
+                elif type(x) is tuple:
+                    batch.append(tuple(map(lambda y: y.to(self.device), x)))
+                else:
+                    batch.append(x.to(self.device))
+            return tuple(batch)
+
         padding = self.state_padding
 
         mini_batch = Transition(*zip(*memory))
@@ -146,24 +360,128 @@ class SynDQNAgent:
 
         return state, action, next_state, reward, final_mask, non_pad_mask
 
+    def assembleBatch(self):
+        """
+        sample and collate one mini batch
+        :return: output of unzipMemory, sampled index and importance sampling weights (None for uniform memories)
+        """
+        idx = weights = None
+        with self.memory_lock:
+            if isinstance(self.memory, (PrioritizedReplayMemory, SharedPrioritizedReplayMemory)):
+                idx, weights = self.memory.sampleIndex(self.batch_size)
+                mini_memory = self.memory.gather(idx)
+            elif self.target_cache is not None:
+                idx = self.memory.sampleIndex(self.batch_size)
+                mini_memory = self.memory.gather(idx)
+            else:
+                mini_memory = self.memory.sample(self.batch_size)
+        return self.unzipMemory(mini_memory), idx, weights
+
+    def nextBatch(self):
+        """
+        get the next mini batch, from the prefetcher if self.prefetch > 0. the time the learner spends here is
+        added to self.batch_wait_time
+        :return: output of assembleBatch
+        """
+        start = time.time()
+        if self.prefetch > 0:
+            if self.prefetcher is None:
+                self.prefetcher = BatchPrefetcher(self.assembleBatch, self.prefetch)
+            batch = self.prefetcher.get()
+        else:
+            batch = self.assembleBatch()
+        self.batch_wait_time += time.time() - start
+        return batch
+
+    def stopPrefetcher(self):
+        """
+        stop the prefetch thread, it is restarted by the next nextBatch call
+        :return: None
+        """
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+            self.prefetcher = None
+
     def optimizeModel(self):
         if len(self.memory) < self.min_mem:
             return
-        mini_memory = self.memory.sample(self.batch_size)
+        batch, idx, weights = self.nextBatch()
+        next_state_values = self.nextStateValues(idx, batch[4], batch[2])
+        self.updateModel(batch, idx, weights, next_state_values)
 
-        state_batch, action_batch, next_state_batch, reward_batch, final_mask, non_pad_mask = self.unzipMemory(mini_memory)
+    def optimizeMacroBatch(self):
+        """
+        self.macro_batch updates on mini batches sampled up front. the target net runs once on the next states of all
+        of them, it does not change between the updates of a group anyway
+        :return: None
+        """
+        if len(self.memory) < self.min_mem:
+            return
+        batches = [self.nextBatch() for _ in range(self.macro_batch)]
+        batch, idx, _ = zip(*batches)
+        next_state_batch = [b[2] for b in batch]
+        if type(next_state_batch[0]) is tuple:
+            next_state_batch = tuple(map(torch.cat, zip(*next_state_batch)))
+        else:
+            next_state_batch = torch.cat(next_state_batch)
+        final_mask = torch.cat([b[4] for b in batch])
+        idx = np.concatenate(idx) if idx[0] is not None else None
+        next_state_values = self.nextStateValues(idx, final_mask, next_state_batch)
+        for (batch, idx, weights), values in zip(batches, next_state_values.split(self.batch_size)):
+            self.updateModel(batch, idx, weights, values)
+
+    def learnStep(self):
+        """
+        the updates due after one vector step: optimizeModel, or with self.macro_batch > 1 a group of updates every
+        self.macro_batch steps
+        :return: None
+        """
+        if self.macro_batch <= 1:
+            return self.optimizeModel()
+        self.pending_updates += 1
+        if self.pending_updates >= self.macro_batch:
+            self.pending_updates = 0
+            self.optimizeMacroBatch()
+
+    def nextStateValues(self, idx, final_mask, next_state_batch):
+        """
+        max target q values of the sampled transitions
+        :param idx: numpy array of sampled slots, None for the uniform list memory
+        :param final_mask: uint8 tensor, 1 for the final transitions
+        :param next_state_batch: next states of the batch, padded for the final transitions
+        :return: float tensor on self.device, 0 for the final transitions
+        """
+        if self.target_cache is not None:
+            return self.cachedNextStateValues(idx, final_mask, next_state_batch)
+        with torch.no_grad():
+            next_state_values = self.target_net(next_state_batch).max(1)[0]
+        next_state_values[final_mask] = 0
+        return next_state_values
+
+    def updateModel(self, batch, idx, weights, next_state_values):
+        """
+        one gradient step on a mini batch
+        :param batch: output of unzipMemory
+        :param idx: sampled slots, used to update the priorities
+        :param weights: importance sampling weights, None for uniform memories
+        :param next_state_values: max target q values of the batch, see nextStateValues
+        :return: None
+        """
+        state_batch, action_batch, next_state_batch, reward_batch, final_mask, non_pad_mask = batch
 
         state_action_values = self.policy_net(state_batch)
         state_action_values = state_action_values.gather(1, action_batch).squeeze(1)
-        target_state_action_values = self.target_net(next_state_batch)
-        target_state_action_values = target_state_action_values.max(1)[0].detach()
 
-        expected_state_action_values = reward_batch
+        expected_state_action_values = reward_batch + self.gamma * next_state_values
 
-        target_state_action_values[final_mask] = 0
-        expected_state_action_values += self.gamma * target_state_action_values
-
-        loss = F.mse_loss(state_action_values[non_pad_mask], expected_state_action_values[non_pad_mask])
+        if isinstance(self.memory, (PrioritizedReplayMemory, SharedPrioritizedReplayMemory)):
+            td_errors = expected_state_action_values - state_action_values
+            weights = weights.to(self.device)
+            loss = (weights[non_pad_mask] * td_errors[non_pad_mask].pow(2)).mean()
+            with self.memory_lock:
+                self.memory.updatePriorities(idx, td_errors)
+        else:
+            loss = F.mse_loss(state_action_values[non_pad_mask], expected_state_action_values[non_pad_mask])
 
         self.optimizer.zero_grad()
         loss.backward()
@@ -171,17 +489,99 @@ class SynDQNAgent:
             param.grad.data.clamp_(-1, 1)
         self.optimizer.step()
 
+    def cachedNextStateValues(self, idx, final_mask, next_state_batch):
+        """
+        max target q values of the sampled transitions from self.target_cache, the target net only runs on the next
+        states not cached since the last target update
+        :param idx: numpy array of sampled slots
+        :param final_mask: uint8 tensor, 1 for the final transitions
+        :param next_state_batch: next states of the batch, padded for the final transitions
+        :return: float tensor on self.device, 0 for the final transitions
+        """
+        def compute(rows):
+            rows = rows.to(self.device)
+            if type(next_state_batch) is tuple:
+                x = tuple(map(lambda s: s[rows], next_state_batch))
+            else:
+                x = next_state_batch[rows]
+            with torch.no_grad():
+                return self.target_net(x).max(1)[0]
+        return self.target_cache.get(idx, 1 - final_mask, compute).to(self.device)
+
+    def updateTargetNet(self):
+        """
+        copy the policy net into the target net, the cached target values go stale with it
+        :return: None
+        """
+        self.target_net.load_state_dict(self.policy_net.state_dict())
+        if self.target_cache is not None:
+            self.target_cache.invalidate()
+
     @staticmethod
     def _reset(env):
         return env.reset()
 
     def getStateFromObs(self, obss):
-        states = map(lambda x: torch.tensor(x, device=self.device, dtype=torch.float).unsqueeze(0)
-                     if x is not None else self.state_padding, obss)
+        """
+        convert observations into states with one copy into a numpy batch and one transfer to self.device. the
+        states are row views of the batch, which getStateInputTensor then passes to the net without copying
+        :param obss: list of observations, None for padding
+        :return: list of states (batch dim 1)
+        """
+        rows = [i for i in range(len(obss)) if obss[i] is not None]
+        if len(rows) == 0:
+            return [self.state_padding for _ in obss]
+        first = np.asarray(obss[rows[0]])
+        # a new batch every step, the memory may keep the states by reference
+        batch = np.empty((len(rows),) + first.shape, dtype=self.stateDtype(first.dtype))
+        for j, i in enumerate(rows):
+            batch[j] = obss[i]
+        batch = torch.from_numpy(batch).to(self.device)
+        if self.state_padding is None or self.state_padding.dtype != batch.dtype or \
+                tuple(self.state_padding.shape[1:]) != first.shape:
+            # the observation space may declare another dtype than the observations have, e.g. float32 for LazyFrames
+            self.state_padding = torch.zeros((1,) + first.shape, dtype=batch.dtype, device=self.device)
+        views = list(batch.split(1))
+        if len(rows) == len(obss):
+            self.obs_batch = batch
+            self.obs_views = views
+            return views
+        states = [self.state_padding for _ in obss]
+        for j, i in enumerate(rows):
+            states[i] = views[j]
         return states
 
+    def resetObs(self):
+        """
+        reset all the envs
+        :return: list of observations
+        """
+        if self.vec_env is not None:
+            return self.vec_env.reset(range(self.n_env))
+        return self.pool.map(self._reset, self.envs)
+
+    def resetEnvs(self, idx):
+        """
+        reset some of the envs
+        :param idx: list of env indexes
+        :return: list of their states
+        """
+        if self.vec_env is not None:
+            obss = self.vec_env.reset(idx)
+        else:
+            obss = self.pool.map(self._reset, [self.envs[i] for i in idx])
+        return self.getStateFromObs(obss)
+
+    def onEnvsReset(self, idx):
+        """
+        called in continuous mode after the given envs were reset, for per env state of subclasses
+        :param idx: list of env indexes
+        :return: None
+        """
+        pass
+
     def resetEnv(self):
-        obss = self.pool.map(self._reset, self.envs)
+        obss = self.resetObs()
         self.alive_idx = [i for i in range(self.n_env)]
         states = self.getStateFromObs(obss)
         return states
@@ -198,10 +598,19 @@ class SynDQNAgent:
             alive_envs.append(self.envs[idx])
             alive_actions.append(actions[idx])
         # alive_envs = self.getAliveEnvs()
+        if self.vec_env is not None:
+            return self.vec_env.step(zip(self.alive_idx, alive_actions))
         rets = self.pool.map(self._act, (zip(alive_envs, alive_actions)))
         return rets
 
-    def pushMemory(self, states, actions, next_states, rewards, dones):
+    def pushMemory(self, states, actions, next_states, rewards, dones, cuts=None):
+        """
+        push the transitions of the alive envs into the memory and the replay log
+        :param dones: list, True where the episode ended, the transition is final
+        :param cuts: optional list, True where the episode was ended by a step limit without being done, the
+                     transition keeps its next state
+        :return: None
+        """
         for i in range(len(self.alive_idx)):
             state = states[i]
             action = actions[i]
@@ -210,19 +619,42 @@ class SynDQNAgent:
             done = dones[i]
             if done:
                 next_state = None
-            self.memory.push(state, action, next_state, reward)
+            with self.memory_lock:
+                if self.target_cache is not None:
+                    self.target_cache.evict(self.memory.position)
+                self.memory.push(state, action, next_state, reward)
+            self.logRecord((state, action, next_state, reward))
+
+    def logRecord(self, record, n=1):
+        """
+        append a pushed record to self.replay_log. the log is created at the first push if self.saving_dir is set
+        and self.log_replay is on. a log that missed pushes could not rebuild the memory, so a run that pushed
+        without a log keeps none and its checkpoints save the memory itself
+        :param record: arguments of one push, see pushRecord
+        :param n: number of transitions in the record
+        :return: None
+        """
+        if self.replay_log is None:
+            if self.saving_dir is None or not self.log_replay:
+                self.log_replay = False
+                return
+            self.replay_log = ReplayLog(self.memory.capacity)
+        self.replay_log.append(record, n, self.saving_dir, self.getCheckpointWriter())
 
     def trainOneEpisode(self, num_episodes, max_episode_steps=100, save_freq=100):
+        if self.auto_reset:
+            return self.trainSteps(num_episodes, max_episode_steps, save_freq)
         r_total = [0 for _ in range(self.n_env)]
         states = self.resetEnv()
         with trange(1, max_episode_steps + 1, leave=False) as t:
             for step in t:
                 actions, qs = self.selectAction(states, True)
-                rets = self.takeAction(map(lambda x: x.item(), actions))
+                rets = self.takeAction(actions.view(-1).tolist())
                 obs_s, rs, dones, infos = zip(*rets)
 
                 next_states = self.getStateFromObs(obs_s)
-                rewards = map(lambda x: torch.tensor([x], device=self.device, dtype=torch.float), rs)
+                rewards = list(torch.tensor(rs, device=self.device, dtype=torch.float).split(1))
+                actions = list(actions.split(1))
                 self.steps_done += len(self.alive_idx)
 
                 alive_states = [states[idx] for idx in self.alive_idx]
@@ -242,9 +674,9 @@ class SynDQNAgent:
 
                 t.set_postfix_str('step={}, total_reward={}'.format(step, map(lambda x: round(x, 2), r_total)))
 
-                self.optimizeModel()
+                self.learnStep()
                 if self.steps_done % self.target_update < self.n_env:
-                    self.target_net.load_state_dict(self.policy_net.state_dict())
+                    self.updateTargetNet()
                 if len(self.alive_idx) == 0 or step == max_episode_steps:
                     tqdm.write('------Episode {} ended, total reward: {}, step: {}------' \
                                .format(self.episodes_done, r_total, step))
@@ -259,6 +691,118 @@ class SynDQNAgent:
                     if i not in self.alive_idx:
                         states.insert(i, self.state_padding)
 
+    def trainSteps(self, num_episodes, max_episode_steps=100, save_freq=100):
+        """
+        continuous mode: step all the envs max_episode_steps times and reset every env as soon as its episode ends,
+        so the action batch stays full width. the running episodes carry over to the next call
+        :param num_episodes: stop early once this many episodes are done
+        :param max_episode_steps: number of steps of this call, and maximum length of one episode
+        :param save_freq: number of episodes between two checkpoints
+        :return: None
+        """
+        if self.states is None:
+            self.states = self.resetEnv()
+            self.env_steps = [0 for _ in range(self.n_env)]
+            self.env_rewards = [0 for _ in range(self.n_env)]
+            self.onEnvsReset(range(self.n_env))
+        self.alive_idx = [i for i in range(self.n_env)]
+        with trange(1, max_episode_steps + 1, leave=False) as t:
+            for _ in t:
+                actions, qs = self.selectAction(self.states, True)
+                rets = self.takeAction(actions.view(-1).tolist())
+                obs_s, rs, dones, infos = zip(*rets)
+
+                next_states = self.getStateFromObs(obs_s)
+                rewards = list(torch.tensor(rs, device=self.device, dtype=torch.float).split(1))
+                actions = list(actions.split(1))
+                self.steps_done += self.n_env
+
+                cuts = []
+                for i in range(self.n_env):
+                    self.env_steps[i] += 1
+                    self.env_rewards[i] += rs[i]
+                    cuts.append(not dones[i] and self.env_steps[i] >= max_episode_steps)
+                self.pushMemory(self.states, actions, next_states, rewards, dones, cuts)
+
+                finished = [i for i in range(self.n_env) if dones[i] or cuts[i]]
+                for i in finished:
+                    self.episode_rewards.append(self.env_rewards[i])
+                    self.episode_lengths.append(self.env_steps[i])
+                    self.episodes_done += 1
+                    tqdm.write('------Episode {} ended in env {}, total reward: {}, step: {}, total steps done: {}------'
+                               .format(self.episodes_done, i, self.env_rewards[i], self.env_steps[i], self.steps_done))
+                    self.env_steps[i] = 0
+                    self.env_rewards[i] = 0
+                    if self.episodes_done % save_freq == 0:
+                        self.saveCheckpoint()
+
+                t.set_postfix_str('total_reward={}'.format(map(lambda x: round(x, 2), self.env_rewards)))
+
+                self.learnStep()
+                if self.steps_done % self.target_update < self.n_env:
+                    self.updateTargetNet()
+
+                if len(finished) > 0:
+                    for i, state in zip(finished, self.resetEnvs(finished)):
+                        next_states[i] = state
+                    self.onEnvsReset(finished)
+                self.states = next_states
+                if self.episodes_done >= num_episodes:
+                    break
+
+    def warmUp(self, n_steps=None, max_episode_steps=100):
+        """
+        fill the memory with uniform random actions before training, without any forward pass of the policy net.
+        all the envs step together, in the thread pool or in the env worker processes, and are reset as soon as
+        their episode ends. an episode ended by max_episode_steps or by the last step is cut, not final: its last
+        transition keeps its next state. the steps count into steps_done, the episodes are not recorded
+        :param n_steps: number of transitions to collect, by default what the memory lacks for min_mem
+        :param max_episode_steps: maximum length of one episode
+        :return: dict with the number of transitions, the time taken and the estimated time saved in seconds
+        """
+        if n_steps is None:
+            n_steps = max(self.min_mem - len(self.memory), 0)
+        start = time.time()
+        n = 0
+        n_batches = 0
+        states = self.resetEnv()
+        env_steps = [0 for _ in range(self.n_env)]
+        with tqdm(total=n_steps, leave=False) as t:
+            while n < n_steps:
+                actions = self.randomActions(self.n_env)
+                rets = self.takeAction(actions.view(-1).tolist())
+                obs_s, rs, dones, infos = zip(*rets)
+                next_states = self.getStateFromObs(obs_s)
+                rewards = list(torch.tensor(rs, device=self.device, dtype=torch.float).split(1))
+                n += self.n_env
+                n_batches += 1
+                cuts = []
+                for i in range(self.n_env):
+                    env_steps[i] += 1
+                    cuts.append(not dones[i] and (env_steps[i] >= max_episode_steps or n >= n_steps))
+                self.pushMemory(states, list(actions.split(1)), next_states, rewards, dones, cuts)
+                t.update(self.n_env)
+
+                finished = [i for i in range(self.n_env) if dones[i] or cuts[i]]
+                if n < n_steps and len(finished) > 0:
+                    for i, state in zip(finished, self.resetEnvs(finished)):
+                        next_states[i] = state
+                        env_steps[i] = 0
+                states = next_states
+        elapsed = time.time() - start
+        self.steps_done += n
+        # continuous mode starts new episodes
+        self.states = None
+        forward_time = self.timeForward(states) if n > 0 else 0.
+        stats = {
+            'transitions': n,
+            'time': elapsed,
+            'saved': n_batches * forward_time
+        }
+        tqdm.write('------Warm up: {transitions} transitions in {time:.1f}s, about {saved:.1f}s saved------'
+                   .format(**stats))
+        return stats
+
     def train(self, num_episodes, max_episode_steps=100, save_freq=100):
         """
         train the network for given number of episodes
@@ -269,7 +813,9 @@ class SynDQNAgent:
         """
         while self.episodes_done < num_episodes:
             self.trainOneEpisode(num_episodes, max_episode_steps, save_freq)
+        self.stopPrefetcher()
         self.saveCheckpoint()
+        self.stopCheckpointWriter()
 
     def getSavingState(self):
         state = {
@@ -285,20 +831,62 @@ class SynDQNAgent:
 
     def saveCheckpoint(self):
         """
-        save checkpoint in self.saving_dir
+        save checkpoint in self.saving_dir through self.checkpoint_writer. the time training was blocked is appended
+        to self.checkpoint_block_times
         :return: None
         """
+        if isinstance(self.memory, CompressedStorage):
+            tqdm.write('------Replay frames: {stored_mb:.1f}MB for {raw_mb:.1f}MB raw, ratio {ratio:.1f}, '
+                       'decode {decode_ms_per_frame:.3f}ms per frame------'.format(**self.memory.compressionStats()))
         if self.saving_dir is None:
             return
+        start = time.time()
         time_stamp = time.strftime('%Y%m%d%H%M%S', time.gmtime())
-        state_filename = os.path.join(self.saving_dir, 'checkpoint.' + time_stamp + '.pth.tar')
-        mem_filename = os.path.join(self.saving_dir, 'memory.' + time_stamp + '.pth.tar')
-        state = self.getSavingState()
-        memory = {
-            'memory': self.memory
-        }
-        torch.save(state, state_filename)
-        torch.save(memory, mem_filename)
+        if self.checkpoint_format == 'fast':
+            self.saveFastCheckpoint(time_stamp)
+        else:
+            state = self.getSavingState()
+            if self.async_checkpoint:
+                state = snapshot(state)
+            refs = []
+            if self.replay_log is not None:
+                manifest = self.replay_log.write(self.saving_dir, len(self.memory), self.getCheckpointWriter())
+                memory = {
+                    'replay_log': manifest
+                }
+                refs = ReplayLog.segmentPaths(self.saving_dir, manifest)
+            elif isinstance(self.memory, MmapStorage):
+                # a copy of the mmap memory flushes the files and keeps the current ring position for the writer
+                memory = {
+                    'memory': copy.copy(self.memory) if self.async_checkpoint else self.memory
+                }
+            else:
+                with self.memory_lock:
+                    memory = {
+                        'memory': copy.deepcopy(self.memory) if self.async_checkpoint else self.memory
+                    }
+            self.getCheckpointWriter().save(time_stamp, [('checkpoint', state), ('memory', memory)], refs)
+        blocked = time.time() - start
+        self.checkpoint_block_times.append(blocked)
+        tqdm.write('------Checkpoint {}: training blocked for {:.3f}s------'.format(time_stamp, blocked))
+
+    def getCheckpointWriter(self):
+        """
+        :return: the CheckpointWriter of this run, created with the current checkpoint options on first use
+        """
+        if self.checkpoint_writer is None:
+            self.checkpoint_writer = CheckpointWriter(self.saving_dir, self.keep_last, self.keep_every,
+                                                      self.async_checkpoint)
+        return self.checkpoint_writer
+
+    def stopCheckpointWriter(self):
+        """
+        wait for the queued checkpoints and stop the writer thread, it is restarted by the next saveCheckpoint call
+        :return: None
+        """
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.stop()
+            self.checkpoint_writer = None
 
     def loadCheckpoint(self, time_stamp, data_only=False, load_memory=True):
         """
@@ -309,6 +897,11 @@ class SynDQNAgent:
         state_filename = os.path.join(self.saving_dir, 'checkpoint.' + time_stamp + '.pth.tar')
         mem_filename = os.path.join(self.saving_dir, 'memory.' + time_stamp + '.pth.tar')
 
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.wait()
+        if os.path.exists(fastPath(self.saving_dir, time_stamp)):
+            self.loadFastCheckpoint(time_stamp, data_only, load_memory)
+            return
         print 'loading checkpoint: ', time_stamp
         checkpoint = torch.load(state_filename)
         if data_only:
@@ -328,13 +921,108 @@ class SynDQNAgent:
         self.target_net.load_state_dict(checkpoint['policy_state_dict'])
         self.target_net = self.target_net.to(self.device)
         self.target_net.eval()
+        if self.target_cache is not None:
+            self.target_cache.invalidate()
 
         self.optimizer = optim.Adam(self.policy_net.parameters())
         self.optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
 
         if load_memory:
             memory = torch.load(mem_filename)
-            self.memory = memory['memory']
+            if 'replay_log' in memory:
+                self.replay_log = ReplayLog(self.memory.capacity)
+                self.replay_log.rebuild(self.saving_dir, memory['replay_log'], self.pushRecord)
+            else:
+                self.memory = memory['memory']
+                # the loaded memory is in no log
+                self.replay_log = None
+                self.log_replay = False
+
+    def saveFastCheckpoint(self, time_stamp):
+        """
+        save the checkpoint as the directory fast.time_stamp in self.saving_dir through self.checkpoint_writer, see
+        fast_checkpoint.saveFastCheckpoint. the state of getSavingState is split into the state dicts and the metrics,
+        the memory arrays are written raw. every checkpoint writes the whole memory, so resuming maps it instead of
+        replaying the log; with async_checkpoint the writer thread writes a copy. the memory needs array storage
+        :param time_stamp: time stamp for the checkpoint
+        :return: None
+        """
+        assert hasArrayStorage(self.memory), 'the fast checkpoint format needs a memory with array storage'
+        state = self.getSavingState()
+        if self.async_checkpoint:
+            state = snapshot(state)
+        model_state = dict((k, v) for k, v in state.items() if k.endswith('state_dict'))
+        metrics = dict((k, v) for k, v in state.items() if not k.endswith('state_dict'))
+        metrics['episode_rewards'] = map(float, metrics['episode_rewards'])
+        metrics['episode_lengths'] = map(int, metrics['episode_lengths'])
+        if isinstance(self.memory, MmapStorage):
+            # a copy of the mmap memory flushes the files and keeps the current ring position for the writer
+            replay = {
+                'memory': copy.copy(self.memory) if self.async_checkpoint else self.memory,
+                'replay_log': copy.deepcopy(self.replay_log) if self.async_checkpoint else self.replay_log
+            }
+        else:
+            with self.memory_lock:
+                replay = {
+                    'memory': copy.deepcopy(self.memory) if self.async_checkpoint else self.memory,
+                    'replay_log': copy.deepcopy(self.replay_log) if self.async_checkpoint else self.replay_log
+                }
+        self.getCheckpointWriter().saveFast(time_stamp, model_state, metrics, replay)
+
+    def loadFastCheckpoint(self, time_stamp, data_only=False, load_memory=True):
+        """
+        load a checkpoint saved by saveFastCheckpoint. the memory arrays are memory mapped copy on write, so resuming
+        does not read the memory and never changes the checkpoint
+        :param time_stamp: time stamp for the checkpoint
+        :return: None
+        """
+        directory = fastPath(self.saving_dir, time_stamp)
+        print 'loading fast checkpoint: ', time_stamp
+        metrics = loadMetrics(directory)
+        self.episode_rewards = metrics['episode_rewards']
+        self.episode_lengths = metrics['episode_lengths']
+        if data_only:
+            return
+        self.episodes_done = metrics['episode']
+        self.steps_done = metrics['steps']
+
+        checkpoint = loadModelState(directory, map_location=self.device)
+        self.policy_net.load_state_dict(checkpoint['policy_state_dict'])
+        self.policy_net = self.policy_net.to(self.device)
+        self.policy_net.train()
+
+        self.target_net.load_state_dict(checkpoint['target_state_dict'])
+        self.target_net = self.target_net.to(self.device)
+        self.target_net.eval()
+        if self.target_cache is not None:
+            self.target_cache.invalidate()
+
+        self.optimizer = optim.Adam(self.policy_net.parameters())
+        self.optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+
+        if load_memory:
+            replay = loadReplay(directory)
+            self.memory = replay['memory']
+            self.replay_log = replay['replay_log']
+            self.log_replay = self.replay_log is not None
+
+    def convertCheckpoint(self, time_stamp):
+        """
+        convert the checkpoint.time_stamp.pth.tar and memory.time_stamp.pth.tar checkpoint to the fast layout under the
+        same time stamp. the agent is left resumed from it
+        :param time_stamp: time stamp for the checkpoint
+        :return: None
+        """
+        self.loadCheckpoint(time_stamp)
+        self.saveFastCheckpoint(time_stamp)
+
+    def pushRecord(self, record):
+        """
+        push one record of self.replay_log into the memory
+        :param record: state, action, next_state, reward
+        :return: None
+        """
+        self.memory.push(*record)
 
 
 # class DQN(torch.nn.Module):
@@ -14,104 +14,85 @@ from syn_dqn_agent import SynDQNAgent
 
 from util.utils import *
 from gym_test.wrapper import wrap_drqn
-
-
-Transition = namedtuple('Transition', ('state', 'action', 'next_state', 'reward', 'final_mask', 'pad_mask'))
-
-
-class SliceReplayMemory:
-    def __init__(self, capacity, sequence_len):
-        self.memory = deque()
-        self.capacity = capacity
-        self.sequence_len = sequence_len
-
-    def push(self, episode):
-        self.memory.append(episode)
-        while self.__len__() > self.capacity:
-            self.memory.popleft()
-
-    def sample(self, batch_size):
-        sample = []
-        batch_size = min(batch_size, len(self.memory))
-        batch_indexes = np.random.choice(np.arange(len(self.memory)), batch_size, replace=False)
-        for batch_idx in batch_indexes:
-            episode = self.memory[batch_idx]
-            start = random.randint(0, len(episode) - self.sequence_len)
-            transitions = episode[start:start + self.sequence_len]
-            sample.append(transitions)
-        return sample
-
-    def __len__(self):
-        return sum(map(len, self.memory))
+from agent.sequence_memory import SequenceReplayMemory, PrioritizedSequenceReplayMemory, Transition, sampleSlices, \
+    sliceLoss
+from agent.mmap_memory import MmapSequenceReplayMemory
+from agent.compressed_memory import CompressedSequenceReplayMemory, CompressedPrioritizedSequenceReplayMemory
 
 
 class SynDRQNAgent(SynDQNAgent):
     def __init__(self, model, envs, exploration,
                  gamma=0.99, memory_size=100000, batch_size=64, target_update_frequency=1000, saving_dir=None,
-                 min_mem=1000, sequence_len=10):
+                 min_mem=1000, sequence_len=10, memory_type='sequence', prefetch=0, stored_state=False, burn_in=0,
+                 env_workers=0, auto_reset=False, single_pass=False, share_target_encoder=False):
+        """
+        :param memory_type: 'sequence', 'prioritized', 'mmap', 'compressed' or 'compressed_prioritized'
+        :param stored_state: store the recurrent state of the actor with every transition, and start the training
+                             slices from it instead of from zeros
+        :param burn_in: number of leading steps of every slice only used to warm up the recurrent state, they get no
+                        loss. sequence_len includes them
+        :param env_workers: number of processes stepping the envs, 0 steps them in a thread pool of this process
+        :param auto_reset: reset every env as soon as its episode ends, its recurrent state is zeroed with it
+        :param single_pass: sample the slices as sequence_len + 1 observations, stored once per frame except in the
+                            compressed memories, which share the frames already. the policy net reads them from the
+                            first step and the target net from the second
+        :param share_target_encoder: with single_pass, encode the observations once with the policy net and run the
+                                     target net on its features. the model needs encode(x) and head(features, hidden)
+        """
+        assert burn_in < sequence_len, 'burn_in has to be shorter than sequence_len'
         SynDQNAgent.__init__(self, model, envs, exploration, gamma, memory_size, batch_size, target_update_frequency,
-                             saving_dir, min_mem)
-        self.memory = SliceReplayMemory(memory_size, sequence_len)
+                             saving_dir, min_mem, prefetch=prefetch, env_workers=env_workers,
+                             auto_reset=auto_reset)
+        if memory_type == 'prioritized':
+            self.memory = PrioritizedSequenceReplayMemory(memory_size, sequence_len,
+                                                          store_next_states=not single_pass)
+        elif memory_type == 'mmap':
+            assert saving_dir is not None, 'mmap memory needs a saving_dir'
+            self.memory = MmapSequenceReplayMemory(memory_size, sequence_len, os.path.join(saving_dir, 'memory'),
+                                                   store_next_states=not single_pass)
+            self.log_replay = False
+        elif memory_type == 'compressed':
+            self.memory = CompressedSequenceReplayMemory(memory_size, sequence_len)
+        elif memory_type == 'compressed_prioritized':
+            self.memory = CompressedPrioritizedSequenceReplayMemory(memory_size, sequence_len)
+        else:
+            self.memory = SequenceReplayMemory(memory_size, sequence_len, store_next_states=not single_pass)
         self.hidden = None
         self.local_memory = [[] for _ in range(self.n_env)]
         self.sequence_len = sequence_len
+        self.stored_state = stored_state
+        self.burn_in = burn_in
+        self.actor_hidden = None
+        self.local_hiddens = [[] for _ in range(self.n_env)]
+        self.recurrent = True
+        self.single_pass = single_pass
+        self.share_target_encoder = share_target_encoder
 
     def forwardPolicyNet(self, x):
         with torch.no_grad():
             state = x.unsqueeze(1)
+            self.actor_hidden = self.hidden
             q_values, self.hidden = self.policy_net(state, self.hidden)
             q_values = q_values.squeeze(1)
             return q_values
 
-    def unzipMemory(self, memory):
-        state_batch = []
-        action_batch = []
-        next_state_batch = []
-        reward_batch = []
-        final_mask_batch = []
-        pad_mask_batch = []
-
-        padding = self.state_padding.to('cpu')
-
-        for episode in memory:
-            episode_transition = Transition(*zip(*episode))
-            state_batch.append(torch.cat([s if s is not None else padding
-                                          for s in episode_transition.state]))
-            action_batch.append(torch.cat(episode_transition.action))
-            next_state_batch.append(torch.cat([s if s is not None else padding
-                                               for s in episode_transition.next_state]))
-            reward_batch.append(torch.cat(episode_transition.reward))
-            final_mask_batch.append(torch.tensor(list(episode_transition.final_mask), dtype=torch.uint8))
-            pad_mask_batch.append(torch.tensor(list(episode_transition.pad_mask), dtype=torch.uint8))
-
-        state = torch.stack(state_batch).to(self.device)
-        action = torch.stack(action_batch).to(self.device)
-        next_state = torch.stack(next_state_batch).to(self.device)
-        reward = torch.stack(reward_batch).to(self.device)
-        final_mask = torch.stack(final_mask_batch).to(self.device)
-        pad_mask = torch.stack(pad_mask_batch)
-        non_pad_mask = 1 - pad_mask
-
-        return state, action, next_state, reward, final_mask, non_pad_mask
+    def assembleBatch(self):
+        with self.memory_lock:
+            mini_memory, slots, weights = sampleSlices(self.memory, self.batch_size, self.single_pass,
+                                                       self.stored_state)
+        return self.unzipMemory(mini_memory), slots, weights
 
     def optimizeModel(self):
         if len(self.memory) < self.min_mem:
             return
-        mini_memory = self.memory.sample(self.batch_size)
-
-        state_batch, action_batch, next_state_batch, reward_batch, final_mask, non_pad_mask = self.unzipMemory(mini_memory)
-
-        state_action_values, _ = self.policy_net(state_batch)
-        state_action_values = state_action_values.gather(2, action_batch).squeeze(2)
-        target_state_action_values, _ = self.target_net(next_state_batch)
-        target_state_action_values = target_state_action_values.max(2)[0].detach()
-
-        expected_state_action_values = reward_batch
-
-        target_state_action_values[final_mask] = 0
-        expected_state_action_values += self.gamma * target_state_action_values
-
-        loss = F.mse_loss(state_action_values[non_pad_mask], expected_state_action_values[non_pad_mask])
+        batch, slots, weights = self.nextBatch()
+        if weights is not None:
+            weights = weights.to(self.device)
+        loss, td_errors, non_pad_mask = sliceLoss(self.policy_net, self.target_net, batch, self.gamma, self.burn_in,
+                                                  self.single_pass, self.share_target_encoder, weights)
+        if slots is not None:
+            with self.memory_lock:
+                self.memory.updatePriorities(slots, td_errors, non_pad_mask)
 
         self.optimizer.zero_grad()
         loss.backward()
@@ -119,13 +100,25 @@ class SynDRQNAgent(SynDQNAgent):
             param.grad.data.clamp_(-1, 1)
         self.optimizer.step()
 
-    def pushMemory(self, states, actions, next_states, rewards, dones):
+    def actorHidden(self, idx):
+        """
+        :param idx: index of the env
+        :return: recurrent state of the actor of env idx before its last step, on cpu, None if not stored
+        """
+        if not self.stored_state or self.actor_hidden is None:
+            return None
+        if type(self.actor_hidden) is tuple:
+            return tuple(map(lambda h: h[:, idx:idx + 1].to('cpu'), self.actor_hidden))
+        return self.actor_hidden[:, idx:idx + 1].to('cpu')
+
+    def pushMemory(self, states, actions, next_states, rewards, dones, cuts=None):
         for i, idx in enumerate(self.alive_idx):
             state = states[i]
             action = actions[i]
             next_state = next_states[i]
             reward = rewards[i]
             done = dones[i]
+            cut = cuts is not None and cuts[i]
 
             if type(state) is tuple:
                 state = map(lambda x: x.to('cpu'), state)
@@ -139,24 +132,55 @@ class SynDRQNAgent(SynDQNAgent):
                     next_state = next_state.to('cpu')
             reward = reward.to('cpu')
 
-            if not done:
-                self.local_memory[idx].append(Transition(state, action, next_state, reward, 0, 0))
-            else:
-                self.local_memory[idx].append(Transition(state, action, next_state, reward, 1, 0))
-                while len(self.local_memory[idx]) < self.sequence_len:
-                    self.local_memory[idx].append(Transition(
-                        None,
-                        torch.tensor([[0]], dtype=torch.long),
-                        None,
-                        torch.tensor([0.]),
-                        0,
-                        1
-                    ))
-                self.memory.push(self.local_memory[idx])
+            self.local_memory[idx].append(Transition(state, action, next_state, reward))
+            self.local_hiddens[idx].append(self.actorHidden(idx))
+            if done or cut:
+                hiddens = self.local_hiddens[idx] if self.stored_state else None
+                with self.memory_lock:
+                    self.memory.pushEpisode(self.local_memory[idx], hiddens, cut)
+                self.logRecord((self.local_memory[idx], hiddens, cut), len(self.local_memory[idx]))
                 self.local_memory[idx] = []
+                self.local_hiddens[idx] = []
+
+    def pushRecord(self, record):
+        """
+        push one record of self.replay_log into the memory
+        :param record: list of Transition of one episode, list of the recurrent states of the actor or None, True if
+                       the episode was cut
+        :return: None
+        """
+        if type(record) is list:
+            # logs written before the recurrent states were stored hold bare episodes
+            record = (record, None)
+        if len(record) == 2:
+            # and logs written before the cut episodes hold only final ones
+            record += (False,)
+        episode, hiddens, cut = record
+        self.memory.pushEpisode(episode, hiddens, cut)
+
+    def onEnvsReset(self, idx):
+        """
+        zero the recurrent state of the envs that were reset
+        :param idx: list of env indexes
+        :return: None
+        """
+        if self.hidden is None:
+            return
+        idx = torch.tensor(list(idx), dtype=torch.long, device=self.device)
+        if type(self.hidden) is tuple:
+            self.hidden = tuple(map(lambda h: h.index_fill(1, idx, 0), self.hidden))
+        else:
+            self.hidden = self.hidden.index_fill(1, idx, 0)
+
+    def warmUp(self, n_steps=None, max_episode_steps=100):
+        # the random actions run no forward pass, the warm up transitions are stored with zero recurrent states
+        self.hidden = None
+        self.actor_hidden = None
+        return SynDQNAgent.warmUp(self, n_steps, max_episode_steps)
 
     def trainOneEpisode(self, num_episodes, max_episode_steps=100, save_freq=100):
-        self.hidden = None
+        if not self.auto_reset:
+            self.hidden = None
         SynDQNAgent.trainOneEpisode(self, num_episodes, max_episode_steps, save_freq)
 
 
@@ -0,0 +1,165 @@
+import multiprocessing as mp
+import traceback
+import tempfile
+import shutil
+import atexit
+import os
+
+import numpy as np
+
+
+def flattenObs(obs):
+    """
+    :param obs: observation, array like or tuple of array likes
+    :return: list of numpy arrays, None if the observation can not be written into fixed buffers
+    """
+    arrays = []
+    for x in obs if type(obs) is tuple else (obs,):
+        x = np.asarray(x)
+        if x.dtype == object or x.ndim == 0:
+            return None
+        arrays.append(x)
+    return arrays
+
+
+def _writeObs(buffers, buffer_dir, i, obs):
+    """
+    write the observation of env i into its shared buffers, (re)created when its shapes change
+    :return: ('shm', spec of the new buffers or None), or ('obs', obs) for observations sent through the pipe
+    """
+    arrays = flattenObs(obs)
+    if arrays is None:
+        return 'obs', obs
+    spec = [(x.shape, x.dtype.str) for x in arrays]
+    new = None
+    if i not in buffers or buffers[i][0] != spec:
+        paths = [os.path.join(buffer_dir, 'env%d_%d' % (i, k)) for k in range(len(arrays))]
+        buffers[i] = (spec, [np.memmap(path, dtype=x.dtype, mode='w+', shape=x.shape)
+                             for path, x in zip(paths, arrays)])
+        new = (paths, spec, type(obs) is tuple)
+    for buf, x in zip(buffers[i][1], arrays):
+        buf[...] = x
+    return 'shm', new
+
+
+def _worker(conn, envs, act, reset, buffer_dir):
+    buffers = {}
+    while True:
+        cmd, args = conn.recv()
+        if cmd == 'close':
+            break
+        try:
+            if cmd == 'reset':
+                results = [_writeObs(buffers, buffer_dir, i, reset(envs[i])) + (None, None, None) for i in args]
+            else:
+                results = []
+                for i, action in args:
+                    obs, r, done, info = act((envs[i], action))
+                    results.append(_writeObs(buffers, buffer_dir, i, obs) + (r, done, info))
+            conn.send(('ok', results))
+        except Exception:
+            conn.send(('error', traceback.format_exc()))
+    conn.close()
+
+
+class SubprocVecEnv(object):
+    def __init__(self, envs, act, reset, n_workers=None):
+        """
+        step envs in worker processes, so envs that hold the GIL run in parallel. the envs are split over n_workers
+        forked processes. commands and rewards go over pipes, the observations are written into memory mapped
+        buffers (in /dev/shm when it exists) that this process reads, so they are not pickled per step. observations
+        that are not arrays or tuples of arrays are sent through the pipe
+        :param envs: list of envs, the workers take them over when they are forked. the copies left in this process
+                     must not be reset or stepped anymore
+        :param act: function((env, action)) returning obs, reward, done, info, run in the workers
+        :param reset: function(env) returning obs, run in the workers
+        :param n_workers: number of worker processes, one per env by default
+        """
+        self.n_env = len(envs)
+        n_workers = min(n_workers or self.n_env, self.n_env)
+        self.buffer_dir = tempfile.mkdtemp(dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+        self.buffers = {}
+        self.worker_of = [i % n_workers for i in range(self.n_env)]
+        ctx = mp.get_context('fork') if hasattr(mp, 'get_context') else mp
+        self.conns = []
+        self.workers = []
+        for w in range(n_workers):
+            conn, child_conn = ctx.Pipe()
+            worker_envs = dict((i, envs[i]) for i in range(self.n_env) if self.worker_of[i] == w)
+            worker = ctx.Process(target=_worker, args=(child_conn, worker_envs, act, reset, self.buffer_dir))
+            worker.daemon = True
+            worker.start()
+            child_conn.close()
+            self.conns.append(conn)
+            self.workers.append(worker)
+        self.closed = False
+        atexit.register(self.close)
+
+    def _readObs(self, i, kind, payload):
+        if kind == 'obs':
+            return payload
+        if payload is not None:
+            paths, spec, is_tuple = payload
+            self.buffers[i] = ([np.memmap(path, dtype=np.dtype(dtype), mode='r', shape=shape)
+                                for path, (shape, dtype) in zip(paths, spec)], is_tuple)
+        buffers, is_tuple = self.buffers[i]
+        # the worker overwrites the buffers on the next step
+        arrays = [np.array(buf) for buf in buffers]
+        return tuple(arrays) if is_tuple else arrays[0]
+
+    def _run(self, cmd, items, env_of):
+        """
+        send one command to every worker concerned and collect the results in the order of items
+        """
+        by_worker = {}
+        for item in items:
+            by_worker.setdefault(self.worker_of[env_of(item)], []).append(item)
+        for w, worker_items in by_worker.items():
+            self.conns[w].send((cmd, worker_items))
+        results = {}
+        for w, worker_items in by_worker.items():
+            status, payload = self.conns[w].recv()
+            if status == 'error':
+                raise RuntimeError('env worker {} failed:\n{}'.format(w, payload))
+            for item, result in zip(worker_items, payload):
+                results[env_of(item)] = result
+        rets = []
+        for item in items:
+            i = env_of(item)
+            kind, obs_payload, r, done, info = results[i]
+            rets.append((self._readObs(i, kind, obs_payload), r, done, info))
+        return rets
+
+    def reset(self, idx):
+        """
+        :param idx: indexes of the envs to reset
+        :return: list of observations
+        """
+        return [ret[0] for ret in self._run('reset', list(idx), lambda i: i)]
+
+    def step(self, actions):
+        """
+        :param actions: list of (env index, action)
+        :return: list of (obs, reward, done, info)
+        """
+        return self._run('step', list(actions), lambda item: item[0])
+
+    def close(self):
+        """
+        stop the workers and delete the buffers
+        :return: None
+        """
+        if self.closed:
+            return
+        self.closed = True
+        for conn in self.conns:
+            try:
+                conn.send(('close', None))
+            except (IOError, OSError):
+                pass
+        for worker in self.workers:
+            worker.join(5)
+            if worker.is_alive():
+                worker.terminate()
+        self.buffers = {}
+        shutil.rmtree(self.buffer_dir, ignore_errors=True)
@@ -0,0 +1,58 @@
+import numpy as np
+import torch
+
+
+class TargetCache(object):
+    def __init__(self, capacity):
+        """
+        max target q value of every slot of a replay memory, computed the first time the slot is sampled after a
+        target net update. a value is valid while its version is the current one, so invalidate drops all of them at
+        once, and a slot is evicted when the memory overwrites it
+        :param capacity: number of slots of the memory
+        """
+        self.values = torch.zeros(capacity)
+        self.versions = torch.full((capacity,), -1, dtype=torch.long)
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+
+    def invalidate(self):
+        """
+        drop all the values, called when the target net changes
+        :return: None
+        """
+        self.version += 1
+
+    def evict(self, slot):
+        """
+        drop the value of a slot the memory is about to overwrite
+        :param slot: slot index
+        :return: None
+        """
+        self.versions[slot] = -1
+
+    def get(self, idx, non_final_mask, compute):
+        """
+        max target q values of sampled transitions, the missing ones computed in one batch
+        :param idx: numpy array or long tensor of slots
+        :param non_final_mask: uint8 tensor, 1 for the transitions with a next state
+        :param compute: function(rows) returning the max target q values of the given rows of the batch (long
+                        tensor of row indexes)
+        :return: float tensor on cpu, 0 for the final transitions
+        """
+        if isinstance(idx, np.ndarray):
+            idx = torch.from_numpy(idx)
+        idx = idx.to('cpu')
+        non_final_mask = non_final_mask.to('cpu', torch.uint8)
+        hit = (self.versions[idx] == self.version).to(torch.uint8)
+        rows = (non_final_mask * (1 - hit)).nonzero().view(-1)
+        values = self.values[idx]
+        if len(rows) > 0:
+            computed = compute(rows).to('cpu', torch.float)
+            values[rows] = computed
+            self.values[idx[rows]] = computed
+            self.versions[idx[rows]] = self.version
+        values[non_final_mask == 0] = 0
+        self.misses += len(rows)
+        self.hits += int(non_final_mask.sum()) - len(rows)
+        return values
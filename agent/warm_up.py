@@ -0,0 +1,73 @@
+import multiprocessing as mp
+import traceback
+import pickle
+import random
+import time
+
+import numpy as np
+import torch
+
+
+def _worker(agent, n_steps, max_episode_steps, seed, queue):
+    """
+    body of one warm up process, forked from the learner. runs random episodes with its copy of agent and sends
+    every episode pickled, so its tensors are copied instead of shared
+    """
+    try:
+        torch.set_num_threads(1)
+        random.seed(seed)
+        np.random.seed(seed)
+        torch.manual_seed(seed)
+        if hasattr(agent.env, 'seed'):
+            agent.env.seed(seed)
+        agent.device = torch.device('cpu')
+        start = time.time()
+        agent.collectRandom(n_steps, max_episode_steps,
+                            lambda episode: queue.put(('episode', pickle.dumps(episode, pickle.HIGHEST_PROTOCOL))))
+        queue.put(('done', time.time() - start))
+    except Exception:
+        queue.put(('error', traceback.format_exc()))
+
+
+def collectParallel(agent, n_steps, max_episode_steps, workers, push):
+    """
+    run random episodes in forked copies of agent (DQNAgent.collectRandom) until they collected n_steps transitions
+    together. every worker seeds its env and random generators apart
+    :param agent: DQNAgent, its env has to survive a fork
+    :param n_steps: number of transitions to collect over all the workers
+    :param max_episode_steps: maximum length of one episode
+    :param workers: number of worker processes
+    :param push: function(episode) called in this process for every episode, in the order they arrive
+    :return: number of transitions collected, summed collection time of the workers in seconds
+    """
+    ctx = mp.get_context('fork') if hasattr(mp, 'get_context') else mp
+    queue = ctx.Queue()
+    seed = random.randrange(2 ** 30)
+    quota = -(-n_steps // workers)
+    processes = []
+    for i in range(workers):
+        process = ctx.Process(target=_worker, args=(agent, quota, max_episode_steps, seed + i, queue))
+        process.daemon = True
+        process.start()
+        processes.append(process)
+    n = 0
+    env_time = 0.
+    running = workers
+    try:
+        while running > 0:
+            kind, payload = queue.get()
+            if kind == 'error':
+                raise RuntimeError('warm up worker failed:\n{}'.format(payload))
+            if kind == 'done':
+                env_time += payload
+                running -= 1
+                continue
+            episode = pickle.loads(payload)
+            push(episode)
+            n += len(episode)
+    finally:
+        for process in processes:
+            process.join(5)
+            if process.is_alive():
+                process.terminate()
+    return n, env_time
@@ -0,0 +1,19 @@
+import sys
+sys.path.append('../..')
+from agent.syn_agent.apex import ApexTrainer
+from syn_dqn import *
+
+
+def makeEnvs(actor_id, n_envs=4):
+    envs = []
+    for i in range(n_envs):
+        env = gym.make("CartPole-v1")
+        env.seed(actor_id * n_envs + i)
+        envs.append(env)
+    return envs
+
+
+if __name__ == '__main__':
+    agent = Agent(DQN(), makeEnvs(0), LinearSchedule(10000, 0.02), batch_size=128, min_mem=1000)
+    trainer = ApexTrainer(agent, makeEnvs, n_actors=8)
+    trainer.train(10000, 500)
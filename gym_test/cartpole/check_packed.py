@@ -0,0 +1,45 @@
+import sys
+import torch
+import torch.nn as nn
+
+sys.path.append('../..')
+
+from drqn import DRQN
+from drqn_agent import CartPoleDRQNAgent
+from agent.drqn_agent import Transition, forwardPacked
+
+
+def checkPacked():
+    """
+    the packed update has to see the same q values and targets as the padded one, on a batch of random episodes
+    """
+    agent = CartPoleDRQNAgent(DRQN, model=DRQN(), batch_size=3, min_mem=1)
+    episodes = []
+    for length in [5, 3, 4]:
+        states = [torch.randn(1, 4) for _ in range(length + 1)]
+        episodes.append([Transition(states[t], torch.tensor([[t % 2]]), states[t + 1] if t < length - 1 else None,
+                                    torch.tensor([1.])) for t in range(length)])
+
+    agent.packed = False
+    state_batch, action_batch, next_state_batch, _, final_mask, non_pad_mask = agent.unzipMemory(list(episodes))
+    with torch.no_grad():
+        q_values = agent.policy_net(state_batch)[0].gather(2, action_batch).squeeze(2)
+        targets = agent.target_net(next_state_batch)[0].max(2)[0]
+    targets[final_mask] = 0
+
+    agent.packed = True
+    state_batch, next_state_batch, action_batch, _, final_mask = agent.unzipPacked(list(episodes))
+    with torch.no_grad():
+        packed_q_values = forwardPacked(agent.policy_net, state_batch)[0].data.gather(1, action_batch).squeeze(1)
+        packed_targets = forwardPacked(agent.target_net, next_state_batch)[0].data.max(1)[0]
+    packed_targets[final_mask] = 0
+
+    def pad(x):
+        return nn.utils.rnn.pad_packed_sequence(nn.utils.rnn.PackedSequence(x, state_batch.batch_sizes), True)[0]
+    assert torch.allclose(pad(packed_q_values)[non_pad_mask], q_values[non_pad_mask], atol=1e-6)
+    assert torch.allclose(pad(packed_targets)[non_pad_mask], targets[non_pad_mask], atol=1e-6)
+    print 'packed q values and targets equal the padded ones'
+
+
+if __name__ == '__main__':
+    checkPacked()
@@ -32,12 +32,20 @@ class DRQN(torch.nn.Module):
         x = self.fc2(x)
         return x, hidden
 
+    def forwardPacked(self, x, hidden=None):
+        x = nn.utils.rnn.PackedSequence(F.relu(self.fc1(x.data)), x.batch_sizes)
+        if hidden is None:
+            x, hidden = self.lstm(x)
+        else:
+            x, hidden = self.lstm(x, hidden)
+        return nn.utils.rnn.PackedSequence(self.fc2(x.data), x.batch_sizes), hidden
+
 
 def train():
     env = gym.make("CartPole-v1")
     agent = CartPoleDRQNAgent(DRQN, model=DRQN(), env=env,
                               exploration=LinearSchedule(10000, initial_p=1.0, final_p=0.02),
-                              batch_size=4, memory_size=100000, min_mem=100)
+                              batch_size=4, memory_size=100000, min_mem=100, packed=True, length_buckets=10)
     agent.saving_dir = '/home/ur5/thesis/rdd_rl/gym_test/cartpole/data/drqn'
     agent.train(10000, 10000, 100, False)
 
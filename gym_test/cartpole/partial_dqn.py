@@ -65,7 +65,7 @@ def train():
 def plot(checkpoint):
     agent = CartPoleDRQNAgent(DQN)
     agent.saving_dir = '/home/ur5/thesis/rdd_rl/gym_test/data/dqn_cartpole_partial'
-    agent.loadCheckpoint(checkpoint)
+    agent.loadCheckpoint(checkpoint, data_only=True)
     plotLearningCurve(agent.episode_rewards, window=100)
     plt.show()
 
@@ -52,7 +52,7 @@ def plot(checkpoint):
                               exploration=LinearSchedule(100000, initial_p=1.0, final_p=0.1),
                               batch_size=32, target_update_frequency=20)
     agent.saving_dir = '/home/ur5/thesis/rdd_rl/gym_test/data/drqn_cartpole_partial'
-    agent.loadCheckpoint(checkpoint)
+    agent.loadCheckpoint(checkpoint, data_only=True)
     plotLearningCurve(agent.episode_rewards, window=20)
     plt.show()
 
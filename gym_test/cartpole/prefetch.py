@@ -0,0 +1,55 @@
+import time
+import tempfile
+import sys
+
+import torch
+
+sys.path.append('../..')
+from util.utils import LinearSchedule
+from dqn import CartPoleDRQNAgent as CartPoleDQNAgent, DQN
+from drqn import CartPoleDRQNAgent, DRQN
+
+import gym
+
+
+def timeTraining(make_agent, prefetch, n_episodes=100, seed=0):
+    """
+    train for n_episodes and time the learner
+    :param make_agent: function(env, prefetch) creating the agent
+    :param prefetch: number of mini batches assembled ahead, 0 for synchronous assembly
+    :return: total wall time, time the learner spent getting mini batches, number of steps
+    """
+    torch.manual_seed(seed)
+    env = gym.make("CartPole-v1")
+    env.seed(seed)
+    agent = make_agent(env, prefetch)
+    agent.saving_dir = tempfile.mkdtemp()
+    start = time.time()
+    while agent.episodes_done < n_episodes:
+        agent.trainOneEpisode(n_episodes, 500, n_episodes + 1)
+    agent.stopPrefetcher()
+    return time.time() - start, agent.batch_wait_time, agent.steps_done
+
+
+def makeDQNAgent(env, prefetch):
+    return CartPoleDQNAgent(DQN, model=DQN(), env=env,
+                            exploration=LinearSchedule(10000, initial_p=1.0, final_p=0.02),
+                            batch_size=64, prefetch=prefetch)
+
+
+def makeDRQNAgent(env, prefetch):
+    return CartPoleDRQNAgent(DRQN, model=DRQN(), env=env,
+                             exploration=LinearSchedule(10000, initial_p=1.0, final_p=0.02),
+                             batch_size=4, memory_size=100000, min_mem=1000, prefetch=prefetch)
+
+
+if __name__ == '__main__':
+    for name, make_agent in [('dqn', makeDQNAgent), ('drqn', makeDRQNAgent)]:
+        print name
+        per_step = {}
+        for prefetch in [0, 2]:
+            total, wait, steps = timeTraining(make_agent, prefetch)
+            per_step[prefetch] = (1000. * total / steps, 1000. * wait / steps)
+            print '    prefetch={}: {} steps, {:.2f}ms per step, {:.2f}ms of it waiting for mini batches' \
+                .format(prefetch, steps, per_step[prefetch][0], per_step[prefetch][1])
+        print '    hidden: {:.2f}ms per step'.format(per_step[0][1] - per_step[2][1])
@@ -0,0 +1,76 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import numpy as np
+import sys
+
+sys.path.append('../..')
+from agent.dqn_agent import DQNAgent
+
+from util.utils import LinearSchedule
+import gym
+
+
+class DQN(torch.nn.Module):
+    def __init__(self):
+        super(DQN, self).__init__()
+
+        self.fc1 = nn.Linear(4, 64)
+        self.fc2 = nn.Linear(64, 128)
+        self.fc3 = nn.Linear(128, 2)
+
+    def forward(self, x):
+        x = F.relu(self.fc1(x))
+        x = F.relu(self.fc2(x))
+        x = self.fc3(x)
+        return x
+
+
+class CartPoleDQNAgent(DQNAgent):
+    def __init__(self, *args, **kwargs):
+        DQNAgent.__init__(self, *args, **kwargs)
+        self.updates_done = 0
+
+    def takeAction(self, action):
+        obs, r, done, info = self.env.step(action)
+        if done:
+            r = -1
+        return obs, r, done, info
+
+    def optimizeModel(self):
+        if len(self.memory) >= self.batch_size:
+            self.updates_done += 1
+        DQNAgent.optimizeModel(self)
+
+    def train(self, num_episodes, max_episode_steps=100, save_freq=100, render=False):
+        while self.episodes_done < num_episodes:
+            self.trainOneEpisode(num_episodes, max_episode_steps, save_freq, render)
+            if len(self.episode_rewards) > 100 and np.average(self.episode_rewards[-100:]) > 195:
+                return True
+        return False
+
+
+def updatesToSolve(memory_type, seed, max_episodes=2000):
+    """
+    train on CartPole until the average reward over 100 episodes exceeds 195
+    :return: number of updates, or None if not solved within max_episodes
+    """
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+    env = gym.make("CartPole-v1")
+    env.seed(seed)
+    agent = CartPoleDQNAgent(DQN, model=DQN(), env=env,
+                             exploration=LinearSchedule(10000, initial_p=1.0, final_p=0.02),
+                             batch_size=32, memory_type=memory_type)
+    if agent.train(max_episodes, 500, max_episodes + 1):
+        return agent.updates_done
+    return None
+
+
+if __name__ == '__main__':
+    n_seeds = 3
+    results = {}
+    for memory_type in ['array', 'prioritized']:
+        results[memory_type] = [updatesToSolve(memory_type, seed) for seed in range(n_seeds)]
+    for memory_type in results:
+        print memory_type, 'updates to solve: ', results[memory_type]
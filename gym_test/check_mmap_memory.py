@@ -0,0 +1,39 @@
+import sys
+import pickle
+import shutil
+import tempfile
+
+import numpy as np
+import torch
+
+sys.path.append('..')
+
+from agent.mmap_memory import MmapReplayMemory
+
+
+def checkRoundTrip():
+    """
+    save, restart and sample: the memory built by the constructor of the resumed run must not truncate the files the
+    checkpoint reopens
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        memory = MmapReplayMemory(5, directory)
+        for i in range(5):
+            memory.push(torch.full((1, 2), i), torch.tensor([[i]]), torch.full((1, 2), i + 1), torch.tensor([i + 0.5]))
+        saved = pickle.dumps(memory)
+        del memory
+        MmapReplayMemory(5, directory)
+        memory = pickle.loads(saved)
+        state, action, next_state, reward, final_mask, _ = memory.gather(np.arange(5))
+        assert action.view(-1).tolist() == range(5), action
+        assert reward.tolist() == [i + 0.5 for i in range(5)], reward
+        assert state[:, 0].tolist() == range(5) and next_state[:, 0].tolist() == range(1, 6)
+        assert final_mask.tolist() == [0] * 5
+        print 'mmap memory round trip ok'
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    checkRoundTrip()
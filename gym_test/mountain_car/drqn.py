@@ -34,11 +34,19 @@ class DRQN(torch.nn.Module):
         x = self.fc2(x)
         return x, hidden
 
+    def forwardPacked(self, x, hidden=None):
+        x = nn.utils.rnn.PackedSequence(F.relu(self.fc1(x.data)), x.batch_sizes)
+        if hidden is None:
+            x, hidden = self.lstm(x)
+        else:
+            x, hidden = self.lstm(x, hidden)
+        return nn.utils.rnn.PackedSequence(self.fc2(x.data), x.batch_sizes), hidden
+
 
 if __name__ == '__main__':
     env = gym.make('MountainCar-v0')
     agent = DRQNAgent(DRQN, model=DRQN(), env=env,
                       exploration=LinearSchedule(100000, initial_p=1.0, final_p=0.02),
-                      batch_size=8, memory_size=1000, min_mem=100)
+                      batch_size=8, memory_size=1000, min_mem=100, packed=True, length_buckets=4)
     agent.saving_dir = '/home/ur5/thesis/rdd_rl/gym_test/mountain_car/data/drqn'
     agent.train(10000, 2000, 100, False, False)
@@ -7,7 +7,7 @@ import gym
 
 import sys
 sys.path.append('../..')
-from agent.drqn_slice_agent import DQNAgent
+from agent.dqn_agent import DQNAgent, FrameStackReplayMemory, ReplayMemory, ArrayReplayMemory
 from gym_test.wrapper import wrap_dqn
 from util.utils import LinearSchedule
 from util.plot import *
@@ -46,15 +46,20 @@ class DQN(nn.Module):
 
 class DQNStackAgent(DQNAgent):
     def __init__(self, *args, **kwargs):
+        stack_frames = kwargs.pop('stack_frames', 4)
         DQNAgent.__init__(self, *args, **kwargs)
+        # the frame stacked memory replaces a uniform one, there is no prioritized variant
+        assert type(self.memory) in (ReplayMemory, ArrayReplayMemory), \
+            'DQNStackAgent stores frame stacks uniformly, memory_type has to be list or array'
+        self.memory = FrameStackReplayMemory(self.memory.capacity, stack_frames)
 
     def resetEnv(self):
         obs = np.array(self.env.reset())
-        self.state = torch.tensor(obs, device=self.device, dtype=torch.float).unsqueeze(0)
+        self.state = torch.from_numpy(obs).unsqueeze(0).to(self.device)
         return
 
     def getNextState(self, obs):
-        return torch.tensor(np.array(obs), device=self.device, dtype=torch.float).unsqueeze(0)
+        return torch.from_numpy(np.array(obs)).unsqueeze(0).to(self.device)
 
 
 if __name__ == '__main__':
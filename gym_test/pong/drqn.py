@@ -31,12 +31,14 @@ class DRQN(nn.Module):
 
         return int(np.prod(o.size()))
 
-    def forward(self, x, hidden=None):
+    def encode(self, x):
         x = x.float() / 256
         shape = x.shape
         x = x.view(shape[0]*shape[1], shape[2], shape[3], shape[4])
         conv_out = self.conv(x)
-        x = conv_out.view(shape[0], shape[1], -1)
+        return conv_out.view(shape[0], shape[1], -1)
+
+    def head(self, x, hidden=None):
         if hidden is None:
             x, hidden = self.lstm(x)
         else:
@@ -44,6 +46,9 @@ class DRQN(nn.Module):
         x = self.fc(x)
         return x, hidden
 
+    def forward(self, x, hidden=None):
+        return self.head(self.encode(x), hidden)
+
 
 if __name__ == '__main__':
     env = gym.make('PongNoFrameskip-v4')
@@ -53,4 +58,5 @@ if __name__ == '__main__':
                       exploration=LinearSchedule(100000, 0.02),
                       batch_size=1, target_update_frequency=1000, memory_size=100000, min_mem=10000)
     agent.saving_dir = '/home/ur5/thesis/rdd_rl/gym_test/pong/data/drqn'
+    agent.warmUp(max_episode_steps=10000, workers=4)
     agent.train(10000, 10000, save_freq=50)
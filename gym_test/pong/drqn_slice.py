@@ -32,12 +32,14 @@ class DRQN(nn.Module):
 
         return int(np.prod(o.size()))
 
-    def forward(self, x, hidden=None):
+    def encode(self, x):
         x = x.float() / 256
         shape = x.shape
         x = x.view(shape[0]*shape[1], shape[2], shape[3], shape[4])
         conv_out = self.conv(x)
-        x = conv_out.view(shape[0], shape[1], -1)
+        return conv_out.view(shape[0], shape[1], -1)
+
+    def head(self, x, hidden=None):
         if hidden is None:
             x, hidden = self.lstm(x)
         else:
@@ -45,6 +47,9 @@ class DRQN(nn.Module):
         x = self.fc(x)
         return x, hidden
 
+    def forward(self, x, hidden=None):
+        return self.head(self.encode(x), hidden)
+
 
 # class DRQNSliceStackAgent(DRQNSliceAgent):
 #     def __init__(self, *args, **kwargs):
@@ -38,19 +38,18 @@ class DQN(nn.Module):
 class DQNStackAgent(SynDQNAgent):
     def __init__(self, *args, **kwargs):
         SynDQNAgent.__init__(self, *args, **kwargs)
+        if self.state_padding is not None:
+            self.state_padding = self.state_padding.to(torch.uint8)
 
     def resetEnv(self):
-        def reset(env):
-            return env.reset()
-        obss = self.pool.map(reset, self.envs)
-        obss = map(lambda x: np.array(x), obss)
+        obss = self.resetObs()
         self.alive_idx = [i for i in range(self.n_env)]
-        states = map(lambda x: torch.tensor(x, device=self.device, dtype=torch.float).unsqueeze(0), obss)
+        # frames stay uint8 until DQN.forward, like the states of getStateFromObs
+        states = map(lambda x: torch.from_numpy(np.array(x)).unsqueeze(0).to(self.device), obss)
         return states
 
     def getNextState(self, obss):
-        obss = map(lambda x: np.array(x), obss)
-        next_states = map(lambda x: torch.tensor(x, device=self.device, dtype=torch.float).unsqueeze(0)
+        next_states = map(lambda x: torch.from_numpy(np.array(x)).unsqueeze(0).to(self.device)
                           if x is not None else None, obss)
         return next_states
 
@@ -66,4 +65,8 @@ if __name__ == '__main__':
     agent = DQNStackAgent(DQN(envs[0].observation_space.shape, envs[0].action_space.n), envs, exploration=LinearSchedule(100000, 0.02),
                           batch_size=128, target_update_frequency=1000, memory_size=100000, min_mem=10000)
     agent.saving_dir = '/home/ur5/thesis/rdd_rl/gym_test/pong/data/syn_dqn'
+    agent.async_checkpoint = True
+    agent.keep_last = 5
+    agent.keep_every = 10
+    agent.warmUp(max_episode_steps=10000)
     agent.train(10000, 10000)
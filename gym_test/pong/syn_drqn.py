@@ -24,12 +24,14 @@ class DRQN(nn.Module):
 
         return int(np.prod(o.size()))
 
-    def forward(self, x, hidden=None):
+    def encode(self, x):
         x = x.float() / 256
         shape = x.shape
         x = x.view(shape[0]*shape[1], shape[2], shape[3], shape[4])
         conv_out = self.conv(x)
-        x = conv_out.view(shape[0], shape[1], -1)
+        return conv_out.view(shape[0], shape[1], -1)
+
+    def head(self, x, hidden=None):
         if hidden is None:
             x, hidden = self.lstm(x)
         else:
@@ -37,26 +39,22 @@ class DRQN(nn.Module):
         x = self.fc(x)
         return x, hidden
 
+    def forward(self, x, hidden=None):
+        return self.head(self.encode(x), hidden)
+
 
 class DRQNStackAgent(SynDRQNAgent):
     def __init__(self, *args, **kwargs):
         SynDRQNAgent.__init__(self, *args, **kwargs)
+        if self.state_padding is not None:
+            self.state_padding = self.state_padding.to(torch.uint8)
 
-    def resetEnv(self):
-        def reset(env):
-            return env.reset()
-        obss = self.pool.map(reset, self.envs)
-        obss = map(lambda x: np.array(x), obss)
-        self.alive_idx = [i for i in range(self.n_env)]
-        states = map(lambda x: torch.tensor(x, device=self.device, dtype=torch.float).unsqueeze(0), obss)
+    def getStateFromObs(self, obss):
+        # frames stay uint8 until DRQN.forward, so replay stores 1 byte per pixel
+        states = map(lambda x: torch.from_numpy(np.array(x)).unsqueeze(0).to(self.device)
+                     if x is not None else self.state_padding, obss)
         return states
 
-    def getNextState(self, obss):
-        obss = map(lambda x: np.array(x), obss)
-        next_states = map(lambda x: torch.tensor(x, device=self.device, dtype=torch.float).unsqueeze(0)
-                          if x is not None else None, obss)
-        return next_states
-
 
 if __name__ == '__main__':
     envs = []
@@ -67,6 +65,8 @@ if __name__ == '__main__':
         envs.append(env)
 
     agent = DRQNStackAgent(DRQN(envs[0].observation_space.shape, envs[0].action_space.n), envs, exploration=LinearSchedule(100000, 0.02),
-                          batch_size=128, target_update_frequency=1000, memory_size=100000, min_mem=10000, sequence_len=10)
+                          batch_size=128, target_update_frequency=1000, memory_size=100000, min_mem=10000, sequence_len=10,
+                          single_pass=True)
     agent.saving_dir = '/home/ur5/thesis/rdd_rl/gym_test/pong/data/syn_drqn'
+    agent.warmUp(max_episode_steps=10000)
     agent.train(10000, 10000, 200)
\ No newline at end of file
@@ -67,53 +67,10 @@ class ConvDRQNAgent(DRQNSliceAgent):
             act = state[1]
             obs = obs.unsqueeze(0)
             act = act.unsqueeze(0)
-            q_values, self.hidden = self.policy_net((obs, act), self.hidden)
+            q_values, self.hidden = self.actorForward((obs, act), self.hidden)
             q_values = q_values.squeeze(0)
             return q_values
 
-    def unzipMemory(self, memory):
-        state_1_batch = []
-        state_2_batch = []
-
-        next_state_1_batch = []
-        next_state_2_batch = []
-
-        action_batch = []
-        reward_batch = []
-        final_mask_batch = []
-        pad_mask_batch = []
-
-        state_1_padding = self.state_padding
-        state_2_padding = torch.tensor([0. for _ in range(self.n_action)]).unsqueeze(0)
-
-        for episode in memory:
-            episode_transition = Transition(*zip(*episode))
-            state_1_batch.append(torch.cat([s[0] if s is not None else state_1_padding
-                                            for s in episode_transition.state]))
-            state_2_batch.append(torch.cat([s[1] if s is not None else state_2_padding
-                                            for s in episode_transition.state]))
-            next_state_1_batch.append(torch.cat([s[0] if s is not None else state_1_padding
-                                                 for s in episode_transition.next_state]))
-            next_state_2_batch.append(torch.cat([s[1] if s is not None else state_2_padding
-                                                 for s in episode_transition.next_state]))
-
-            action_batch.append(torch.cat(episode_transition.action))
-            reward_batch.append(torch.cat(episode_transition.reward))
-            final_mask_batch.append(torch.tensor(list(episode_transition.final_mask), dtype=torch.uint8))
-            pad_mask_batch.append(torch.tensor(list(episode_transition.pad_mask), dtype=torch.uint8))
-
-        state = (torch.stack(state_1_batch).to(self.device),
-                 torch.stack(state_2_batch).to(self.device))
-        action = torch.stack(action_batch).to(self.device)
-        next_state = (torch.stack(next_state_1_batch).to(self.device),
-                      torch.stack(next_state_2_batch).to(self.device))
-        reward = torch.stack(reward_batch).to(self.device)
-        final_mask = torch.stack(final_mask_batch).to(self.device)
-        pad_mask = torch.stack(pad_mask_batch)
-        non_pad_mask = 1 - pad_mask
-
-        return state, action, next_state, reward, final_mask, non_pad_mask
-
 
 if __name__ == '__main__':
     agent = ConvDRQNAgent(DRQN, model=DRQN(), env=ScoopEnv(),
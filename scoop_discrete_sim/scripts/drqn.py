@@ -60,11 +60,19 @@ class DRQN(torch.nn.Module):
         x = self.fc2(x)
         return x, (hx, cx)
 
+    def forwardPacked(self, x, hidden=None):
+        x = nn.utils.rnn.PackedSequence(F.relu(self.fc1(x.data)), x.batch_sizes)
+        if hidden is None:
+            x, hidden = self.lstm(x)
+        else:
+            x, hidden = self.lstm(x, hidden)
+        return nn.utils.rnn.PackedSequence(self.fc2(x.data), x.batch_sizes), hidden
+
 
 if __name__ == '__main__':
     agent = DRQNAgent(DRQN, model=DRQN(), env=SimScoopEnv(),
                           exploration=LinearSchedule(100000, initial_p=1.0, final_p=0.1),
-                          batch_size=2)
+                          batch_size=2, packed=True, length_buckets=8)
     agent.saving_dir = '/home/ur5/thesis/rdd_rl/scoop_discrete_sim/data/drqn_lrud'
     # agent.load_checkpoint('20190206133550')
     agent.train(100000, max_episode_steps=200)
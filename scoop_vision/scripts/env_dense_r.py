@@ -45,7 +45,7 @@ class ScoopEnv:
             p = [0.]
         xs = [i for i in range(len(p))]
         resampled = np.interp(np.linspace(0, len(p) - 1, 20), xs, p)
-        return np.rollaxis(self.sensor.getColorData(), 2, 0), np.expand_dims(resampled, 0)
+        return np.rollaxis(self.sensor.getColorData(), 2, 0).astype(np.uint8), np.expand_dims(resampled, 0)
 
     def reset(self):
         """
@@ -35,7 +35,7 @@ class ScoopEnv:
 
         self.open_position = 0.3
 
-        self.img_his = [np.zeros((3, 64, 64)) for _ in range(4)]
+        self.img_his = [np.zeros((3, 64, 64), dtype=np.uint8) for _ in range(4)]
         self.theta_his = [np.zeros((1, 20)) for _ in range(4)]
 
     def sendClearSignal(self):
@@ -49,7 +49,7 @@ class ScoopEnv:
         xs = [i for i in range(len(p))]
         resampled = np.interp(np.linspace(0, len(p) - 1, 20), xs, p)
 
-        img_obs = np.rollaxis(self.sensor.getColorData(), 2, 0)
+        img_obs = np.rollaxis(self.sensor.getColorData(), 2, 0).astype(np.uint8)
         theta_obs = np.expand_dims(resampled, 0)
 
         self.img_his = self.img_his[1:] + [img_obs]
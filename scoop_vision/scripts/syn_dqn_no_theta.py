@@ -29,6 +29,7 @@ class DQN(torch.nn.Module):
         return int(np.prod(o.size()))
 
     def forward(self, img):
+        img = img.float() / 256
         img_shape = img.shape
         img_conv_out = self.img_conv(img)
         x = img_conv_out.view(img_shape[0], -1)
@@ -45,10 +46,11 @@ class Agent(SynDQNAgent):
         SynDQNAgent.__init__(self, model, envs, exploration, gamma, memory_size, batch_size, target_update_frequency,
                              saving_dir, min_mem)
         if envs is not None:
-            self.state_padding = torch.zeros(self.envs[0].observation_space[0].shape, device=self.device).unsqueeze(0)
+            self.state_padding = torch.zeros(self.envs[0].observation_space[0].shape, device=self.device,
+                                             dtype=torch.uint8).unsqueeze(0)
 
     def getStateFromObs(self, obss):
-        states = map(lambda x: torch.tensor(x[0], device=self.device, dtype=torch.float).unsqueeze(0)
+        states = map(lambda x: torch.from_numpy(x[0]).unsqueeze(0).to(self.device)
                      if x is not None else self.state_padding, obss)
         return states
 
@@ -49,6 +49,7 @@ class DQN(torch.nn.Module):
 
     def forward(self, inputs):
         img, theta = inputs
+        img = img.float() / 256
         img_shape = img.shape
         img_conv_out = self.img_conv(img)
         img_vec = img_conv_out.view(img_shape[0], -1)
@@ -71,11 +72,12 @@ class Agent(SynDQNAgent):
                              saving_dir, min_mem)
         self.saving_dir = '/home/ur5/thesis/rdd_rl/scoop_vision/data/syn_dqn_wrist'
         if envs is not None:
-            self.state_padding = (torch.zeros(self.envs[0].observation_space[0].shape, device=self.device).unsqueeze(0),
+            self.state_padding = (torch.zeros(self.envs[0].observation_space[0].shape, device=self.device,
+                                              dtype=torch.uint8).unsqueeze(0),
                                   torch.zeros(self.envs[0].observation_space[1].shape, device=self.device).unsqueeze(0))
 
     def getStateFromObs(self, obss):
-        states = map(lambda x: (torch.tensor(x[0], device=self.device, dtype=torch.float).unsqueeze(0),
+        states = map(lambda x: (torch.from_numpy(x[0]).unsqueeze(0).to(self.device),
                                 torch.tensor(x[1], device=self.device, dtype=torch.float).unsqueeze(0))
                      if x is not None else self.state_padding, obss)
         return states
@@ -85,6 +87,8 @@ class Agent(SynDQNAgent):
         return torch.cat(imgs), torch.cat(thetas)
 
     def unzipMemory(self, memory):
+        if type(memory) is tuple:
+            return SynDQNAgent.unzipMemory(self, memory)
         state_0_padding = self.state_padding[0].to('cpu')
         state_1_padding = self.state_padding[1].to('cpu')
 
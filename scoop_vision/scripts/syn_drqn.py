@@ -41,8 +41,9 @@ class DRQN(torch.nn.Module):
         o = self.theta_conv(torch.zeros(1, *shape))
         return int(np.prod(o.size()))
 
-    def forward(self, inputs, hidden=None):
+    def encode(self, inputs):
         img, theta = inputs
+        img = img.float() / 256
         img_shape = img.shape
         img = img.view(img_shape[0]*img_shape[1], img_shape[2], img_shape[3], img_shape[4])
         img_conv_out = self.img_conv(img)
@@ -53,7 +54,9 @@ class DRQN(torch.nn.Module):
         theta_conv_out = self.theta_conv(theta)
         theta_vec = theta_conv_out.view(img_shape[0], img_shape[1], -1)
 
-        x = torch.cat((img_vec, theta_vec), 2)
+        return torch.cat((img_vec, theta_vec), 2)
+
+    def head(self, x, hidden=None):
         if hidden is None:
             x, hidden = self.lstm(x)
         else:
@@ -61,16 +64,20 @@ class DRQN(torch.nn.Module):
         x = self.fc(x)
         return x, hidden
 
+    def forward(self, inputs, hidden=None):
+        return self.head(self.encode(inputs), hidden)
+
 
 class Agent(SynDRQNAgent):
     def __init__(self, model, envs, exploration,
                  gamma=0.99, memory_size=100000, batch_size=64, target_update_frequency=1000, saving_dir=None,
-                 min_mem=1000, sequence_len=10):
+                 min_mem=1000, sequence_len=10, memory_type='sequence'):
         saving_dir = '/home/ur5/thesis/rdd_rl/scoop_vision/data/syn_drqn'
         SynDRQNAgent.__init__(self, model, envs, exploration, gamma, memory_size, batch_size, target_update_frequency,
-                              saving_dir, min_mem, sequence_len)
+                              saving_dir, min_mem, sequence_len, memory_type)
         if envs is not None:
-            self.state_padding = (torch.zeros(self.envs[0].observation_space[0].shape, device=self.device).unsqueeze(0),
+            self.state_padding = (torch.zeros(self.envs[0].observation_space[0].shape, device=self.device,
+                                              dtype=torch.uint8).unsqueeze(0),
                               torch.zeros(self.envs[0].observation_space[1].shape, device=self.device).unsqueeze(0))
 
     def forwardPolicyNet(self, x):
@@ -83,7 +90,7 @@ class Agent(SynDRQNAgent):
             return q_values
 
     def getStateFromObs(self, obss):
-        states = map(lambda x: (torch.tensor(x[0], device=self.device, dtype=torch.float).unsqueeze(0),
+        states = map(lambda x: (torch.from_numpy(x[0]).unsqueeze(0).to(self.device),
                                 torch.tensor(x[1], device=self.device, dtype=torch.float).unsqueeze(0))
                      if x is not None else self.state_padding, obss)
         return states
@@ -92,48 +99,6 @@ class Agent(SynDRQNAgent):
         imgs, thetas = zip(*states)
         return torch.cat(imgs), torch.cat(thetas)
 
-    def unzipMemory(self, memory):
-        state_0_batch = []
-        state_1_batch = []
-
-        next_state_0_batch = []
-        next_state_1_batch = []
-
-        action_batch = []
-        reward_batch = []
-        final_mask_batch = []
-        pad_mask_batch = []
-
-        state_0_padding = self.state_padding[0].to('cpu')
-        state_1_padding = self.state_padding[1].to('cpu')
-
-        for episode in memory:
-            episode_transition = Transition(*zip(*episode))
-            state_0_batch.append(torch.cat([s[0] if s is not None else state_0_padding
-                                            for s in episode_transition.state]))
-            state_1_batch.append(torch.cat([s[1] if s is not None else state_1_padding
-                                            for s in episode_transition.state]))
-            next_state_0_batch.append(torch.cat([s[0] if s is not None else state_0_padding
-                                                 for s in episode_transition.next_state]))
-            next_state_1_batch.append(torch.cat([s[1] if s is not None else state_1_padding
-                                                 for s in episode_transition.next_state]))
-            action_batch.append(torch.cat(episode_transition.action))
-            reward_batch.append(torch.cat(episode_transition.reward))
-            final_mask_batch.append(torch.tensor(list(episode_transition.final_mask), dtype=torch.uint8))
-            pad_mask_batch.append(torch.tensor(list(episode_transition.pad_mask), dtype=torch.uint8))
-
-        state = (torch.stack(state_0_batch).to(self.device),
-                 torch.stack(state_1_batch).to(self.device))
-        action = torch.stack(action_batch).to(self.device)
-        next_state = (torch.stack(next_state_0_batch).to(self.device),
-                      torch.stack(next_state_1_batch).to(self.device))
-        reward = torch.stack(reward_batch).to(self.device)
-        final_mask = torch.stack(final_mask_batch).to(self.device)
-        pad_mask = torch.stack(pad_mask_batch)
-        non_pad_mask = 1 - pad_mask
-
-        return state, action, next_state, reward, final_mask, non_pad_mask
-
 
 if __name__ == '__main__':
     envs = []
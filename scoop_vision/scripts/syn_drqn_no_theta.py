@@ -28,12 +28,14 @@ class DRQN(torch.nn.Module):
         o = self.img_conv(torch.zeros(1, *shape))
         return int(np.prod(o.size()))
 
-    def forward(self, img, hidden=None):
+    def encode(self, img):
         img = img.float() / 256
         img_shape = img.shape
         img = img.view(img_shape[0]*img_shape[1], img_shape[2], img_shape[3], img_shape[4])
         img_conv_out = self.img_conv(img)
-        x = img_conv_out.view(img_shape[0], img_shape[1], -1)
+        return img_conv_out.view(img_shape[0], img_shape[1], -1)
+
+    def head(self, x, hidden=None):
         if hidden is None:
             x, hidden = self.lstm(x)
         else:
@@ -41,6 +43,9 @@ class DRQN(torch.nn.Module):
         x = self.fc(x)
         return x, hidden
 
+    def forward(self, img, hidden=None):
+        return self.head(self.encode(img), hidden)
+
 
 class Agent(SynDRQNAgent):
     def __init__(self, model, envs, exploration,
@@ -49,10 +54,11 @@ class Agent(SynDRQNAgent):
         saving_dir = '/home/ur5/thesis/rdd_rl/scoop_vision/data/syn_drqn'
         SynDRQNAgent.__init__(self, model, envs, exploration, gamma, memory_size, batch_size, target_update_frequency,
                               saving_dir, min_mem, sequence_len)
-        self.state_padding = torch.zeros(self.envs[0].observation_space[0].shape, device=self.device).unsqueeze(0)
+        self.state_padding = torch.zeros(self.envs[0].observation_space[0].shape, device=self.device,
+                                         dtype=torch.uint8).unsqueeze(0)
 
     def getStateFromObs(self, obss):
-        states = map(lambda x: torch.tensor(x[0], device=self.device, dtype=torch.float).unsqueeze(0)
+        states = map(lambda x: torch.from_numpy(x[0]).unsqueeze(0).to(self.device)
                      if x is not None else self.state_padding, obss)
         return states
 
@@ -0,0 +1,54 @@
+import numpy as np
+
+
+class SumTree(object):
+    def __init__(self, capacity):
+        """
+        binary sum tree over capacity leaves. updates and prefix sum queries are batched, each costs O(log n)
+        :param capacity: number of leaves
+        """
+        self.capacity = capacity
+        self.tree_size = 1
+        while self.tree_size < capacity:
+            self.tree_size *= 2
+        self.tree = np.zeros(2 * self.tree_size)
+
+    def total(self):
+        return self.tree[1]
+
+    def get(self, idx):
+        """
+        get the values of the given leaves
+        :param idx: array of leaf indexes
+        :return: array of values
+        """
+        return self.tree[np.asarray(idx) + self.tree_size]
+
+    def update(self, idx, values):
+        """
+        set the values of the given leaves and refresh their ancestors
+        :param idx: array of leaf indexes
+        :param values: array of new values
+        :return: None
+        """
+        nodes = np.asarray(idx) + self.tree_size
+        self.tree[nodes] = values
+        nodes = np.unique(nodes // 2)
+        while len(nodes) > 0 and nodes[0] >= 1:
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+            nodes = np.unique(nodes // 2)
+
+    def find(self, prefix_sums):
+        """
+        find for every prefix sum the first leaf whose cumulative value exceeds it
+        :param prefix_sums: array of values in [0, total)
+        :return: array of leaf indexes
+        """
+        values = np.array(prefix_sums, dtype=np.float64)
+        nodes = np.ones(len(values), dtype=np.int64)
+        while len(nodes) > 0 and nodes[0] < self.tree_size:
+            left = 2 * nodes
+            go_right = values >= self.tree[left]
+            values -= self.tree[left] * go_right
+            nodes = left + go_right
+        return np.minimum(nodes - self.tree_size, self.capacity - 1)